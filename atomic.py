@@ -0,0 +1,176 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Atomic file writes.
+
+A file is replaced by writing its new contents to a temporary file in the
+same directory, syncing it and renaming it over the original. Readers (and a
+crash) see either the old or the new contents, never a partial file.
+
+Renames and removals only become durable once their directory is synced.
+A Transaction collects the directories it touched and syncs each of them
+once, when it is committed, instead of once per file.
+
+A Transaction given a journal records the previous state of every file
+before changing it, and writes its log when committed (see snapshot).
+"""
+
+
+import errno
+import os
+import stat
+import tempfile
+import threading
+
+
+# Mode of files created without a mode or an existing file to copy it from
+DEFAULT_MODE = 0o644
+
+
+class Transaction(object):
+
+    def __init__(self, journal=None):
+        self.dirs = set()
+        self.lock = threading.Lock()
+        self.journal = journal
+
+    def write(self, filename, contents, mode=None, follow=True):
+        """
+        Replace the contents of the file atomically.
+
+        'contents' is a string, or an iterable of strings written in turn.
+        The mode and ownership of an existing file are kept. A new file gets
+        'mode' (default: DEFAULT_MODE) and the ownership of its directory.
+        Symbolic links are followed, the file they point to is replaced,
+        unless 'follow' is False: the link itself is then replaced by a new
+        file. Missing directories are created.
+        """
+        if follow:
+            filename = os.path.realpath(filename)
+        else:
+            filename = os.path.abspath(filename)
+        if self.journal is not None:
+            self.journal.record(filename)
+        dirname = os.path.dirname(filename)
+        if not os.path.exists(dirname):
+            self._makedirs(dirname)
+        st = None
+        # A link replaced by the file has no mode or owner to keep
+        if not os.path.islink(filename):
+            try:
+                st = os.stat(filename)
+            except OSError:
+                pass
+        if st is None:
+            owner = os.stat(dirname)
+            mode = DEFAULT_MODE if mode is None else mode
+        else:
+            owner = st
+            mode = stat.S_IMODE(st.st_mode)
+
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.{}.'.format(
+            os.path.basename(filename)), suffix='.tmp')
+        try:
+            # Set the attributes before any contents are written
+            os.fchmod(fd, mode)
+            fst = os.fstat(fd)
+            if (fst.st_uid, fst.st_gid) != (owner.st_uid, owner.st_gid):
+                os.fchown(fd, owner.st_uid, owner.st_gid)
+            with os.fdopen(fd, 'wb') as fil:
+                if isinstance(contents, bytes):
+                    fil.write(contents)
+                else:
+                    for chunk in contents:
+                        fil.write(chunk)
+                fil.flush()
+                os.fsync(fil.fileno())
+            os.rename(tmpname, filename)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        self._touch(dirname)
+
+    def symlink(self, target, filename):
+        """
+        Make the file a symbolic link to the target, atomically replacing
+        whatever the file was.
+        """
+        filename = os.path.abspath(filename)
+        if self.journal is not None:
+            self.journal.record(filename)
+        dirname = os.path.dirname(filename)
+        if not os.path.exists(dirname):
+            self._makedirs(dirname)
+        tmpname = tempfile.mktemp(dir=dirname, prefix='.{}.'.format(
+            os.path.basename(filename)), suffix='.tmp')
+        os.symlink(target, tmpname)
+        try:
+            os.rename(tmpname, filename)
+        except:
+            os.remove(tmpname)
+            raise
+        self._touch(dirname)
+
+    def remove(self, filename):
+        """
+        Remove the file if it exists.
+        """
+        if self.journal is not None and os.path.lexists(filename):
+            self.journal.record(filename)
+        try:
+            os.remove(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        self._touch(os.path.dirname(os.path.abspath(filename)))
+
+    def commit(self):
+        """
+        Sync every directory touched since the last commit, after writing the
+        log of the journal.
+        """
+        if self.journal is not None:
+            self.journal.save(self)
+        with self.lock:
+            dirs, self.dirs = self.dirs, set()
+        for dirname in sorted(dirs):
+            fd = os.open(dirname, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _makedirs(self, dirname):
+        parent = os.path.dirname(dirname)
+        if not os.path.exists(parent):
+            self._makedirs(parent)
+        try:
+            os.mkdir(dirname)
+        except OSError as e:
+            # Created meanwhile by another thread
+            if e.errno != errno.EEXIST:
+                raise
+        self._touch(parent)
+
+    def _touch(self, dirname):
+        with self.lock:
+            self.dirs.add(dirname)
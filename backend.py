@@ -31,17 +31,40 @@ sensitive. Setting wrong file permissions, file-modes or newline characters
 could result in errors. Any changes made to these files must comply with the
 underlying OS specifications.
 
+The set and remove functions are built on plans. A plan maps each file whose
+contents have to change to its new contents (None if the file is to be
+removed), computed from the inputs and what is on disk. Files which already
+hold the desired contents are left untouched, so applying the same settings
+twice writes nothing. Files are replaced atomically (see atomic), group the
+calls in a transaction() to sync directories once for all of them.
+
 All the strings in this module (except docstrings) uses single quotes for
 uniformity. Any single quotes within them are escaped appropriately.
 """
 
 
+import collections
+import contextlib
 import os
 import subprocess
+import threading
+
+import confmodel
+import scanner
+from atomic import Transaction
+from edit import Edit
+from scanindex import ScanIndex
+from snapshot import Journal
 
 
 DEFAULT_PORT = 8080
 
+# Phrases identifying proxy settings (and references to them) in files
+PHRASES = ('_proxy=', '_PROXY=', '_proxy', '_PROXY', '::proxy', 'BASH_ENV')
+
+
+# Root of the file system tree the settings are applied to (see set_root)
+root = '/'
 
 # Root's files
 environment = '/etc/environment'
@@ -64,12 +87,166 @@ bashlogin = os.path.join(home, '.bash_login')
 userprofile = os.path.join(home, '.profile')
 bashenv = os.path.join(home, '.bash_env')
 
+# Profiles and the relay (see profiles and relay)
+statedir = '/var/lib/grrproxy'
+profilesdir = os.path.join(statedir, 'profiles')
+currentlink = os.path.join(statedir, 'current')
+relayconf = os.path.join(statedir, 'relay.json')
+snapshotsdir = os.path.join(statedir, 'snapshots')
+
+# Paths of the files within the root, as seen by the programs reading them
+_PATHNAMES = ('home', 'environment', 'bashbashrc', 'aptconf', 'aptconfd',
+              'aptfrag', 'sudoers', 'sudoersd', 'sudodproxy', 'profile',
+              'profiled', 'profdproxy', 'bashrc', 'bashprofile', 'bashlogin',
+              'userprofile', 'bashenv', 'statedir', 'profilesdir',
+              'currentlink', 'relayconf', 'snapshotsdir')
+_paths = dict((name, globals()[name]) for name in _PATHNAMES)
+
+
+def set_root(path, homedir=None):
+    """
+    Target the file system tree at 'path' (a chroot or the root file system
+    of a container) instead of '/'.
+
+    Every file path of this module is moved below the root. The contents
+    written keep referring to the files as seen from within the root. The
+    user's files are those of 'homedir' within the root (default: HOME).
+    The scan index is keyed by the actual paths and can be shared by roots.
+    """
+    global root
+    root = os.path.abspath(path)
+    paths = dict(_paths)
+    if homedir is not None:
+        for name in ('bashrc', 'bashprofile', 'bashlogin', 'userprofile',
+                     'bashenv'):
+            paths[name] = os.path.join(
+                homedir, os.path.relpath(paths[name], paths['home']))
+        paths['home'] = homedir
+    globals().update((name, rooted(p)) for name, p in paths.items())
+
+
+def rooted(path):
+    """
+    Return the actual path of a path within the root.
+    """
+    return os.path.join(root, os.path.relpath(path, '/'))
+
+
+def unrooted(path):
+    """
+    Return the path within the root of an actual path. Paths outside of the
+    root are returned as they are.
+    """
+    relpath = os.path.relpath(path, root)
+    if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+        return path
+    return os.path.join('/', relpath)
+
+
+class UserFiles(collections.namedtuple('UserFiles', 'bashprofile bashlogin '
+                                       'userprofile bashenv bashrc')):
+    """
+    The bash files of a user.
+    """
+
+    @property
+    def supfile(self):
+        """
+        The superior login file: the first existing one bash reads.
+        """
+        for filename in (self.bashprofile, self.bashlogin, self.userprofile):
+            if os.path.exists(filename):
+                return filename
+        return self.bashprofile
+
+
+def user_files(home):
+    """
+    Return the UserFiles of the user with the home directory.
+    """
+    return UserFiles(os.path.join(home, '.bash_profile'),
+                     os.path.join(home, '.bash_login'),
+                     os.path.join(home, '.profile'),
+                     os.path.join(home, '.bash_env'),
+                     os.path.join(home, '.bashrc'))
+
+
+# GSettings
+gsettings = 'gsettings'
+dconf = 'dconf'
+proxyschema = 'org.gnome.system.proxy'
+proxydir = '/org/gnome/system/proxy/'
+
+# Defaults of the keys of the proxy schemas, by keyfile section
+GSETTINGS_DEFAULTS = {
+    '/': {'mode': 'none', 'autoconfig-url': '', 'use-same-proxy': True,
+          'ignore-hosts': ['localhost', '127.0.0.0/8', '::1']},
+    'http': {'enabled': False, 'host': '', 'port': 8080,
+             'use-authentication': False, 'authentication-user': '',
+             'authentication-password': ''},
+    'https': {'host': '', 'port': 0},
+    'ftp': {'host': '', 'port': 0},
+    'socks': {'host': '', 'port': 0},
+}
+
+# Cache files
+scanindexfile = '/var/cache/grrproxy/scanindex.json'
+modelcachefile = '/var/cache/grrproxy/models.json'
+
+# Phrase scans are cached across runs (keyed by inode, mtime and size)
+index = ScanIndex(scanindexfile, PHRASES)
+
+# So are the models of environment, apt and sudoers, re-parsed only where
+# the files changed (see confmodel)
+models = confmodel.ModelCache(modelcachefile)
+
+# Symbolic link to be made, in place of file contents in a plan
+Link = collections.namedtuple('Link', 'target')
+
+# Write transaction shared by the threads of an apply or remove
+_transaction = None
+_transactionlock = threading.Lock()
+
+# Record the previous state of the files changed (see snapshot)
+snapshots = True
+
+
+def _new_transaction():
+    if not snapshots:
+        return Transaction()
+    return Transaction(Journal(snapshotsdir, digest=index.digest))
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Group the file changes made within into a single write transaction.
+
+    Every file is replaced atomically as it is written, but the directories
+    are only synced once, when the outermost block exits. Changes made
+    outside of a transaction are synced immediately. The files changed are
+    snapshotted first, the id of the log is then trans.journal.last.
+    """
+    global _transaction
+    with _transactionlock:
+        outer = _transaction is None
+        if outer:
+            _transaction = _new_transaction()
+        trans = _transaction
+    try:
+        yield trans
+    finally:
+        if outer:
+            with _transactionlock:
+                _transaction = None
+            trans.commit()
+
 
 def get_noproxy():
     """
     Return default noproxy hosts from gsettings.
     """
-    args = ['gsettings', 'get', 'org.gnome.system.proxy', 'ignore-hosts']
+    args = [gsettings, 'get', proxyschema, 'ignore-hosts']
     # Assume gsettings uses single rather than double quotes
     noprolist = subprocess.check_output(args).split('\'')[1:-1:2]
     return noprolist
@@ -78,15 +255,13 @@ def get_noproxy():
 def find_phrase(filename, *phrases):
     """
     Return True if any of the phrases are in the file.
-    """
-    if not os.path.exists(filename):
-        return
 
-    with open(filename, 'r') as fil:
-        lines = fil.readlines()
-        for phrase in phrases:
-            if any(phrase in l for l in lines):
-                return True
+    Results are looked up in the scan index first. The file is only read if it
+    has changed since it was last scanned.
+    """
+    lines = index.lookup(filename, phrases, scanner.scan)
+    if lines and any(lines.values()):
+        return True
 
 
 def check_bash():
@@ -97,18 +272,32 @@ def check_bash():
                   bashbashrc, bashrc, profdproxy, profile]
     found = []
     for filename in checkfiles:
-        if find_phrase(filename, '_proxy=', '_PROXY='):
+        if find_phrase(filename, *_bash_phrases()):
             found.append(filename)
+    index.save()
     return found
 
 
+def check_user_bash(home):
+    """
+    Return filename(s) of the user with the home directory containing proxy
+    settings for bash.
+
+    Only the user's own files are checked. The scan index is not saved, this
+    is left to the caller of a batch of users.
+    """
+    return [f for f in user_files(home)
+            if find_phrase(f, *_bash_phrases())]
+
+
 def check_environment():
     """
     Return filename(s) containing proxy settings for environment.
     """
     found = []
-    if find_phrase(environment, '_proxy=', '_PROXY='):
+    if _proxy_items(environment, confmodel.ENVIRONMENT):
         found.append(environment)
+    models.save()
     return found
 
 
@@ -117,8 +306,9 @@ def check_apt():
     found = []
     checkfiles = [aptconf, aptfrag]
     for filename in checkfiles:
-        if find_phrase(filename, '::proxy'):
+        if _proxy_items(filename, confmodel.APT):
             found.append(filename)
+    models.save()
     return found
 
 
@@ -126,21 +316,102 @@ def check_gsettings():
     """
     Return non empty value(s) of proxy keys in GSettings.
 
-    Some keys should neither be used nor modified. They cannot be relied for
-    correct proxy settings either. You may filter them manually for further
-    processing.
+    Only keys holding a non default value are considered. The mode, boolean
+    values and empty strings cannot be relied for correct proxy settings and
+    are left out. Each value is reported as '<schema> <key> <value>'.
     """
     found = []
-    args = ['gsettings', 'list-recursively', 'org.gnome.system.proxy']
-    lines = subprocess.check_output(args).split('\n')
-    for line in lines:
-        # Check the last part
-        if line and line.split()[-1] not in ('mode' 'true', 'false',
-                                             '\'\'', '""'):
-            found.append(line)
+    settings = _parse_keyfile(_dconf('dump', proxydir))
+    for section in sorted(settings):
+        for key, value in sorted(settings[section].items()):
+            if (key != 'mode' and
+                    value not in ('true', 'false', '\'\'', '""') and
+                    value != _gsettings_default(section, key)):
+                found.append('{} {} {}'.format(_schema(section), key, value))
     return found
 
 
+def _gsettings_default(section, key):
+    """
+    Return the default of a key of a keyfile section in GVariant text format,
+    or None if it is unknown.
+    """
+    default = GSETTINGS_DEFAULTS.get(section, {}).get(key)
+    return None if default is None else _gvariant(default)
+
+
+def _schema(section):
+    """
+    Return the schema of a keyfile section relative to the proxy schema.
+    """
+    if section == '/':
+        return proxyschema
+    return '{}.{}'.format(proxyschema, section.strip('/').replace('/', '.'))
+
+
+def _dconf(*args, **kwargs):
+    """
+    Run dconf with the arguments and return its output.
+
+    Keyword argument 'input' is written to its standard input.
+    """
+    cmd = [dconf] + list(args)
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    output = proc.communicate(kwargs.get('input'))[0]
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return output
+
+
+def _gvariant(value):
+    """
+    Return the GVariant text format of a boolean, integer, string or list.
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return '[{}]'.format(', '.join(_gvariant(v) for v in value))
+    # Quote as dconf prints strings, so that values compare equal
+    value = str(value)
+    quote = '"' if '\'' in value and '"' not in value else '\''
+    escaped = value.replace('\\', '\\\\').replace(quote, '\\' + quote)
+    return '{0}{1}{0}'.format(quote, escaped)
+
+
+def _make_keyfile(settings):
+    """
+    Return a dconf keyfile for {section: {key: value}} settings. Values are
+    in GVariant text format.
+    """
+    sections = []
+    for section in sorted(settings):
+        lines = ['[{}]'.format(section)]
+        for key, value in sorted(settings[section].items()):
+            lines.append('{}={}'.format(key, value))
+        sections.append('\n'.join(lines))
+    return '{}\n'.format('\n\n'.join(sections))
+
+
+def _parse_keyfile(keyfile):
+    """
+    Return {section: {key: value}} from a dconf keyfile. Values are left in
+    GVariant text format.
+    """
+    settings = {}
+    section = None
+    for line in keyfile.splitlines():
+        line = line.strip()
+        if line.startswith('[') and line.endswith(']'):
+            section = settings.setdefault(line[1:-1], {})
+        elif '=' in line and section is not None:
+            key, value = line.split('=', 1)
+            section[key] = value
+    return settings
+
+
 def check_sudoers():
     """
     Return filename(s) containing proxy settings for sudoers.
@@ -148,8 +419,9 @@ def check_sudoers():
     found = []
     checkfiles = [sudoers, sudodproxy]
     for filename in checkfiles:
-        if find_phrase(filename, '_proxy', '_PROXY'):
+        if _proxy_items(filename, confmodel.SUDOERS):
             found.append(filename)
+    models.save()
     return found
 
 
@@ -164,69 +436,92 @@ def set_bash(protos, hosts, ports, user=None, pwd=None,
 
     For more information, please refer to http://www.gnu.org/software/bash/
     manual/bashref.html#Bash-Startup-Files
+
+    Existing proxy settings are replaced. Only the files whose contents
+    change are written, the changed filenames are returned.
+    """
+    return commit(plan_bash(protos, hosts, ports, user=user, pwd=pwd,
+                            noproxy=noproxy, useauth=useauth))
+
+
+def plan_bash(protos, hosts, ports, user=None, pwd=None,
+              noproxy=None, useauth=None):
     """
+    Return the changes applying proxy settings for bash (see set_bash).
+    """
+    files = UserFiles(bashprofile, bashlogin, userprofile, bashenv, bashrc)
+    lines = proxy_lines('export {}="{}"', protos, hosts, ports, user=user,
+                        pwd=pwd, noproxy=noproxy, useauth=useauth)
+    checkfiles = list(files) + [bashbashrc, profdproxy, profile]
+    setfiles = (profdproxy, files.supfile, bashbashrc, bashrc, bashenv)
+    desired = _bash_edits(checkfiles, setfiles, bashenv, lines)
+    if os.path.islink(profdproxy):
+        # Linked to a profile, which must not be edited through the link
+        desired[profdproxy] = '\n{}\n'.format(desired[profdproxy].tail)
+
     # Check for profile.d reference in profile
-    if not os.path.exists(profile):
-        open(profile, 'w').close()
-    with open(profile, 'r+') as prof:
-        lines = prof.readlines()
-        for line in lines:
-            if os.path.join(profiled, '*.sh') in line:
-                break
+    if not desired[profile].contains(os.path.join(unrooted(profiled),
+                                                  '*.sh')):
         # Line is absent, write the script
-        else:
-            script = ['if [ -d /etc/profile.d ]; then',
-                      '  for i in /etc/profile.d/*.sh; do',
-                      '    if [ -r $i ]; then',
-                      '      . $i',
-                      '    fi',
-                      '  done',
-                      '  unset i',
-                      'fi']
-            newline = '' if lines and lines[-1] == '\n' else '\n'
-            prof.write('{}{}\n'.format(newline, '\n'.join(script)))
-
-    # Ensure profile.d exists
-    if not os.path.exists(profiled):
-        os.makedirs(profiled)
-
-    # Make or pick the superior file
-    for filename in (bashprofile, bashlogin, userprofile):
-        if os.path.exists(filename):
-            supfile = filename
-            break
-    else:
-        os.makedirs(bashprofile)
-        supfile = bashprofile
+        script = ['if [ -d /etc/profile.d ]; then',
+                  '  for i in /etc/profile.d/*.sh; do',
+                  '    if [ -r $i ]; then',
+                  '      . $i',
+                  '    fi',
+                  '  done',
+                  '  unset i',
+                  'fi']
+        desired[profile].tail = '\n'.join(script)
+
+    return _diff(desired)
 
-    # Make the command lines
-    lines = []
-    authform = '{}:{}@'.format(user, pwd) if (user and pwd) else ''
-    for proto, host, port in zip(protos, hosts, ports):
-        # Use authentication for specified protocols
-        auth = '' if useauth and proto not in useauth else authform
-        # Make upper and lower cases spearately
-        lines.append('export {0}_proxy="{0}://{3}{1}:{2}/"'
-                     .format(proto, host, port, auth))
-        lines.append('export {4}_PROXY="{0}://{3}{1}:{2}/"'
-                     .format(proto, host, port, auth, proto.upper()))
-    if noproxy:
-        noproxy = ','.join(noproxy)
-        lines.append('export no_proxy="{}"'.format(noproxy))
-        lines.append('export NO_PROXY="{}"'.format(noproxy))
 
-    # Write the lines
+def set_user_bash(home, protos, hosts, ports, user=None, pwd=None,
+                  noproxy=None, useauth=None):
+    """
+    Apply proxy settings for bash to the files of the user with the home
+    directory only (see set_bash). The changed filenames are returned.
+    """
+    return commit(plan_user_bash(home, protos, hosts, ports, user=user,
+                                 pwd=pwd, noproxy=noproxy, useauth=useauth))
+
+
+def plan_user_bash(home, protos, hosts, ports, user=None, pwd=None,
+                   noproxy=None, useauth=None):
+    """
+    Return the changes applying proxy settings for bash to the files of the
+    user with the home directory.
+    """
+    files = user_files(home)
+    lines = proxy_lines('export {}="{}"', protos, hosts, ports, user=user,
+                        pwd=pwd, noproxy=noproxy, useauth=useauth)
+    setfiles = (files.supfile, files.bashrc, files.bashenv)
+    return _diff(_bash_edits(list(files), setfiles, files.bashenv,
+                             lines))
+
+
+def _bash_edits(checkfiles, setfiles, bashenv, lines):
+    """
+    Return the Edits of the bash files: the proxy lines are removed from the
+    check files and appended to the set files, along with a reference to
+    bashenv.
+    """
     contents = '\n'.join(lines)
-    for filename in (profdproxy, supfile, bashbashrc, bashrc, bashenv):
-        with open(filename, 'a+') as fil:
-            lines = fil.readlines()
-            newline = '' if lines and lines[-1] == '\n' else '\n'
+    beline = 'export BASH_ENV="{}"'.format(unrooted(bashenv))
+    desired = {}
+    for filename in checkfiles:
+        if filename in setfiles:
+            # Our own BASH_ENV line is moved along with the settings
+            edit = _edit(filename, _bash_phrases(), (beline,))
             # Add ~/.bash_env to all files except to itself
-            if filename == bashenv or any('BASH_ENV' in l for l in lines):
-                beline = ''
+            if filename == bashenv or edit.contains('BASH_ENV'):
+                edit.tail = contents
             else:
-                beline = 'export BASH_ENV="{}"\n'.format(bashenv)
-            fil.write('{}{}{}\n'.format(newline, beline, contents))
+                edit.tail = '{}\n{}'.format(beline, contents)
+        else:
+            edit = _edit(filename, _bash_phrases())
+        desired[filename] = edit
+    return desired
 
 
 def set_environment(protos, hosts, ports, user=None, pwd=None,
@@ -238,43 +533,62 @@ def set_environment(protos, hosts, ports, user=None, pwd=None,
     be visible after logging out and back in. You can check the programs using
     /etc/enviroment with:
     grep -l pam_env /etc/pam.d/*.
+
+    Existing proxy settings are replaced. The file is only written if its
+    contents change, the changed filenames are returned.
+    """
+    return commit(plan_environment(protos, hosts, ports, user=user, pwd=pwd,
+                                   noproxy=noproxy, useauth=useauth))
+
+
+def plan_environment(protos, hosts, ports, user=None, pwd=None,
+                     noproxy=None, useauth=None):
+    """
+    Return the changes applying proxy settings for environment.
     """
     # Make the command lines
-    lines = []
-    authform = '{}:{}@'.format(user, pwd) if (user and pwd) else ''
-    for proto, host, port in zip(protos, hosts, ports):
-        # Use authentication for specified protocols
-        auth = '' if useauth and proto not in useauth else authform
-        # Make upper and lower cases spearately
-        lines.append('{0}_proxy="{0}://{3}{1}:{2}/"'
-                     .format(proto, host, port, auth))
-        lines.append('{4}_PROXY="{0}://{3}{1}:{2}/"'
-                     .format(proto, host, port, auth, proto.upper()))
-    if noproxy:
-        lines.append('no_proxy="{}"'.format(','.join(noproxy)))
-        lines.append('NO_PROXY="{}"'.format(','.join(noproxy)))
-
-    # Write the lines
-    with open(environment, 'a+') as env:
-        envlines = env.readlines()
-        newline = '' if envlines and envlines[-1] == '\n' else '\n'
-        # Add ~/.bash_env
-        if any('BASH_ENV' in l for l in envlines):
-            beline = ''
-        else:
-            beline = 'BASH_ENV="{}"\n'.format(bashenv)
-        env.write('{}{}{}\n'.format(newline, beline, '\n'.join(lines)))
+    lines = proxy_lines('{}="{}"', protos, hosts, ports, user=user, pwd=pwd,
+                        noproxy=noproxy, useauth=useauth)
+    beline = 'BASH_ENV="{}"'.format(unrooted(bashenv))
+
+    # Our own BASH_ENV line is moved along with the settings
+    items = _model(environment, confmodel.ENVIRONMENT)
+    removed = [i for i in items if confmodel.ENVIRONMENT.is_proxy(i) or
+               i.name == 'BASH_ENV' and i.value == unrooted(bashenv)]
+    # Add ~/.bash_env
+    if not any(i.name == 'BASH_ENV' for i in items if i not in removed):
+        lines.insert(0, beline)
+    edit = _model_edit(environment, confmodel.ENVIRONMENT, removed,
+                       tail='\n'.join(lines))
+    return _diff({environment: edit})
 
 
 def set_apt(protos, hosts, ports, user=None, pwd=None, useauth=None):
     """
     Apply proxy settings for apt.
+
+    Existing proxy settings are replaced. Only the files whose contents
+    change are written, the changed filenames are returned.
     """
-    # Ensure aptconf.d is present
-    if not os.path.exists(aptconfd):
-        os.makedirs(aptconfd)
+    return commit(plan_apt(protos, hosts, ports, user=user, pwd=pwd,
+                           useauth=useauth))
 
-    # Make the command lines
+
+def plan_apt(protos, hosts, ports, user=None, pwd=None, useauth=None):
+    """
+    Return the changes applying proxy settings for apt.
+    """
+    lines = apt_lines(protos, hosts, ports, user=user, pwd=pwd,
+                      useauth=useauth)
+    desired = {aptconf: _remove_proxies(aptconf, confmodel.APT),
+               aptfrag: '\n{}\n'.format('\n'.join(lines))}
+    return _diff(desired)
+
+
+def apt_lines(protos, hosts, ports, user=None, pwd=None, useauth=None):
+    """
+    Return the apt configuration lines of the proxy settings.
+    """
     lines = []
     authform = '{}:{}@'.format(user, pwd) if (user and pwd) else ''
     for proto, host, port in zip(protos, hosts, ports):
@@ -282,43 +596,64 @@ def set_apt(protos, hosts, ports, user=None, pwd=None, useauth=None):
         auth = '' if useauth and proto not in useauth else authform
         lines.append('Acquire::{0}::proxy "{0}://{3}{1}:{2}/";'
                      .format(proto, host, port, auth))
-
-    # Write the lines
-    with open(aptfrag, 'w') as frag:
-        frag.write('\n{}\n'.format('\n'.join(lines)))
+    return lines
 
 
 def set_gsettings(protos, hosts, ports, user=None, pwd=None,
                   noproxy=None):
     """
     Apply proxy settings for GSettings.
+
+    All the keys are written in a single transaction, by loading a keyfile
+    into dconf. Nothing is written if the keys already hold these values.
+    Keys set previously but not part of these settings are written back to
+    their defaults in the same keyfile, so that no reader sees the settings
+    reset in between. Keys of unknown defaults, outside of the proxy
+    schemas, can only be reset: dconf is then reset before the load.
+    Return the changed keys as '<schema> <key>'.
     """
-    # Make the command lines
-    cmds = ['gsettings set org.gnome.system.proxy mode \'manual\'']
+    # Make the settings
+    settings = {'/': {'mode': 'manual'}}
     for proto, host, port in zip(protos, hosts, ports):
-        cmds.append('gsettings set org.gnome.system.proxy.{} host \'{}\''
-                    .format(proto, host))
-        cmds.append('gsettings set org.gnome.system.proxy.{} port {}'
-                    .format(proto, port))
+        settings[proto] = {'host': host, 'port': int(port)}
+    http = settings.setdefault('http', {})
     if user and pwd:
         # Use authentication for http (other's don't work)
-        cmds.append('gsettings set org.gnome.system.proxy.http '
-                    'use-authentication true')
-        cmds.append('gsettings set org.gnome.system.proxy.http '
-                    'authentication-user \'{}\''.format(user))
-        cmds.append('gsettings set org.gnome.system.proxy.http '
-                    'authentication-password \'{}\''.format(pwd))
+        http['use-authentication'] = True
+        http['authentication-user'] = user
+        http['authentication-password'] = pwd
     else:
-        cmds.append('gsettings set org.gnome.system.proxy.http '
-                    'use-authentication false')
+        http['use-authentication'] = False
     if noproxy:
-        ighosts = ['\'{}\''.format(host) for host in noproxy]
-        cmds.append('gsettings set org.gnome.system.proxy ignore-hosts "[{}]"'
-                    .format(', '.join(ighosts)))
-
-    # Call commands
-    for cmd in cmds:
-        subprocess.call(cmd, shell=True)
+        settings['/']['ignore-hosts'] = list(noproxy)
+
+    # Compare with the current values
+    current = _parse_keyfile(_dconf('dump', proxydir))
+    desired = dict((s, dict((k, _gvariant(v)) for k, v in keys.items()))
+                   for s, keys in settings.items())
+    unknown = False
+    for section, keys in current.items():
+        for key in keys:
+            if key not in desired.get(section, {}):
+                default = _gsettings_default(section, key)
+                if default is None:
+                    unknown = True
+                else:
+                    desired.setdefault(section, {})[key] = default
+    changed = []
+    for section in sorted(set(current) | set(desired)):
+        old, new = current.get(section, {}), desired.get(section, {})
+        changed.extend('{} {}'.format(_schema(section), k)
+                       for k in sorted(set(old) | set(new))
+                       if old.get(k) != new.get(k))
+    if not changed:
+        return changed
+
+    # Load the settings
+    if unknown:
+        _dconf('reset', '-f', proxydir)
+    _dconf('load', proxydir, input=_make_keyfile(desired))
+    return changed
 
 
 def set_sudoers(protos, noproxy=None):
@@ -330,110 +665,294 @@ def set_sudoers(protos, noproxy=None):
     couldn't be found. Every proxy values are written in a separate file inside
     sudoers.d. Any errors occured while editing these files could result in
     sudo denying you further access.
+
+    Existing proxy settings are replaced. Only the files whose contents
+    change are written, the changed filenames are returned.
     """
-    # Check for sudoers.d reference in sudoers file
-    if not os.path.exists(sudoers):
-        open(sudoers, 'w').close()
-    with open(sudoers, 'r+') as sd:
-        lines = sd.readlines()
-        incdir = '#includedir'
-        for line in lines:
-            if incdir in line and sudoersd in line:
-                break
-        else:
-            # Line is absent, write it in a new line
-            newline = '' if lines and lines[-1] == '\n' else '\n'
-            sd.write('{}{} {}\n'.format(newline, incdir, sudoersd))
+    return commit(plan_sudoers(protos, noproxy=noproxy))
 
-    # Ensure sudoers.d is present
-    if not os.path.exists(sudoersd):
-        os.makedirs(sudoersd)
+
+def plan_sudoers(protos, noproxy=None):
+    """
+    Return the changes applying proxy settings for sudoers.
+    """
+    # Check for sudoers.d reference in sudoers file
+    edit = _remove_proxies(sudoers, confmodel.SUDOERS)
+    if not any(i.kind == confmodel.INCLUDE and i.name == 'includedir' and
+               os.path.normpath(i.value) == unrooted(sudoersd)
+               for i in _model(sudoers, confmodel.SUDOERS)):
+        # Line is absent, write it in a new line
+        edit.tail = '#includedir {}'.format(unrooted(sudoersd))
 
     # Make the variables (both cases)
     variables = ['{}_proxy {}_PROXY'.format(p, p.upper()) for p in protos]
     if noproxy:
         variables.extend(['no_proxy NO_PROXY'])
 
-    # Write the variables
-    fd = os.open(sudodproxy, os.O_WRONLY | os.O_CREAT, 0o440)
-    with os.fdopen(fd, 'w') as sdp:
-        sdp.write('\nDefaults env_keep += "{}"\n'
-                  .format(' '.join(variables)))
+    desired = {sudoers: edit,
+               sudodproxy: '\nDefaults env_keep += "{}"\n'
+                           .format(' '.join(variables))}
+    return _diff(desired)
 
 
-def remove_lines(filename, *phrases):
+def plan_link_bash(script):
     """
-    Remove lines from the file containing any of the phrases.
+    Return the changes making bash source the script rather than hold the
+    proxy settings. The profile.d file is linked to it.
     """
-    if not os.path.exists(filename):
-        return
+    files = UserFiles(bashprofile, bashlogin, userprofile, bashenv, bashrc)
+    line = '[ -r "{0}" ] && . "{0}"'.format(unrooted(script))
+    checkfiles = list(files) + [bashbashrc, profile]
+    setfiles = (files.supfile, bashbashrc, bashrc, bashenv)
+    desired = _bash_edits(checkfiles, setfiles, bashenv, [line])
+    desired[profdproxy] = _link(script, profdproxy)
+    return _diff(desired)
 
-    # Make new lines excluding the phrases
-    newlines = []
-    with open(filename, 'r') as fil:
-        oldlines = fil.readlines()
-        for line in oldlines:
-            if not any(p in line for p in phrases):
-                newlines.append(line)
 
-    # Manage newline characters
-    while len(newlines) > 1 and newlines[-1] == newlines[-2] == '\n':
-        newlines.pop()
-    if not newlines[-1].endswith('\n'):
-        newlines.append('\n')
+def plan_link_apt(conf):
+    """
+    Return the changes making apt read the proxy settings from the file.
+    """
+    return _diff({aptconf: _remove_proxies(aptconf, confmodel.APT),
+                  aptfrag: _link(conf, aptfrag)})
 
-    # Write the new lines
-    with open(filename, 'w') as fil:
-        fil.write(''.join(newlines))
+
+def remove_lines(filename, *phrases):
+    """
+    Remove lines from the file containing any of the phrases.
+
+    The file is streamed into its replacement, memory use does not depend on
+    its size.
+    """
+    return commit(_diff({filename: _edit(filename, phrases)}))
 
 
 def remove_bash():
     """
     Remove proxy settings for bash.
     """
-    for filename in check_bash():
-        remove_lines(filename, '_proxy=', '_PROXY=')
+    return commit(plan_remove_bash())
+
+
+def plan_remove_bash():
+    """
+    Return the changes removing proxy settings for bash.
+    """
+    checkfiles = [bashprofile, bashlogin, userprofile, bashenv,
+                  bashbashrc, bashrc, profdproxy, profile]
+    desired = dict((f, _edit(f, _bash_phrases())) for f in checkfiles)
 
     # Remove the proxy file inside profile.d
-    if os.path.exists(profdproxy):
-        os.remove(profdproxy)
+    desired[profdproxy] = None
+    return _diff(desired)
+
+
+def remove_user_bash(home):
+    """
+    Remove proxy settings for bash from the files of the user with the home
+    directory.
+    """
+    return commit(plan_remove_user_bash(home))
+
+
+def plan_remove_user_bash(home):
+    """
+    Return the changes removing proxy settings for bash from the files of the
+    user with the home directory.
+    """
+    return _diff(dict((f, _edit(f, _bash_phrases()))
+                      for f in user_files(home)))
 
 
 def remove_environment():
     """
     Remove proxy settings for environment.
     """
-    for filename in check_environment():
-        remove_lines(filename, '_proxy=', '_PROXY=')
+    return commit(plan_remove_environment())
+
+
+def plan_remove_environment():
+    """
+    Return the changes removing proxy settings for environment.
+    """
+    return _diff({environment: _remove_proxies(environment,
+                                               confmodel.ENVIRONMENT)})
 
 
 def remove_apt():
     """
     Remove proxy settings for apt.
     """
-    for filename in check_apt():
-        remove_lines(aptconf, '::proxy')
+    return commit(plan_remove_apt())
+
 
+def plan_remove_apt():
+    """
+    Return the changes removing proxy settings for apt.
+    """
     # Remove the proxy file inside aptconf.d
-    if os.path.exists(aptfrag):
-        os.remove(aptfrag)
+    desired = {aptconf: _remove_proxies(aptconf, confmodel.APT),
+               aptfrag: None}
+    return _diff(desired)
 
 
 def remove_gsettings():
     """
     Remove proxy settings for GSettings.
     """
-    args = ['gsettings', 'reset-recursively', 'org.gnome.system.proxy']
-    subprocess.call(args)
+    if not _parse_keyfile(_dconf('dump', proxydir)):
+        return []
+    _dconf('reset', '-f', proxydir)
+    return [proxyschema]
 
 
 def remove_sudoers(filenames=None):
     """
     Remove proxy settings for sudo.
     """
-    for filename in check_sudoers():
-        remove_lines(sudoers, '_proxy', '_PROXY')
+    return commit(plan_remove_sudoers())
 
+
+def plan_remove_sudoers():
+    """
+    Return the changes removing proxy settings for sudo.
+    """
     # Remove the proxy file inside sudoers.d
-    if os.path.exists(sudodproxy):
-        os.remove(sudodproxy)
+    desired = {sudoers: _remove_proxies(sudoers, confmodel.SUDOERS),
+               sudodproxy: None}
+    return _diff(desired)
+
+
+def commit(changes):
+    """
+    Write the changes of a plan. Return the changed filenames.
+
+    A plan maps filenames to their new contents (a string or an Edit), a Link
+    or None, meaning the file is to be removed. Files are replaced
+    atomically, keeping their mode and ownership. Missing directories are
+    created. Edited files which are symbolic links are followed, files given
+    whole contents (our own) replace any link.
+    """
+    trans = _transaction or _new_transaction()
+    for filename in sorted(changes):
+        contents = changes[filename]
+        # Only used if the file is new, sudo rejects writable files
+        mode = 0o440 if filename in (sudoers, sudodproxy) else None
+        if contents is None:
+            trans.remove(filename)
+        elif isinstance(contents, Link):
+            trans.symlink(contents.target, filename)
+        elif isinstance(contents, Edit):
+            trans.write(filename, contents, mode=mode)
+        else:
+            trans.write(filename, contents, mode=mode, follow=False)
+    if trans is not _transaction:
+        trans.commit()
+    return sorted(changes)
+
+
+def proxy_lines(form, protos, hosts, ports, user=None, pwd=None,
+                noproxy=None, useauth=None):
+    """
+    Return the lines assigning the proxy variables, formatted with 'form'
+    from the variable name and its value.
+    """
+    lines = []
+    authform = '{}:{}@'.format(user, pwd) if (user and pwd) else ''
+    for proto, host, port in zip(protos, hosts, ports):
+        # Use authentication for specified protocols
+        auth = '' if useauth and proto not in useauth else authform
+        value = '{0}://{3}{1}:{2}/'.format(proto, host, port, auth)
+        # Make upper and lower cases spearately
+        lines.append(form.format('{}_proxy'.format(proto), value))
+        lines.append(form.format('{}_PROXY'.format(proto.upper()), value))
+    if noproxy:
+        noproxy = ','.join(noproxy)
+        lines.append(form.format('no_proxy', noproxy))
+        lines.append(form.format('NO_PROXY', noproxy))
+    return lines
+
+
+def _read(filename):
+    """
+    Return the contents of the file, or None if it does not exist.
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as fil:
+        return fil.read()
+
+
+def _diff(desired):
+    """
+    Return the desired contents which differ from the files.
+    """
+    return dict((f, c) for f, c in desired.items() if not _unchanged(f, c))
+
+
+def _unchanged(filename, contents):
+    if isinstance(contents, Edit):
+        return contents.unchanged()
+    if isinstance(contents, Link):
+        return (os.path.islink(filename) and
+                os.readlink(filename) == contents.target)
+    if contents is None:
+        return not os.path.lexists(filename)
+    # Our own files replace any link
+    return not os.path.islink(filename) and _read(filename) == contents
+
+
+def _link(target, filename):
+    """
+    Return the Link of the file to the target. Links are relative, so that
+    they hold within any root.
+    """
+    return Link(os.path.relpath(target, os.path.dirname(filename)))
+
+
+def _bash_phrases():
+    """
+    Return the phrases of the lines making up bash settings: the variables
+    and the sourcing of the current profile.
+    """
+    return ('_proxy=', '_PROXY=', unrooted(currentlink) + '/')
+
+
+def _edit(filename, phrases, exact=(), tail=None):
+    """
+    Return an Edit of the file locating lines through the scan index. The
+    entry of the file is dropped if its lines turn out to be stale.
+    """
+    return Edit(filename, phrases, exact, tail, lookup=_lookup,
+                stale=index.forget)
+
+
+def _model(filename, fmt):
+    """
+    Return the Items of the file in the format (see confmodel), none if it
+    does not exist.
+    """
+    return models.model(filename, fmt) or []
+
+
+def _proxy_items(filename, fmt):
+    return [i for i in _model(filename, fmt) if fmt.is_proxy(i)]
+
+
+def _model_edit(filename, fmt, items, tail=None):
+    """
+    Return an Edit of the file removing the proxy settings of the items.
+    """
+    return Edit(filename, tail=tail, lookup=_lookup,
+                replace=confmodel.removals(filename, fmt, items))
+
+
+def _remove_proxies(filename, fmt):
+    """
+    Return an Edit of the file removing all of its proxy settings.
+    """
+    return _model_edit(filename, fmt, _proxy_items(filename, fmt))
+
+
+def _lookup(filename, phrases):
+    return index.lookup(filename, phrases, scanner.scan)
@@ -0,0 +1,1017 @@
+#!/usr/bin/env python2.7
+
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Performance benchmarks.
+
+Each benchmark returns a dictionary of measurements (seconds unless the name
+says otherwise). Measurements that cannot be taken on this host (no wx, no
+display) are None and reported as skipped.
+
+Measurements listed in the budget file (benchmark_budget.json) must not
+exceed their budget. The exit status is 1 if any of them does.
+
+The results are printed to stdout as JSON, and saved to a file with --save.
+Timings depend on the host, so a baseline is saved on the host it is
+compared on, before a change, and the run after the change is compared with
+it. The measurements which grew by more than the tolerance (and by more than
+MIN_REGRESSION) are reported, and the exit status is 1 if there are any:
+
+    python benchmark.py targets --save baseline.json
+    python benchmark.py targets --baseline baseline.json
+
+    python benchmark.py [BENCHMARK ...] [--runs N] [--budget FILE]
+                        [--save FILE] [--baseline FILE]
+                        [--tolerance FRACTION]
+"""
+
+
+import argparse
+import json
+import os
+import Queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUDGET = os.path.join(HERE, 'benchmark_budget.json')
+
+# Growth of a measurement over its baseline below which it is noise
+DEFAULT_TOLERANCE = 0.5
+MIN_REGRESSION = 0.001
+
+# Prints the time at which the main frame has been shown
+FIRST_FRAME = '''
+import wx
+import grrproxy
+from mainframe import GrrFrame
+
+app = wx.App(False)
+frame = GrrFrame(parent=None, title='benchmark')
+frame.Show()
+
+def shown():
+    print(repr(__import__('time').time()))
+    app.ExitMainLoop()
+
+wx.CallAfter(shown)
+app.MainLoop()
+'''
+
+# Prints the time taken to remove the proxy lines of a file and the growth of
+# the anonymous memory (KiB) meanwhile. File pages mapped by the scanner are
+# not anonymous, so only the memory held by the process itself is counted.
+REMOVE_LINES = '''
+import sys
+import threading
+import time
+import backend
+import scanindex
+
+backend.index = scanindex.ScanIndex(None, backend.PHRASES)
+
+def anon():
+    with open('/proc/self/status') as fil:
+        for line in fil:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1])
+
+base = anon()
+peak = [base]
+done = threading.Event()
+
+def sample():
+    while not done.is_set():
+        peak[0] = max(peak[0], anon())
+        time.sleep(0.001)
+
+sampler = threading.Thread(target=sample)
+sampler.start()
+start = time.time()
+backend.remove_lines({filename!r}, '_proxy=', '_PROXY=')
+elapsed = time.time() - start
+done.set()
+sampler.join()
+print(repr(elapsed))
+print(peak[0] - base)
+'''
+
+
+# Runs fakedconf as dconf or gsettings (by the name of the script run), with
+# its database in the directory
+FAKEDCONF = '''#!/bin/sh
+FAKEDCONF_DB="{db}" exec "{python}" "{script}" "$@"
+'''
+
+def _python(code, env=None):
+    """
+    Run code in a fresh interpreter. Return its output, or None if it fails.
+    """
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=HERE, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = proc.communicate()[0]
+    return output if proc.returncode == 0 else None
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+def time_import(module, runs):
+    """
+    Return the median time taken to import the module in a new process.
+    """
+    code = ('import time\nstart = time.time()\nimport {}\n'
+            'print(repr(time.time() - start))'.format(module))
+    times = []
+    for _ in range(runs):
+        output = _python(code)
+        if output is None:
+            return None
+        times.append(float(output))
+    return _median(times)
+
+
+def time_first_frame(runs):
+    """
+    Return the median time from process start until the frame is shown.
+    """
+    if not os.getenv('DISPLAY'):
+        return None
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        output = _python(FIRST_FRAME)
+        if output is None:
+            return None
+        times.append(float(output.split()[-1]) - start)
+    return _median(times)
+
+
+def bench_startup(runs):
+    """
+    Import times of the entry points and time to first frame of the GUI.
+    """
+    return {'import_cli': time_import('cli', runs),
+            'import_grrproxy': time_import('grrproxy', runs),
+            'first_frame': time_first_frame(runs)}
+
+
+def make_rcfile(filename, size, proxylines=16):
+    """
+    Write an rc file of about 'size' bytes with the proxy lines spread evenly
+    across it.
+    """
+    block = ''.join('alias ll{0}="ls -l {0}"\n'.format(i) for i in range(64))
+    blocks = max(size // len(block), 1)
+    every = max(blocks // proxylines, 1)
+    with open(filename, 'wb') as fil:
+        for i in range(blocks):
+            fil.write(block)
+            if i % every == 0:
+                fil.write('export http_proxy="http://proxy:3128/"\n')
+
+
+def bench_remove(runs):
+    """
+    Time and anonymous memory growth of removing the proxy lines of large
+    files. The memory must not depend on the size of the file.
+    """
+    if not os.path.exists('/proc/self/status'):
+        return {'remove_4mb': None, 'remove_32mb': None, 'peak_anon_kb': None}
+    results = {}
+    peaks = []
+    tmpdir = tempfile.mkdtemp(prefix='grrproxy-bench-')
+    try:
+        for mb in (4, 32):
+            filename = os.path.join(tmpdir, 'bashrc')
+            times = []
+            for _ in range(runs):
+                make_rcfile(filename, mb << 20)
+                output = _python(REMOVE_LINES.format(filename=filename))
+                if output is None:
+                    return {'remove_4mb': None, 'remove_32mb': None,
+                            'peak_anon_kb': None}
+                elapsed, peak = output.split()
+                times.append(float(elapsed))
+                peaks.append(int(peak))
+            results['remove_{}mb'.format(mb)] = _median(times)
+    finally:
+        shutil.rmtree(tmpdir)
+    results['peak_anon_kb'] = max(peaks)
+    return results
+
+
+def bench_dispatch(runs, workers=8, calls=200):
+    """
+    Round-trip latency of calls to the GUI thread made by many workers at
+    once, with an event loop standing in for wx. 'posts_per_call' is the
+    number of event loop turns per call, below one when calls are batched.
+    """
+    from dispatcher import Dispatcher
+
+    loop = Queue.Queue()
+    posts = [0]
+    created = []
+
+    def post(func):
+        posts[0] += 1
+        loop.put(func)
+
+    def event_loop():
+        created.append(Dispatcher(post))
+        while True:
+            func = loop.get()
+            if func is None:
+                return
+            func()
+
+    thread = threading.Thread(target=event_loop)
+    thread.start()
+    while not created:
+        time.sleep(0.001)
+    dispatcher = created[0]
+
+    latencies = []
+
+    def work():
+        for _ in range(calls):
+            start = time.time()
+            dispatcher.call(time.time)
+            latencies.append(time.time() - start)
+
+    for _ in range(runs):
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+        for worker in threads:
+            worker.start()
+        for worker in threads:
+            worker.join()
+    loop.put(None)
+    thread.join()
+
+    latencies.sort()
+    return {'roundtrip_median': _median(latencies),
+            'roundtrip_p95': latencies[int(len(latencies) * 0.95)],
+            'posts_per_call': float(posts[0]) / len(latencies)}
+
+
+def make_noproxy(domains=5000, networks=2000, seed=0):
+    """
+    Return a large ignore list of internal domains, IPv4 and IPv6 networks
+    and some patterns, along with hosts of which about half bypass it.
+    """
+    import random
+    rand = random.Random(seed)
+    entries, hosts = [], []
+    for i in range(domains):
+        domain = 'svc{}.dept{}.corp{}.example'.format(i, i % 97, i % 7)
+        entries.append(('.' if i % 3 else '') + domain)
+        hosts.append('api.{}'.format(domain) if i % 3 else domain)
+        hosts.append('svc{}.other{}.example'.format(i, i % 13))
+    for i in range(networks):
+        if i % 4:
+            net = (10 << 24) | (rand.getrandbits(16) << 8)
+            entries.append('{}.{}.{}.0/24'.format(
+                net >> 24, (net >> 16) & 255, (net >> 8) & 255))
+            hosts.append('{}.{}.{}.{}'.format(
+                net >> 24, (net >> 16) & 255, (net >> 8) & 255, i & 255))
+        else:
+            entries.append('fd00:{:x}::/32'.format(i))
+            hosts.append('fd00:{:x}::1'.format(i))
+        hosts.append('172.{}.{}.{}'.format(16 + i % 16, i & 255, i % 7))
+    entries.extend(['*.build*.example', 'ci-?.example', '192.168.*'])
+    rand.shuffle(hosts)
+    return entries, hosts
+
+
+def _linear_bypass(entries, host):
+    """
+    Scan the parsed entries one by one, as a flat list is checked.
+    """
+    import fnmatch
+    import noproxy
+    address = noproxy.address_value(host)
+    for kind, value in entries:
+        if kind == noproxy.ALL:
+            return True
+        elif kind == noproxy.NETWORK:
+            if address is not None and address[0] == value[0]:
+                shift = noproxy.BITS[value[0]] - value[2]
+                if address[1] >> shift == value[1] >> shift:
+                    return True
+        elif address is not None:
+            continue
+        elif kind == noproxy.DOMAIN:
+            if host == value or host.endswith('.' + value):
+                return True
+        elif kind == noproxy.SUBDOMAINS:
+            if host.endswith('.' + value):
+                return True
+        elif fnmatch.fnmatchcase(host, value):
+            return True
+    return False
+
+
+def bench_noproxy(runs, linear_hosts=500, working_set=1000):
+    """
+    Time per lookup of a host in a large ignore list, compiled (see
+    noproxy.Matcher) and scanned linearly, and the time to compile the list.
+    'lookup' is the time for a host not looked up before, 'lookup_cached'
+    for a working set of hosts looked up again and again. 'compact' is the
+    time to compact the list (see noproxy.compact).
+    """
+    import noproxy
+
+    entries, hosts = make_noproxy()
+    compiles, compacts = [], []
+    for _ in range(runs):
+        start = time.time()
+        matcher = noproxy.Matcher(entries)
+        compiles.append(time.time() - start)
+        start = time.time()
+        noproxy.compact(entries)
+        compacts.append(time.time() - start)
+
+    parsed = [noproxy.parse(e) for e in entries]
+    sample = hosts[:linear_hosts]
+    if ([matcher.bypass(h) for h in sample] !=
+            [_linear_bypass(parsed, h) for h in sample]):
+        raise AssertionError('the matcher and the linear scan disagree')
+
+    lookups, cached, linear = [], [], []
+    bypass = matcher.bypass
+    repeated = hosts[:working_set] * 10
+    for _ in range(runs):
+        matcher.cache.clear()
+        start = time.time()
+        for host in hosts:
+            bypass(host)
+        lookups.append((time.time() - start) / len(hosts))
+        start = time.time()
+        for host in repeated:
+            bypass(host)
+        cached.append((time.time() - start) / len(repeated))
+        start = time.time()
+        for host in sample:
+            _linear_bypass(parsed, host)
+        linear.append((time.time() - start) / len(sample))
+    return {'compile': _median(compiles), 'compact': _median(compacts),
+            'lookup': _median(lookups), 'lookup_cached': _median(cached),
+            'linear_lookup': _median(linear)}
+
+
+class FakeProxy(object):
+    """
+    A proxy on the local host answering every request with a short response
+    over keep-alive connections, which can be stopped and started again on
+    the same port.
+    """
+
+    RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+
+    def __init__(self):
+        self.port = 0
+        self.sock = None
+        self.clients = []
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        import socket
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', self.port))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self._accept, args=(self.sock,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Close the listening socket and every connection, as a crash would.
+        """
+        import socket
+        self.sock.close()
+        with self.lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            client.close()
+
+    def _accept(self, sock):
+        import socket
+        while True:
+            try:
+                client, _ = sock.accept()
+            except socket.error:
+                return
+            with self.lock:
+                self.clients.append(client)
+            thread = threading.Thread(target=self._serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, client):
+        import socket
+        buf = b''
+        try:
+            while True:
+                while b'\r\n\r\n' not in buf:
+                    data = client.recv(65536)
+                    if not data:
+                        return
+                    buf += data
+                buf = buf.partition(b'\r\n\r\n')[2]
+                client.sendall(self.RESPONSE)
+        except socket.error:
+            pass
+        finally:
+            client.close()
+
+
+def bench_failover(runs, proxies=3, clients=8, phase=1.0):
+    """
+    Throughput of requests through the relay (see relay) balancing over
+    several proxies, one of which fails for a while. 'throughput_drop' is
+    the fraction of the throughput lost meanwhile, 'failed_requests' the
+    requests which were not answered and 'recovery' the time until the
+    proxy takes requests again once it is back.
+    """
+    import httplib
+    import relay
+
+    fakes = [FakeProxy() for _ in range(proxies)]
+    balancer = relay.Balancer([relay.Upstream('127.0.0.1', f.port)
+                               for f in fakes])
+    server = relay.Relay({'http': balancer}, ('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    done = [0]
+    failed = [0]
+    stopped = threading.Event()
+
+    def client():
+        conn = httplib.HTTPConnection(*server.address)
+        while not stopped.is_set():
+            try:
+                conn.request('GET', 'http://example.com/')
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise IOError(response.status)
+                done[0] += 1
+            except (IOError, httplib.HTTPException):
+                failed[0] += 1
+                conn.close()
+                conn = httplib.HTTPConnection(*server.address)
+        conn.close()
+
+    def throughput():
+        before = done[0]
+        time.sleep(phase)
+        return (done[0] - before) / phase
+
+    workers = [threading.Thread(target=client) for _ in range(clients)]
+    for worker in workers:
+        worker.start()
+    drops, recoveries = [], []
+    try:
+        for _ in range(runs):
+            healthy = throughput()
+            fakes[0].stop()
+            degraded = throughput()
+            fakes[0].start()
+            start = time.time()
+            upstream = balancer.upstreams[0]
+            while upstream.ejected and time.time() - start < 60:
+                time.sleep(0.01)
+            recoveries.append(time.time() - start)
+            drops.append(max(0.0, 1 - degraded / healthy))
+    finally:
+        stopped.set()
+        for worker in workers:
+            worker.join()
+        server.stop()
+        thread.join()
+        for fake in fakes:
+            fake.stop()
+    return {'throughput_drop': _median(drops),
+            'failed_requests': float(failed[0]),
+            'recovery': _median(recoveries)}
+
+
+def make_configs(dirname, size):
+    """
+    Write environment, apt and sudoers files of about 'size' bytes each, with
+    a few proxy settings among many other statements and comments. Return
+    their filenames by format.
+    """
+    env = ''.join('VAR{0}="value {0}"\n# http_proxy=commented{0}\n'.format(i)
+                  for i in range(256))
+    apt = ''.join('APT::Option{0} "{0}";\nAcquire {{\n  Retries "{0}";\n'
+                  '  /* ftp::Proxy "x"; */\n}};\n'.format(i)
+                  for i in range(256))
+    sudo = ''.join('Defaults:user{0} env_keep += "LANG LC_{0}"\n'
+                   'user{0} ALL=(ALL) ALL\n'.format(i) for i in range(256))
+    blocks = {'environment': (env, 'http_proxy="http://proxy:3128/"\n'),
+              'apt': (apt, 'Acquire::http::Proxy "http://proxy:3128/";\n'),
+              'sudoers': (sudo, 'Defaults env_keep += "http_proxy"\n')}
+    filenames = {}
+    for name, (block, proxy) in blocks.items():
+        filenames[name] = os.path.join(dirname, name)
+        with open(filenames[name], 'wb') as fil:
+            for i in range(max(size // len(block), 1)):
+                fil.write(block)
+                if i % 64 == 0:
+                    fil.write(proxy)
+    return filenames
+
+
+# Lines the models are fuzzed with, by format: settings, comments, blocks
+FUZZ_LINES = {
+    'environment': [b'VAR{}="value"\n', b'#http_proxy=http://p{}/\n',
+                    b'http_proxy=http://p{}/\n', b'not an assignment {}\n'],
+    'apt': [b'Acquire::http::Proxy "http://p{}/";\n', b'#Acquire{} {{\n',
+            b'Acquire{} {{\n', b'}};\n', b'/* {}\n', b'*/\n',
+            b'http::Proxy "http://q{}/"; Retries "1";\n', b'// {}\n'],
+    'sudoers': [b'Defaults env_keep += "http_proxy V{}"\n',
+                b'Defaults env_keep += "A \\\n B{}"\n',
+                b'root ALL=(ALL) ALL # {}\n', b'#includedir /x{}\n'],
+}
+
+
+def fuzz_models(steps, size=128 << 10, seed=0):
+    """
+    Return the number of random edits after which the model of a file
+    updated incrementally differs from the model parsed afresh. Edits
+    insert, delete and replace lines, and comment lines in and out (which
+    keeps the offsets, and may open or close apt blocks).
+    """
+    import random
+    import confmodel
+
+    rand = random.Random(seed)
+
+    def lines(fmt, count):
+        return b''.join(rand.choice(FUZZ_LINES[fmt]).replace(
+            b'{}', str(rand.randint(0, 99)).encode('ascii')).replace(
+            b'{{', b'{').replace(b'}}', b'}') for _ in range(count))
+
+    tmpdir = tempfile.mkdtemp(prefix='grrproxy-bench-')
+    mismatches = 0
+    try:
+        for fmt in (confmodel.ENVIRONMENT, confmodel.APT, confmodel.SUDOERS):
+            filename = os.path.join(tmpdir, fmt.name)
+            data = lines(fmt.name, size // 24)
+            cache = confmodel.ModelCache()
+            for _ in range(steps):
+                start = rand.randint(0, len(data))
+                end = min(len(data), start + rand.randint(0, 256))
+                edit = rand.choice(('insert', 'delete', 'replace', 'toggle',
+                                    'append'))
+                if edit == 'insert':
+                    data = data[:start] + lines(fmt.name, 3) + data[start:]
+                elif edit == 'delete':
+                    data = data[:start] + data[end:]
+                elif edit == 'replace':
+                    data = data[:start] + lines(fmt.name, 2) + data[end:]
+                elif edit == 'append':
+                    data += lines(fmt.name, 3)
+                else:
+                    pos = data.find(b'\n', start)
+                    if 0 <= pos < len(data) - 1:
+                        first = data[pos + 1:pos + 2]
+                        first = b' ' if first == b'#' else b'#'
+                        data = data[:pos + 1] + first + data[pos + 2:]
+                with open(filename + '.tmp', 'wb') as fil:
+                    fil.write(data)
+                os.rename(filename + '.tmp', filename)
+                if (cache.model(filename, fmt) !=
+                        confmodel.ModelCache().model(filename, fmt)):
+                    mismatches += 1
+    finally:
+        shutil.rmtree(tmpdir)
+    return mismatches
+
+
+def bench_models(runs, size=4 << 20):
+    """
+    Time of parsing 4MB environment, apt and sudoers files into their models
+    (see confmodel): in full, again after a line in the middle was changed
+    and a line appended (as apply does), and when they are unchanged. Then
+    the number of incremental models differing from a fresh parse after
+    random edits (see fuzz_models), which must be 0.
+    """
+    import confmodel
+
+    formats = {'environment': confmodel.ENVIRONMENT, 'apt': confmodel.APT,
+               'sudoers': confmodel.SUDOERS}
+    tmpdir = tempfile.mkdtemp(prefix='grrproxy-bench-')
+    times = dict((key, []) for key in formats)
+    try:
+        filenames = make_configs(tmpdir, size)
+        for _ in range(runs):
+            for name, fmt in formats.items():
+                filename = filenames[name]
+                cache = confmodel.ModelCache()
+                start = time.time()
+                cache.model(filename, fmt)
+                full = time.time() - start
+
+                with open(filename, 'rb') as fil:
+                    contents = fil.read()
+                middle = contents.index(b'\n', len(contents) // 2) + 1
+                changed = (contents[:middle] + b'# changed\n' +
+                           contents[middle:] + b'\n')
+                with open(filename + '.tmp', 'wb') as fil:
+                    fil.write(changed)
+                os.rename(filename + '.tmp', filename)
+                start = time.time()
+                cache.model(filename, fmt)
+                reparse = time.time() - start
+
+                start = time.time()
+                cache.model(filename, fmt)
+                cached = time.time() - start
+                times[name].append((full, reparse, cached))
+    finally:
+        shutil.rmtree(tmpdir)
+    results = {}
+    for name, values in times.items():
+        full, reparse, cached = zip(*values)
+        results['parse_' + name] = _median(full)
+        results['reparse_' + name] = _median(reparse)
+        results['cached_' + name] = _median(cached)
+    results['mismatches'] = float(fuzz_models(40))
+    return results
+
+
+def bench_snapshot(runs, files=32, size=1 << 20):
+    """
+    Time added by the snapshot of the files replaced by a transaction, and
+    time of the rollback. The files are replaced by an atomic write either
+    way.
+    """
+    import atomic
+    import snapshot
+
+    def replace(journal):
+        trans = atomic.Transaction(journal)
+        for filename in filenames:
+            trans.write(filename, b'export http_proxy="http://proxy:3128/"\n')
+        trans.commit()
+        return trans
+
+    tmpdir = tempfile.mkdtemp(prefix='grrproxy-bench-')
+    filenames = [os.path.join(tmpdir, 'rc{}'.format(i)) for i in range(files)]
+    store = os.path.join(tmpdir, 'snapshots')
+    overheads = []
+    rollbacks = []
+    try:
+        for _ in range(runs):
+            for filename in filenames:
+                make_rcfile(filename, size)
+            start = time.time()
+            replace(None)
+            plain = time.time() - start
+
+            for filename in filenames:
+                make_rcfile(filename, size)
+            start = time.time()
+            txnid = replace(snapshot.Journal(store)).journal.last
+            overheads.append(time.time() - start - plain)
+
+            start = time.time()
+            trans = atomic.Transaction()
+            snapshot.rollback(store, txnid, trans)
+            trans.commit()
+            rollbacks.append(time.time() - start)
+            snapshot.gc(store, keep=0)
+    finally:
+        shutil.rmtree(tmpdir)
+    return {'overhead_{}mb'.format(files * size >> 20): _median(overheads),
+            'rollback_{}mb'.format(files * size >> 20): _median(rollbacks)}
+
+
+def make_root(dirname, users=64, rcsize=8 << 20, usersize=256 << 10,
+              confsize=1 << 20):
+    """
+    Build a synthetic root file system tree in the directory: the system
+    files of every target, an 'admin' user (the user of the backend) with an
+    rc file of 'rcsize' bytes and 'users' more users with rc files of
+    'usersize' bytes, all with proxy settings spread across them, and a
+    fake dconf (see make_fakedconf). Return the home directories of the
+    users and the fake dconf.
+    """
+    for subdir in ('etc/apt/apt.conf.d', 'etc/sudoers.d', 'etc/profile.d',
+                   'home/admin'):
+        os.makedirs(os.path.join(dirname, subdir))
+    make_rcfile(os.path.join(dirname, 'home/admin/.bashrc'), rcsize)
+    make_rcfile(os.path.join(dirname, 'home/admin/.profile'), rcsize // 8)
+    make_rcfile(os.path.join(dirname, 'etc/bash.bashrc'), rcsize // 4)
+    make_rcfile(os.path.join(dirname, 'etc/profile'), rcsize // 8)
+    configs = make_configs(dirname, confsize)
+    for name, path in (('environment', 'etc/environment'),
+                       ('apt', 'etc/apt/apt.conf'),
+                       ('sudoers', 'etc/sudoers')):
+        os.rename(configs[name], os.path.join(dirname, path))
+    homes = []
+    for i in range(users):
+        home = os.path.join(dirname, 'home', 'user{}'.format(i))
+        os.mkdir(home)
+        make_rcfile(os.path.join(home, '.bashrc'), usersize, proxylines=2)
+        homes.append(home)
+    return homes, make_fakedconf(dirname)[0]
+
+
+def make_fakedconf(dirname):
+    """
+    Write dconf and gsettings commands to the directory running fakedconf,
+    with its database in the directory. Return their filenames.
+    """
+    # fakedconf acts as gsettings when run under that name
+    script = os.path.join(dirname, 'gsettings.py')
+    os.symlink(os.path.join(HERE, 'fakedconf.py'), script)
+    commands = []
+    for name, run in (('dconf', os.path.join(HERE, 'fakedconf.py')),
+                      ('gsettings', script)):
+        filename = os.path.join(dirname, name)
+        with open(filename, 'w') as fil:
+            fil.write(FAKEDCONF.format(db=os.path.join(dirname, 'dconf.json'),
+                                       python=sys.executable, script=run))
+        os.chmod(filename, 0o755)
+        commands.append(filename)
+    return commands
+
+
+def bench_gsettings(runs):
+    """
+    Time of the set, check and remove functions of GSettings, offline,
+    against fakedconf (see make_fakedconf). 'mismatches' counts the results
+    which differ from those expected, along the way: keys changed, then
+    none when set again, keys of a protocol left out reset, the values
+    found by check and the ignore list read back. It must be 0.
+    """
+    import backend
+
+    schema = backend.proxyschema
+    mismatches = [0]
+
+    def expect(value, expected):
+        if value != expected:
+            mismatches[0] += 1
+            sys.stderr.write('gsettings: {!r} != {!r}\n'.format(value,
+                                                                 expected))
+
+    def timed(times, func, *args, **kwargs):
+        start = time.time()
+        result = func(*args, **kwargs)
+        times.append(time.time() - start)
+        return result
+
+    both = (['http', 'https'], ['proxy.example.com'] * 2, ['3128', '3129'])
+    noproxy = ['localhost', '.example.com']
+    saved = backend.dconf, backend.gsettings
+    tmpdir = tempfile.mkdtemp(prefix='grrproxy-bench-')
+    sets, checks, removes = [], [], []
+    try:
+        backend.dconf, backend.gsettings = make_fakedconf(tmpdir)
+        expect(backend.get_noproxy(), ['localhost', '127.0.0.0/8', '::1'])
+        for _ in range(runs):
+            expect(timed(sets, backend.set_gsettings, *both, user='u',
+                         pwd='p', noproxy=noproxy),
+                   ['{} ignore-hosts'.format(schema),
+                    '{} mode'.format(schema)] +
+                   ['{}.http {}'.format(schema, k) for k in (
+                       'authentication-password', 'authentication-user',
+                       'host', 'port', 'use-authentication')] +
+                   ['{}.https {}'.format(schema, k) for k in ('host',
+                                                               'port')])
+            expect(backend.set_gsettings(*both, user='u', pwd='p',
+                                         noproxy=noproxy), [])
+            expect(timed(checks, backend.check_gsettings),
+                   ["{} ignore-hosts ['localhost', '.example.com']"
+                    .format(schema),
+                    "{}.http authentication-password 'p'".format(schema),
+                    "{}.http authentication-user 'u'".format(schema),
+                    "{}.http host 'proxy.example.com'".format(schema),
+                    '{}.http port 3128'.format(schema),
+                    "{}.https host 'proxy.example.com'".format(schema),
+                    '{}.https port 3129'.format(schema)])
+            expect(backend.get_noproxy(), noproxy)
+            # The keys left out go back to their defaults in the same load
+            other = (['http'], ['other.example.com'], ['8081'])
+            expect(backend.set_gsettings(*other),
+                   ['{} ignore-hosts'.format(schema)] +
+                   ['{}.http {}'.format(schema, k) for k in (
+                       'authentication-password', 'authentication-user',
+                       'host', 'port', 'use-authentication')] +
+                   ['{}.https {}'.format(schema, k) for k in ('host',
+                                                               'port')])
+            expect(backend.set_gsettings(*other), [])
+            expect(backend.check_gsettings(),
+                   ["{}.http host 'other.example.com'".format(schema),
+                    '{}.http port 8081'.format(schema)])
+            expect(backend.get_noproxy(), ['localhost', '127.0.0.0/8',
+                                           '::1'])
+            expect(timed(removes, backend.remove_gsettings), [schema])
+            expect(backend.check_gsettings(), [])
+            expect(backend.remove_gsettings(), [])
+    finally:
+        backend.dconf, backend.gsettings = saved
+        shutil.rmtree(tmpdir)
+    return {'set': _median(sets), 'check': _median(checks),
+            'remove': _median(removes), 'mismatches': float(mismatches[0])}
+
+
+def bench_targets(runs, users=64):
+    """
+    Time of the check, set and remove functions of each target (and of the
+    users' bash files) on a synthetic root (see make_root), with an ignore
+    list of thousands of entries. The checks start without a scan index or
+    models, as on a first run. 'cycle' is a full apply and remove of every
+    target and user, as the command line does them.
+    """
+    import backend
+    import cli
+    import confmodel
+    import executor
+    import noproxy
+    import scanindex
+    import users as users_
+
+    settings = {'protos': ['http', 'https', 'ftp'],
+                'hosts': ['proxy.example.com'] * 3,
+                'ports': ['3128'] * 3, 'user': None, 'pwd': None,
+                'noproxy': noproxy.compact(make_noproxy()[0]),
+                'useauth': None}
+    funcs = cli.set_funcs(settings)
+    saved = backend.index, backend.models, backend.dconf
+    times = {}
+    tmpdir = tempfile.mkdtemp(prefix='grrproxy-bench-')
+
+    def timed(name, func, *args):
+        start = time.time()
+        func(*args)
+        times.setdefault(name, []).append(time.time() - start)
+
+    try:
+        for run in range(runs):
+            root = os.path.join(tmpdir, 'root{}'.format(run))
+            homes, backend.dconf = make_root(root, users)
+            userlist = users_.home_users(homes)
+            backend.set_root(root, homedir='/home/admin')
+            backend.index = scanindex.ScanIndex(None, backend.PHRASES)
+            backend.models = confmodel.ModelCache()
+            for target in executor.TARGETS:
+                timed('check_' + target, getattr(backend, 'check_' + target))
+            for target in executor.TARGETS:
+                timed('set_' + target, funcs[target])
+            for target in executor.TARGETS:
+                timed('remove_' + target,
+                      getattr(backend, 'remove_' + target))
+            timed('check_users', users_.check, userlist)
+            timed('set_users', users_.apply, userlist, settings)
+            timed('remove_users', users_.remove, userlist)
+
+            start = time.time()
+            with backend.transaction():
+                executor.run(funcs, 'Setting')
+                users_.apply(userlist, settings)
+            with backend.transaction():
+                executor.run(cli.backend_funcs('remove_', executor.TARGETS),
+                             'Removing')
+                users_.remove(userlist)
+            times.setdefault('cycle', []).append(time.time() - start)
+            shutil.rmtree(root)
+    finally:
+        backend.set_root('/')
+        backend.index, backend.models, backend.dconf = saved
+        shutil.rmtree(tmpdir)
+    return dict((name, _median(values)) for name, values in times.items())
+
+
+BENCHMARKS = {'startup': bench_startup, 'remove': bench_remove,
+              'dispatch': bench_dispatch, 'noproxy': bench_noproxy,
+              'failover': bench_failover, 'snapshot': bench_snapshot,
+              'models': bench_models, 'targets': bench_targets,
+              'gsettings': bench_gsettings}
+
+
+def check_budget(results, budget):
+    """
+    Return the (name, value, limit) of the measurements over budget.
+    """
+    over = []
+    for bench in sorted(results):
+        for name, value in sorted(results[bench].items()):
+            limit = budget.get(bench, {}).get(name)
+            if value is not None and limit is not None and value > limit:
+                over.append(('{}.{}'.format(bench, name), value, limit))
+    return over
+
+
+def compare_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Return the (name, value, base) of the measurements which grew by more
+    than the tolerance (a fraction of the baseline) and by more than
+    MIN_REGRESSION. Measurements missing from either side are left out.
+    """
+    slower = []
+    for bench in sorted(results):
+        for name, value in sorted(results[bench].items()):
+            base = (baseline.get(bench) or {}).get(name)
+            if (value is not None and base is not None and
+                    value > base * (1 + tolerance) and
+                    value - base > MIN_REGRESSION):
+                slower.append(('{}.{}'.format(bench, name), value, base))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the benchmarks.')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run: {} (default: all)'
+                             .format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--runs', type=int, default=5,
+                        help='repetitions of each measurement')
+    parser.add_argument('--budget', default=BUDGET,
+                        help='budget file (default: benchmark_budget.json)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='also write the results to the file')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        metavar='FRACTION',
+                        help='growth over the baseline allowed (default: '
+                             '{})'.format(DEFAULT_TOLERANCE))
+    args = parser.parse_args(argv)
+    names = args.benchmarks or sorted(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {}'
+                     .format(', '.join(sorted(unknown))))
+
+    results = {}
+    for name in names:
+        results[name] = BENCHMARKS[name](args.runs)
+        for key, value in sorted(results[name].items()):
+            sys.stderr.write('{}.{}: {}\n'.format(
+                name, key, 'skipped' if value is None else
+                '{:.6g}'.format(value)))
+
+    with open(args.budget, 'r') as fil:
+        budget = json.load(fil)
+    over = check_budget(results, budget)
+    for name, value, limit in over:
+        sys.stderr.write('OVER BUDGET {}: {:.6g} > {}\n'
+                         .format(name, value, limit))
+    slower = []
+    if args.baseline:
+        with open(args.baseline, 'r') as fil:
+            baseline = json.load(fil)
+        slower = compare_baseline(results, baseline, args.tolerance)
+        for name, value, base in slower:
+            growth = ' (+{:.0%})'.format(value / base - 1) if base else ''
+            sys.stderr.write('SLOWER THAN BASELINE {}: {:.6g} > {:.6g}{}\n'
+                             .format(name, value, base, growth))
+    json.dump(results, sys.stdout, indent=1, sort_keys=True)
+    sys.stdout.write('\n')
+    if args.save:
+        with open(args.save, 'w') as fil:
+            json.dump(results, fil, indent=1, sort_keys=True)
+            fil.write('\n')
+    return 1 if over or slower else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
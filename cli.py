@@ -0,0 +1,771 @@
+#!/usr/bin/env python2.7
+
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Headless command line interface.
+
+Drives the backend directly, for use from provisioning scripts and boot
+hooks. This module must never import wx (or any of the GUI modules), so that
+it starts quickly on hosts without a display.
+
+Commands:
+    apply   Apply proxy settings, replacing any existing ones. Only the files
+            whose contents change are written.
+    remove  Remove proxy settings.
+    check   Report where proxy settings are found.
+    status  Report whether proxy settings are present.
+    env     Report the proxy variables login, interactive and non-interactive
+            bash shells end up with, and the file and line setting each (see
+            shellenv). The files are read, no shell is run.
+    profile Save, use, delete or list named profiles (see profiles). Using a
+            profile switches a link rather than rewriting the files.
+    watch   Keep running and switch profiles as the network changes, by
+            rules (see netwatch).
+    drift   Keep running and report changes of the proxy settings made to
+            the files behind our back, as they happen, one JSON object per
+            line (see driftwatch). With --reapply, the profile in use is
+            applied again to the files which drifted.
+    relay   Run the local forwarding proxy configured by apply --relay (see
+            relay), until interrupted.
+    snapshot
+            List the snapshots taken before each change, roll the files
+            back to one of them, or remove the old ones (see snapshot).
+
+The result is printed to stdout as JSON. Settings for apply are given as
+options, or as a JSON object (--json FILE, '-' for stdin) of the form:
+    {"proxies": {"http": "host:port", ...}, "user": "...", "password": "...",
+     "useauth": ["http", ...], "noproxy": ["localhost", ...]}
+Options override the JSON values.
+
+With --root, the settings are applied to the directory tree given (a chroot
+or the root file system of a container) instead of '/'. With --roots (or
+--roots-file), the command is run on many trees by a pool of processes and
+reported per root, along with the throughput. GSettings are left out in both
+cases.
+
+With --all-users (every user of the password database who can log in) or
+--homes, the bash settings of these users are also checked, applied or
+removed, and reported per user under "users".
+"""
+
+
+import argparse
+import json
+import logging
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import backend
+import confmodel
+import executor
+import users
+from noproxy import compact
+
+
+PROTOS = ('http', 'https', 'ftp', 'socks')
+
+# The defaults of relay, probe and shellenv, which are only imported by the
+# commands using them
+RELAY_ADDRESS = ('127.0.0.1', 3129)
+PROBE_TIMEOUT = 2.0
+SHELLS = ('login', 'interactive', 'noninteractive')
+
+# Exit codes
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_ABSENT = 3
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='grrproxy',
+                                     description='Manage proxy settings '
+                                                 'without the GUI.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log progress to stderr')
+    parser.add_argument('--targets', type=_csv, default=executor.TARGETS,
+                        help='comma separated targets (default: all)')
+    parser.add_argument('--all-users', action='store_true',
+                        help='cover the bash files of every user')
+    parser.add_argument('--homes', type=_csv, metavar='DIRS',
+                        help='cover the bash files of the users with these '
+                             'comma separated home directories')
+    parser.add_argument('--root', metavar='DIR',
+                        help='apply to the directory tree instead of /')
+    parser.add_argument('--roots', type=_csv, metavar='DIRS', default=[],
+                        help='comma separated directory trees to process '
+                             'in parallel')
+    parser.add_argument('--roots-file', metavar='FILE',
+                        help='file listing directory trees, one per line')
+    parser.add_argument('--processes', type=int, metavar='N',
+                        help='processes for --roots (default: one per CPU)')
+    commands = parser.add_subparsers(dest='command')
+
+    apply_ = commands.add_parser('apply', help='apply proxy settings')
+    _add_settings(apply_)
+    apply_.add_argument('--keep', action='store_true',
+                        help='fail instead of overwriting existing settings')
+    apply_.add_argument('--relay', nargs='?', type=_address,
+                        const=RELAY_ADDRESS, metavar='HOST:PORT',
+                        help='point the targets at the local relay, which '
+                             'forwards to the proxies (default: {}:{})'
+                             .format(*RELAY_ADDRESS))
+
+    commands.add_parser('remove', help='remove proxy settings')
+    commands.add_parser('check', help='report where settings are found')
+    commands.add_parser('status', help='report whether settings are present')
+    env = commands.add_parser('env', help='report the proxy variables of '
+                                          'bash shells')
+    env.add_argument('--shells', type=_csv, default=SHELLS,
+                     help='comma separated shells among {} (default: all)'
+                          .format(', '.join(SHELLS)))
+
+    profile = commands.add_parser('profile', help='manage named profiles')
+    actions = profile.add_subparsers(dest='action')
+    save = actions.add_parser('save', help='save settings as a profile')
+    save.add_argument('name')
+    _add_settings(save)
+    use = actions.add_parser('use', help='switch to a profile')
+    use.add_argument('name')
+    delete = actions.add_parser('delete', help='delete a profile')
+    delete.add_argument('name')
+    actions.add_parser('list', help='list the profiles')
+
+    watch = commands.add_parser('watch', help='switch profiles as the '
+                                              'network changes')
+    watch.add_argument('--rules', metavar='FILE', required=True,
+                       help='JSON rules picking the profiles')
+    watch.add_argument('--facts', metavar='FILE',
+                       help='read the network facts from a JSON file '
+                            'rather than the system (for tests)')
+    watch.add_argument('--debounce', type=float, metavar='SECONDS',
+                       default=2.0, help='time without changes before the '
+                                         'network is checked (default: 2)')
+    watch.add_argument('--once', action='store_true',
+                       help='check the network once and exit')
+
+    drift = commands.add_parser('drift', help='report changes of the proxy '
+                                              'settings of the files')
+    drift.add_argument('--reapply', action='store_true',
+                       help='apply the profile in use again on changes')
+    drift.add_argument('--poll', type=float, metavar='SECONDS',
+                       help='check the files at this interval rather than '
+                            'through inotify (for tests)')
+    drift.add_argument('--debounce', type=float, metavar='SECONDS',
+                       default=0.5, help='time without changes before the '
+                                         'files are checked (default: 0.5)')
+
+    snapshot = commands.add_parser('snapshot', help='list, roll back or '
+                                                    'remove snapshots')
+    actions = snapshot.add_subparsers(dest='action')
+    actions.add_parser('list', help='list the snapshots, oldest first')
+    rollback = actions.add_parser('rollback', help='restore the files '
+                                                   'changed to their state '
+                                                   'before the transaction')
+    rollback.add_argument('id', help='id of the transaction')
+    gc = actions.add_parser('gc', help='remove old snapshots')
+    gc.add_argument('--keep', type=int, metavar='N', default=100,
+                    help='snapshots kept at least (default: 100)')
+    gc.add_argument('--days', type=float, metavar='DAYS',
+                    help='also remove the snapshots older than this')
+
+    relay_ = commands.add_parser('relay', help='run the local forwarding '
+                                               'proxy')
+    relay_.add_argument('--listen', type=_address, metavar='HOST:PORT',
+                        help='address to listen on (default: the one given '
+                             'to apply --relay)')
+    return parser
+
+
+def _add_settings(parser):
+    """
+    Add the options giving proxy settings (see load_settings).
+    """
+    parser.add_argument('--json', metavar='FILE',
+                        help='read settings from a JSON file (- for stdin)')
+    for proto in PROTOS:
+        parser.add_argument('--{}'.format(proto), metavar='HOST[:PORT],...',
+                            help='{} proxy, or comma separated candidates of '
+                                 'which the fastest is used (all of them by '
+                                 'weight, HOST:PORT=WEIGHT, with --relay)'
+                                 .format(proto))
+    parser.add_argument('--probe', action='store_true',
+                        help='probe the proxies first, fail if one cannot be '
+                             'reached')
+    parser.add_argument('--probe-timeout', type=float, metavar='SECONDS',
+                        default=PROBE_TIMEOUT,
+                        help='time limit of the probes (default: 2)')
+    parser.add_argument('--user', help='user name for authentication')
+    parser.add_argument('--password', help='password for authentication')
+    parser.add_argument('--useauth', type=_csv, metavar='PROTOS',
+                        help='comma separated protocols using authentication')
+    parser.add_argument('--noproxy', type=_csv, metavar='HOSTS',
+                        help='comma separated hosts to ignore')
+
+
+def _address(value):
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError('invalid address: {}'.format(value))
+    return host, int(port)
+
+
+def _csv(value):
+    return [v for v in value.split(',') if v]
+
+
+def load_settings(args):
+    """
+    Return the apply settings as keyword arguments for the set functions,
+    and a report of how they were made: the results of the probes of the
+    proxies (see probe.choose), the size of the compacted noproxy list and,
+    for the relay, the upstreams of the protocols given several proxies.
+
+    A protocol may be given several candidate proxies, the fastest reachable
+    is then used. The proxies are only probed if so or if asked to. With
+    --relay, the relay balances the requests over all of them instead, by
+    their weights (HOST:PORT=WEIGHT).
+
+    Raises ValueError if the settings are invalid and probe.UnreachableError
+    if a protocol has no reachable proxy.
+    """
+    import probe
+    data = {}
+    if args.json:
+        if args.json == '-':
+            data = json.load(sys.stdin)
+        else:
+            with open(args.json, 'r') as fil:
+                data = json.load(fil)
+        if not isinstance(data, dict):
+            raise ValueError('JSON settings must be an object')
+
+    proxies = dict(data.get('proxies') or {})
+    for proto in PROTOS:
+        if getattr(args, proto):
+            proxies[proto] = getattr(args, proto)
+    unknown = set(proxies) - set(PROTOS)
+    if unknown:
+        raise ValueError('Unknown protocols: {}'
+                         .format(', '.join(sorted(unknown))))
+    if not proxies:
+        raise ValueError('No hosts were specified')
+
+    candidates, weights = {}, {}
+    for proto, values in proxies.items():
+        if not isinstance(values, list):
+            values = _csv(str(values))
+        candidates[proto], weights[proto] = [], []
+        for value in values:
+            value, _, weight = str(value).partition('=')
+            if weight and not weight.isdigit() or weight == '0':
+                raise ValueError('Invalid weight: {}'.format(weight))
+            host, _, port = value.rpartition(':')
+            if not host or not port.isdigit():
+                # No port is specified, use default
+                host, port = value, backend.DEFAULT_PORT
+            candidates[proto].append((host, int(port)))
+            weights[proto].append(int(weight or 1))
+        if not candidates[proto]:
+            raise ValueError('No hosts were specified for {}'.format(proto))
+
+    user = args.user or data.get('user')
+    pwd = args.password or data.get('password')
+    probes = []
+    upstreams = None
+    if getattr(args, 'relay', None):
+        # The relay balances the requests over all of them
+        upstreams = dict((proto, [[h, p, w] for (h, p), w in
+                                  zip(candidates[proto], weights[proto])])
+                         for proto in candidates
+                         if len(candidates[proto]) > 1)
+        chosen = dict((proto, c[0]) for proto, c in candidates.items())
+    elif args.probe or any(len(c) > 1 for c in candidates.values()):
+        chosen, probes = probe.choose(candidates, args.probe_timeout,
+                                      user=user, pwd=pwd)
+        for r in probes:
+            logging.info('Probed {}:{}: {}'.format(
+                r.host, r.port, '{:.3f}s'.format(r.latency) if r.ok
+                else r.error))
+    else:
+        chosen = dict((proto, c[0]) for proto, c in candidates.items())
+
+    protos, hosts, ports = [], [], []
+    for proto in PROTOS:
+        if proto in chosen:
+            protos.append(proto)
+            hosts.append(chosen[proto][0])
+            ports.append(chosen[proto][1])
+
+    useauth = args.useauth or data.get('useauth')
+    if useauth:
+        useauth = [u for u in useauth if u in protos]
+    notes = {}
+    if probes:
+        notes['probes'] = probe_report(probes)
+    if upstreams:
+        notes['upstreams'] = upstreams
+    noproxy = args.noproxy or data.get('noproxy') or None
+    if noproxy:
+        compacted = compact(noproxy)
+        notes['noproxy'] = {'entries': [len(noproxy), len(compacted)],
+                            'bytes': [len(','.join(noproxy)),
+                                      len(','.join(compacted))]}
+        noproxy = compacted
+    return ({'protos': protos, 'hosts': hosts, 'ports': ports, 'user': user,
+             'pwd': pwd, 'noproxy': noproxy, 'useauth': useauth}, notes)
+
+
+def probe_report(results):
+    """
+    Return a JSON friendly report of the probe results.
+    """
+    return [{'host': r.host, 'port': r.port, 'ok': r.ok,
+             'latency': None if r.latency is None else round(r.latency, 6),
+             'error': r.error} for r in results]
+
+
+def set_funcs(settings):
+    """
+    Return the set function of each target, bound to the settings.
+    """
+    s = settings
+    return {
+        'bash': lambda: backend.set_bash(
+            s['protos'], s['hosts'], s['ports'], user=s['user'],
+            pwd=s['pwd'], noproxy=s['noproxy'], useauth=s['useauth']),
+        'environment': lambda: backend.set_environment(
+            s['protos'], s['hosts'], s['ports'], user=s['user'],
+            pwd=s['pwd'], noproxy=s['noproxy'], useauth=s['useauth']),
+        'apt': lambda: backend.set_apt(
+            s['protos'], s['hosts'], s['ports'], user=s['user'],
+            pwd=s['pwd'], useauth=s['useauth']),
+        'gsettings': lambda: backend.set_gsettings(
+            s['protos'], s['hosts'], s['ports'], user=s['user'],
+            pwd=s['pwd'], noproxy=s['noproxy']),
+        'sudoers': lambda: backend.set_sudoers(
+            s['protos'], noproxy=s['noproxy']),
+    }
+
+
+def backend_funcs(prefix, targets):
+    """
+    Return the backend functions named prefix + target for the targets.
+    """
+    return dict((t, getattr(backend, prefix + t)) for t in targets)
+
+
+def report(results):
+    """
+    Return a JSON friendly report of the target results.
+    """
+    return dict((r.name, {'result': r.result,
+                          'error': str(r.exception) if r.exception else None,
+                          'elapsed': round(r.elapsed, 6)})
+                for r in results)
+
+
+def user_list(args):
+    """
+    Return the Users to cover, or None if none were asked for.
+    """
+    if 'bash' not in args.targets:
+        return None
+    if args.all_users:
+        return users.passwd_users()
+    if args.homes:
+        return users.home_users(args.homes)
+
+
+def user_report(results, verbose=False):
+    """
+    Return a JSON friendly report of the user results, one entry per user.
+    The table of the results is written to stderr if 'verbose'.
+    """
+    if verbose:
+        sys.stderr.write(users.table(results) + '\n')
+    return [{'user': r.name, 'home': r.home, 'result': r.result,
+             'error': str(r.exception) if r.exception else None,
+             'elapsed': round(r.elapsed, 6)} for r in results]
+
+
+def _snapshot(trans):
+    """
+    Return the id of the snapshot taken by the transaction, or None.
+    """
+    return trans.journal.last if trans.journal is not None else None
+
+
+def _finish(output, results, userresults, verbose):
+    """
+    Add the user results to the output. Return the output and exit code.
+    """
+    failed = executor.errors(results)
+    if userresults is not None:
+        output['users'] = user_report(userresults, verbose)
+        failed.extend(r.exception for r in userresults
+                      if r.exception is not None)
+    output['ok'] = not failed
+    return output, EXIT_FAILED if failed else EXIT_OK
+
+
+def do_check(args):
+    results = executor.run(backend_funcs('check_', args.targets), 'Checking')
+    userlist = user_list(args)
+    userresults = None if userlist is None else users.check(userlist)
+    return _finish({'targets': report(results)}, results, userresults,
+                   args.verbose)
+
+
+def do_status(args):
+    results = executor.run(backend_funcs('check_', args.targets), 'Checking')
+    userlist = user_list(args)
+    userresults = None if userlist is None else users.check(userlist)
+    failed = executor.errors(results)
+    present = dict((r.name, bool(r.result)) for r in results)
+    output = {'ok': not failed, 'present': any(present.values()),
+              'targets': present}
+    if userresults is not None:
+        output['users'] = dict((r.home, bool(r.result)) for r in userresults)
+        output['present'] = (output['present'] or
+                             any(output['users'].values()))
+        failed.extend(r.exception for r in userresults
+                      if r.exception is not None)
+        output['ok'] = not failed
+    if failed:
+        output['errors'] = dict((r.name, str(r.exception)) for r in results
+                                if r.exception is not None)
+        output['errors'].update((r.home, str(r.exception))
+                                for r in userresults or ()
+                                if r.exception is not None)
+        return output, EXIT_FAILED
+    return output, EXIT_OK if output['present'] else EXIT_ABSENT
+
+
+def env_report(shells):
+    """
+    Return the JSON form of the variables of the shells.
+    """
+    return dict((shell, dict((name, {'value': v.value, 'file': v.filename,
+                                     'line': v.line})
+                             for name, v in variables.items()))
+                for shell, variables in shells.items())
+
+
+def do_env(args):
+    import shellenv
+    unknown = [s for s in args.shells if s not in shellenv.SHELLS]
+    if unknown:
+        return ({'ok': False, 'error': 'Unknown shells: {}'.format(
+            ', '.join(unknown))}, EXIT_USAGE)
+    try:
+        output = {'ok': True,
+                  'shells': env_report(shellenv.resolve(args.shells))}
+        userlist = user_list(args)
+        if userlist is not None:
+            output['users'] = dict(
+                (user.home, env_report(shellenv.resolve(args.shells,
+                                                        home=user.home)))
+                for user in userlist)
+    except EnvironmentError as e:
+        return {'ok': False, 'error': str(e)}, EXIT_FAILED
+    return output, EXIT_OK
+
+
+def do_remove(args):
+    userlist = user_list(args)
+    userresults = None
+    with backend.transaction() as trans:
+        results = executor.run(backend_funcs('remove_', args.targets),
+                               'Removing')
+        if userlist is not None:
+            userresults = users.remove(userlist)
+    return _finish({'targets': report(results), 'snapshot': _snapshot(trans)},
+                   results, userresults, args.verbose)
+
+
+def do_apply(args):
+    import probe
+    import relay
+    try:
+        settings, notes = load_settings(args)
+    except (IOError, ValueError) as e:
+        return {'ok': False, 'error': str(e)}, EXIT_USAGE
+    except probe.UnreachableError as e:
+        return {'ok': False, 'error': str(e),
+                'probes': probe_report(e.results)}, EXIT_FAILED
+
+    if args.relay:
+        # Only the relay keeps the credentials of the proxies
+        upstreams = notes.pop('upstreams', None)
+        notes['relay'] = {'address': '{}:{}'.format(*args.relay),
+                          'config': relay.save_config(settings, args.relay,
+                                                      upstreams),
+                          'upstreams': upstreams}
+        settings = relay.relayed(settings, args.relay)
+
+    # Existing settings are replaced by the set functions
+    userlist = user_list(args)
+    if args.keep:
+        checks = executor.run(backend_funcs('check_', args.targets),
+                              'Checking')
+        userchecks = None if userlist is None else users.check(userlist)
+        output, code = _finish({'targets': report(checks)}, checks,
+                               userchecks, args.verbose)
+        if code != EXIT_OK:
+            return output, code
+        if (any(r.result for r in checks) or
+                any(r.result for r in userchecks or ())):
+            output.update(ok=False, error='Proxy settings were detected')
+            return output, EXIT_FAILED
+
+    funcs = set_funcs(settings)
+    userresults = None
+    with backend.transaction() as trans:
+        results = executor.run(dict((t, funcs[t]) for t in args.targets),
+                               'Setting')
+        if userlist is not None:
+            userresults = users.apply(userlist, settings)
+    output, code = _finish({'targets': report(results),
+                            'snapshot': _snapshot(trans)}, results,
+                           userresults, args.verbose)
+    output.update(notes)
+    return output, code
+
+
+def do_profile(args):
+    import probe
+    import profiles
+    output = {'ok': True}
+    try:
+        targets = [t for t in profiles.TARGETS if t in args.targets]
+        if args.action == 'save':
+            settings, notes = load_settings(args)
+            output['changed'] = profiles.save(args.name, settings, targets)
+            output.update(notes)
+        elif args.action == 'use':
+            with backend.transaction() as trans:
+                output['changed'] = profiles.use(args.name, targets)
+            output['snapshot'] = _snapshot(trans)
+        elif args.action == 'delete':
+            profiles.delete(args.name)
+    except ValueError as e:
+        return {'ok': False, 'error': str(e)}, EXIT_USAGE
+    except probe.UnreachableError as e:
+        return {'ok': False, 'error': str(e),
+                'probes': probe_report(e.results)}, EXIT_FAILED
+    except (EnvironmentError, subprocess.CalledProcessError) as e:
+        return {'ok': False, 'error': str(e)}, EXIT_FAILED
+    output.update(action=args.action, profiles=profiles.names(),
+                  current=profiles.current())
+    return output, EXIT_OK
+
+
+def do_snapshot(args):
+    import snapshot
+    store = backend.snapshotsdir
+    output = {'ok': True, 'action': args.action}
+    try:
+        if args.action == 'list':
+            output['snapshots'] = [
+                {'id': log['id'], 'time': log['time'],
+                 'files': sorted(log['files'])}
+                for log in snapshot.logs(store)]
+        elif args.action == 'rollback':
+            with backend.transaction() as trans:
+                output['changed'] = snapshot.rollback(store, args.id, trans)
+            output['snapshot'] = _snapshot(trans)
+        elif args.action == 'gc':
+            age = None if args.days is None else args.days * 86400
+            output['removed'], output['blobs'] = snapshot.gc(
+                store, keep=args.keep, age=age)
+    except ValueError as e:
+        return {'ok': False, 'error': str(e)}, EXIT_USAGE
+    except EnvironmentError as e:
+        return {'ok': False, 'error': str(e)}, EXIT_FAILED
+    return output, EXIT_OK
+
+
+def do_watch(args):
+    import netwatch
+    import profiles
+    try:
+        rules = netwatch.load_rules(args.rules)
+    except (IOError, ValueError) as e:
+        return {'ok': False, 'error': str(e)}, EXIT_USAGE
+    targets = [t for t in profiles.TARGETS if t in args.targets]
+    source = (netwatch.FileSource(args.facts) if args.facts else
+              netwatch.NetlinkSource())
+    watcher = netwatch.Watcher(source, rules, debounce=args.debounce,
+                               apply=lambda name: profiles.use(name, targets))
+    if args.once:
+        watcher.check()
+    else:
+        signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: watcher.stop())
+        watcher.run()
+    source.close()
+    return ({'ok': True, 'switches': watcher.switches,
+             'profile': profiles.current()}, EXIT_OK)
+
+
+def do_drift(args):
+    import driftwatch
+    import profiles
+    if args.reapply and profiles.current() is None:
+        return ({'ok': False, 'error': 'No profile in use to apply again'},
+                EXIT_USAGE)
+    homes = [u.home for u in user_list(args) or ()]
+    files = driftwatch.managed_files(args.targets, homes)
+    filenames = [f.filename for f in files]
+    if args.poll is not None:
+        source = driftwatch.PollSource(filenames, args.poll)
+    else:
+        try:
+            source = driftwatch.InotifySource(filenames)
+        except (OSError, AttributeError) as e:
+            logging.warning('Could not use inotify, polling instead: {}'
+                            .format(e))
+            source = driftwatch.PollSource(filenames, 1.0)
+    watcher = driftwatch.DriftWatcher(
+        source, files, debounce=args.debounce, notify=_drift_event,
+        apply=driftwatch.reapply if args.reapply else None)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: watcher.stop())
+    watcher.run()
+    source.close()
+    return ({'ok': True, 'files': len(files), 'drifts': watcher.drifts,
+             'reapplied': watcher.reapplied}, EXIT_OK)
+
+
+def _drift_event(drift):
+    json.dump({'event': 'drift', 'filename': drift.filename,
+               'target': drift.target, 'home': drift.home,
+               'added': drift.added, 'removed': drift.removed,
+               'time': round(time.time(), 3)}, sys.stdout, sort_keys=True)
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+
+
+def do_relay(args):
+    import relay
+    try:
+        settings, upstreams, address = relay.load_config()
+    except ValueError as e:
+        return {'ok': False, 'error': str(e)}, EXIT_USAGE
+    upstreams = relay.balancers(settings, upstreams)
+    if not upstreams:
+        return {'ok': False, 'error': 'No proxy to relay to'}, EXIT_USAGE
+    try:
+        server = relay.Relay(upstreams, args.listen or address)
+    except socket.error as e:
+        return {'ok': False, 'error': str(e)}, EXIT_FAILED
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: server.stop())
+    server.serve_forever()
+    return {'ok': True, 'stats': server.stats()}, EXIT_OK
+
+
+COMMANDS = {'apply': do_apply, 'remove': do_remove, 'check': do_check,
+            'status': do_status, 'profile': do_profile, 'watch': do_watch,
+            'relay': do_relay, 'snapshot': do_snapshot, 'env': do_env,
+            'drift': do_drift}
+
+
+def do_roots(args, roots):
+    """
+    Run the command on each root with a pool of processes.
+    """
+    import fleet
+    batch = fleet.run(roots, COMMANDS[args.command], args,
+                      processes=args.processes)
+    logging.info('Processed {} roots in {:.3f}s ({:.1f} roots/sec)'.format(
+        len(roots), batch.elapsed, batch.roots_per_sec or 0))
+    codes = [EXIT_FAILED if r.code is None else r.code
+             for r in batch.results]
+    if EXIT_FAILED in codes or EXIT_USAGE in codes:
+        code = EXIT_FAILED
+    elif codes and all(c == EXIT_ABSENT for c in codes):
+        code = EXIT_ABSENT
+    else:
+        code = EXIT_OK
+    results = []
+    for r in batch.results:
+        output = dict(r.output, root=r.root, elapsed=round(r.elapsed, 6))
+        output.pop('command', None)
+        results.append(output)
+    return ({'ok': code != EXIT_FAILED, 'roots': results,
+             'elapsed': round(batch.elapsed, 6),
+             'roots_per_sec': batch.roots_per_sec}, code)
+
+
+def read_roots(args):
+    """
+    Return the roots given by --roots and --roots-file.
+    """
+    roots = list(args.roots)
+    if args.roots_file:
+        with open(args.roots_file, 'r') as fil:
+            roots.extend(line.strip() for line in fil if line.strip())
+    return roots
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    unknown = set(args.targets) - set(executor.TARGETS)
+    if unknown:
+        parser.error('unknown targets: {}'.format(', '.join(sorted(unknown))))
+    try:
+        roots = read_roots(args)
+    except IOError as e:
+        parser.error(str(e))
+    if args.root and roots:
+        parser.error('--root cannot be used with --roots')
+    if (args.root or roots) and (args.all_users or args.homes):
+        parser.error('users cannot be enumerated within other roots')
+    if args.root or roots:
+        # GSettings are not stored in the tree
+        args.targets = [t for t in args.targets if t != 'gsettings']
+
+    logging.basicConfig(level=logging.INFO if args.verbose else
+                        logging.WARNING,
+                        format='%(name)-12s: %(levelname)-8s %(message)s')
+
+    if roots:
+        output, code = do_roots(args, roots)
+    else:
+        if args.root:
+            backend.set_root(args.root)
+            # Models of other trees are not kept in the cache of the host
+            backend.models = confmodel.ModelCache(None)
+        output, code = COMMANDS[args.command](args)
+    output['command'] = args.command
+    json.dump(output, sys.stdout, sort_keys=True)
+    sys.stdout.write('\n')
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,502 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Structured models of the configuration files holding proxy settings.
+
+The system environment (pam_env), the apt configuration and sudoers are
+tokenised by small parsers into Items:
+
+    environment  ASSIGNMENT  the variable and its value (without quotes)
+    apt          DIRECTIVE   the full option name (the names of the blocks
+                             it is in joined with ::) and its value
+    sudoers      DEFAULTS    the binding ('', ':user', '@host'...) and the
+                             parameters, as [name, operator, value, text]
+                 INCLUDE     include or includedir, and the path
+
+The offsets of an item span its statement; the whole line for environment
+and sudoers (with continuation lines). Comments are skipped, so commented out
+settings and other variables are never taken for proxy settings.
+
+Models are kept by a ModelCache. A file is parsed in chunks of about CHUNK
+bytes which end at statement boundaries, each recorded with a CRC of its
+contents, its first bytes and the state of the parser at its start (the
+open blocks of apt). When the file changes, the chunks of the previous
+contents are looked for in order, by their first bytes, from where the
+last one found ended. A chunk found unchanged is kept, with its items moved,
+if the state there agrees; the contents in between are parsed again. So an
+edit costs the parsing of the chunks it touches, wherever they are. A file
+whose stat key (inode, mtime and size) is unchanged is not read at all.
+"""
+
+
+import collections
+import os
+import re
+import zlib
+
+from scanindex import ScanIndex
+from scanner import mapfile
+
+
+# Size of the chunks of a file parsed at once
+CHUNK = 1 << 16
+
+# Bytes at the start of a chunk searched for to find it again, once moved.
+# The next RESYNC chunks are looked for, WINDOW bytes ahead at most.
+HEAD = 64
+RESYNC = 8
+WINDOW = 4 * CHUNK
+
+# Kinds of items
+ASSIGNMENT = 'assignment'
+DIRECTIVE = 'directive'
+DEFAULTS = 'defaults'
+INCLUDE = 'include'
+
+Item = collections.namedtuple('Item', 'kind name value start end')
+
+
+class Format(object):
+    """
+    A file format, parsed by chunks.
+    """
+
+    name = None
+    # State of the parser at the start of a file (as JSON)
+    initial = None
+
+    def parse(self, buf, pos, limit, state):
+        """
+        Parse the statements from 'pos' on, up to the first statement
+        boundary at or after 'limit'. Return the Items, the offset of that
+        boundary and the state of the parser there.
+        """
+        raise NotImplementedError
+
+    def boundary(self, buf, pos):
+        """
+        Return True if a chunk may start at the offset: the start of a line.
+        """
+        return pos == 0 or buf[pos - 1:pos] == b'\n'
+
+    def is_proxy(self, item):
+        """
+        Return True if the item holds proxy settings.
+        """
+        raise NotImplementedError
+
+    def removal(self, buf, item):
+        """
+        Return the (start, end, text) replacement removing the proxy
+        settings of the item. The statement is removed, along with its
+        line(s) if nothing else is on them.
+        """
+        start, end = _widen(buf, item.start, item.end)
+        return start, end, b''
+
+
+class EnvironmentFormat(Format):
+    """
+    pam_env environment files: NAME=value lines, optionally prefixed with
+    export.
+    """
+
+    name = 'environment'
+    _LINE = br'[ \t]*(?:export[ \t]+)?([A-Za-z_][A-Za-z0-9_]*)=([^\n]*)'
+    _FIRST = re.compile(_LINE)
+    _NEXT = re.compile(b'\n' + _LINE)
+
+    def parse(self, buf, pos, limit, state):
+        end = _line_end(buf, limit)
+        items = []
+        for start, match in _lines(self._FIRST, self._NEXT, buf, pos, end):
+            value = _decode(match.group(2)).strip()
+            if len(value) > 1 and value[0] in '"\'' and value[-1] == value[0]:
+                value = value[1:-1]
+            items.append(Item(ASSIGNMENT, _decode(match.group(1)), value,
+                              start, min(match.end() + 1, end)))
+        return items, end, state
+
+    def is_proxy(self, item):
+        return item.name.lower().endswith('_proxy')
+
+
+class AptFormat(Format):
+    """
+    apt configuration: 'name "value";' options, scoped by 'name { ... };'
+    blocks. // and # comment out the rest of the line, /* */ a block.
+    """
+
+    name = 'apt'
+    initial = []
+    # An unterminated comment runs to the end
+    _TOKEN = re.compile(br'[ \t\r\f\v]+|\n|//[^\n]*|#[^\n]*|/\*.*?(?:\*/|\Z)|'
+                        br'("[^"\n]*")|([{};])|([^\s{};"]+)|.', re.S)
+    # A whole 'name "value";' option, the most common statement
+    _OPTION = re.compile(br'[ \t]*([^\s{};"/#][^\s{};"]*)[ \t]+"([^"\n]*)"'
+                         br'[ \t]*;')
+
+    def parse(self, buf, pos, limit, state):
+        scopes = list(state)
+        items = []
+        words = []
+        size = len(buf)
+        while pos < size:
+            if not words:
+                if pos >= limit and self.boundary(buf, pos):
+                    break
+                match = self._OPTION.match(buf, pos)
+                if match:
+                    items.append(self._item(scopes, [match.group(1),
+                                                     match.group(2)],
+                                            match.start(1), match.end()))
+                    pos = match.end()
+                    continue
+            match = self._TOKEN.match(buf, pos)
+            start, pos = match.start(), match.end()
+            string, punct, word = match.groups()
+            if string is not None:
+                words.append((string[1:-1], start))
+            elif word is not None:
+                words.append((word, start))
+            elif punct == b'{':
+                scopes.append(_decode(words[0][0]) if words else '')
+                words = []
+            elif punct is not None:
+                item = self._statement(scopes, words, pos)
+                if item is not None:
+                    items.append(item)
+                words = []
+                if punct == b'}' and scopes:
+                    scopes.pop()
+        return items, pos, scopes
+
+    def is_proxy(self, item):
+        parts = item.name.lower().split('::')
+        return len(parts) > 2 and parts[0] == 'acquire' and parts[2] == 'proxy'
+
+    def _statement(self, scopes, words, end):
+        if not words or words[0][0] == b'clear':
+            return None
+        if len(words) == 1:
+            # An element of a list, named after its block
+            return Item(DIRECTIVE, '::'.join(s for s in scopes if s),
+                        _decode(words[0][0]), words[0][1], end)
+        return self._item(scopes, [w for w, _ in words[:2]], words[0][1], end)
+
+    def _item(self, scopes, words, start, end):
+        name = '::'.join(s for s in scopes + [_decode(words[0])] if s)
+        return Item(DIRECTIVE, name, _decode(words[1]), start, end)
+
+
+class SudoersFormat(Format):
+    """
+    sudoers: the Defaults lines and the include directives. Lines ending
+    with a backslash continue on the next line.
+    """
+
+    name = 'sudoers'
+    _START = br'[ \t]*(?:Defaults|[#@]include)'
+    _FIRST = re.compile(_START)
+    _NEXT = re.compile(b'\n' + _START)
+    _DEFAULTS = re.compile(r'\s*Defaults([:@!>]\S*)?\s+(.*?)\s*$', re.S)
+    _INCLUDE = re.compile(r'\s*[#@](include(?:dir)?)\s+(.*?)\s*$', re.S)
+    _PARAM = re.compile(r'\s*((!*)\s*([A-Za-z_][A-Za-z0-9_]*)(?:\s*(\+=|-=|=)'
+                        r'\s*("(?:[^"\\]|\\.)*"|[^,"]*?))?)\s*(?:,|$)')
+
+    def parse(self, buf, pos, limit, state):
+        end = _logical_end(buf, limit)
+        items = []
+        for start, match in _lines(self._FIRST, self._NEXT, buf, pos, end):
+            lineend = _logical_end(buf, start + 1)
+            item = self._item(buf[start:lineend], start, lineend)
+            if item is not None:
+                items.append(item)
+        return items, end, state
+
+    def boundary(self, buf, pos):
+        return pos == 0 or (buf[pos - 1:pos] == b'\n' and
+                            buf[pos - 2:pos - 1] != b'\\')
+
+    def is_proxy(self, item):
+        return item.kind == DEFAULTS and any(
+            _proxy_variables(name, value) for name, _, value, _ in item.value)
+
+    def removal(self, buf, item):
+        texts = []
+        for name, op, value, text in item.value:
+            variables = _proxy_variables(name, value)
+            if variables:
+                kept = [v for v in value.split() if v not in variables]
+                if not kept:
+                    continue
+                text = '{} {} "{}"'.format(name, op, ' '.join(kept))
+            texts.append(text)
+        if not texts:
+            return item.start, item.end, b''
+        line = 'Defaults{} {}'.format(item.name, ', '.join(texts))
+        if buf[item.end - 1:item.end] == b'\n':
+            line += '\n'
+        return item.start, item.end, line.encode('utf-8')
+
+    def _item(self, line, start, end):
+        line = _decode(line).replace('\\\n', ' ')
+        match = self._INCLUDE.match(line)
+        if match:
+            return Item(INCLUDE, match.group(1), match.group(2), start, end)
+        match = self._DEFAULTS.match(line)
+        if not match:
+            return None
+        params = []
+        text = match.group(2)
+        pos = 0
+        while pos < len(text):
+            param = self._PARAM.match(text, pos)
+            if param is None or param.end() == pos:
+                break
+            pos = param.end()
+            whole, bangs, name, op, value = param.groups()
+            if op is None:
+                op = '!' if len(bangs) % 2 else ''
+            elif value.startswith('"'):
+                value = re.sub(r'\\(.)', r'\1', value[1:-1])
+            params.append([name, op, value, whole])
+        return Item(DEFAULTS, match.group(1) or '', params, start, end)
+
+
+ENVIRONMENT = EnvironmentFormat()
+APT = AptFormat()
+SUDOERS = SudoersFormat()
+
+
+class ModelCache(ScanIndex):
+    """
+    Models of files, persisted as JSON like the scan index (see ScanIndex
+    for load and save).
+    """
+
+    def __init__(self, path=None):
+        ScanIndex.__init__(self, path)
+        # Items of the files by stat key, and of their chunks by offset and
+        # CRC (not persisted)
+        self.items = {}
+
+    def model(self, filename, fmt):
+        """
+        Return the Items of the file in the Format, or None if it does not
+        exist.
+        """
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            entry = self.entries.get(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            with self.lock:
+                self.items.pop(filename, None)
+                if self.entries.pop(filename, None) is not None:
+                    self.dirty = True
+            return None
+        key = [st.st_ino, st.st_mtime, st.st_size]
+        if entry and entry.get('format') != fmt.name:
+            entry = None
+        if entry and entry['key'] == key:
+            with self.lock:
+                cached = self.items.get(filename)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+            items, bychunk = _items(entry['chunks'])
+            with self.lock:
+                self.items[filename] = key, items, bychunk
+            return items
+
+        # The lock is not held meanwhile, so that other files can be parsed
+        with mapfile(filename) as buf:
+            chunks, state = _reparse(fmt, buf, entry)
+        with self.lock:
+            cached = self.items.get(filename)
+        items, bychunk = _items(chunks, cached[2] if cached else {})
+        with self.lock:
+            self.entries[filename] = {'key': key, 'format': fmt.name,
+                                      'chunks': chunks, 'state': state}
+            self.items[filename] = key, items, bychunk
+            self.dirty = True
+        return items
+
+
+def removals(filename, fmt, items):
+    """
+    Return the (start, end, text) replacements removing the proxy settings
+    of the items of the file (see Edit).
+    """
+    if not items:
+        return []
+    with mapfile(filename) as buf:
+        return [fmt.removal(buf, item) for item in items]
+
+
+def _reparse(fmt, buf, entry):
+    """
+    Return the chunks of the contents, reusing those of the entry found
+    unchanged (possibly moved), and the state of the parser at the end.
+    """
+    size = len(buf)
+    old = entry['chunks'] if entry else []
+    chunks = []
+    pos = 0
+    state = fmt.initial
+    # Offset of the contents of the last chunk reused since
+    shift = 0
+    ahead = 0
+    while pos < size:
+        # Chunks which would end before the position are gone
+        while ahead < len(old) and old[ahead][1] + shift <= pos:
+            ahead += 1
+        found = _find(fmt, buf, pos, old, ahead)
+        if found is not None and found[1] == pos and old[found[0]][3] == state:
+            i = found[0]
+            shift = pos - old[i][0]
+            chunks.append([pos, old[i][1] + shift] + old[i][2:])
+            pos = old[i][1] + shift
+            state = old[i + 1][3] if i + 1 < len(old) else entry['state']
+            ahead = i + 1
+            continue
+        # Parse up to the next chunk found, if it is close
+        limit = pos + CHUNK
+        if found is not None and pos < found[1] < limit:
+            limit = found[1]
+        items, end, after = fmt.parse(buf, pos, limit, state)
+        chunks.append([pos, end, _crc(buf, pos, end), state,
+                       [[i.kind, i.name, i.value, i.start - pos, i.end - pos]
+                        for i in items],
+                       buf[pos:pos + HEAD].decode('latin-1')])
+        pos, state = end, after
+    return chunks, state
+
+
+def _find(fmt, buf, pos, old, ahead):
+    """
+    Return the index of the first of the next RESYNC old chunks found within
+    WINDOW bytes of the position, and the offset where it is found, or None.
+    """
+    oldsize = old[-1][1] if old else 0
+    for i in range(ahead, min(ahead + RESYNC, len(old))):
+        start, end, crc = old[i][:3]
+        head = old[i][5].encode('latin-1')
+        found = buf.find(head, pos, pos + WINDOW)
+        tries = 0
+        while found >= 0 and tries < 4:
+            # The last statement may go on in contents appended
+            if ((end != oldsize or found + end - start == len(buf)) and
+                    fmt.boundary(buf, found) and
+                    _crc(buf, found, found + end - start) == crc):
+                return i, found
+            found = buf.find(head, found + 1, pos + WINDOW)
+            tries += 1
+    return None
+
+
+def _items(chunks, previous=None):
+    """
+    Return the Items of the chunks, and those of each chunk by its offset,
+    CRC and the state of the parser at its start. The Items of the
+    'previous' chunks still at their offset, and parsed in the same state,
+    are reused.
+    """
+    items = []
+    bychunk = {}
+    for chunk in chunks:
+        # The state is a list of open blocks for apt
+        state = chunk[3]
+        key = chunk[0], chunk[2], (tuple(state) if isinstance(state, list)
+                                   else state)
+        found = previous.get(key) if previous else None
+        if found is None:
+            found = [Item(kind, name, value, chunk[0] + start, chunk[0] + end)
+                     for kind, name, value, start, end in chunk[4]]
+        bychunk[key] = found
+        items.extend(found)
+    return items, bychunk
+
+
+def _crc(buf, start, end):
+    return zlib.crc32(buf[start:end]) & 0xffffffff
+
+
+def _lines(first, following, buf, pos, end):
+    """
+    Yield the offsets and matches of the lines between the offsets matching
+    the pattern. Searching for the newline first (the 'following' pattern)
+    is much faster than a multiline pattern.
+    """
+    match = first.match(buf, pos, end)
+    if match:
+        yield pos, match
+    for match in following.finditer(buf, pos, end):
+        yield match.start() + 1, first.match(buf, match.start() + 1, end)
+
+
+def _line_end(buf, limit):
+    """
+    Return the offset of the start of the first line at or after 'limit'.
+    """
+    if limit >= len(buf):
+        return len(buf)
+    end = buf.find(b'\n', max(limit - 1, 0))
+    return len(buf) if end < 0 else end + 1
+
+
+def _logical_end(buf, limit):
+    """
+    Return the offset of the start of the first line at or after 'limit'
+    which does not continue the previous line.
+    """
+    end = _line_end(buf, limit)
+    while end < len(buf) and buf[end - 2:end] == b'\\\n':
+        end = _line_end(buf, end + 1)
+    return end
+
+
+def _widen(buf, start, end):
+    """
+    Return the span of the lines of the statement if nothing else is on
+    them, or of the statement.
+    """
+    linestart = buf.rfind(b'\n', 0, start) + 1
+    lineend = _line_end(buf, end) if end < len(buf) else end
+    if buf[linestart:start].strip() or buf[end:lineend].strip():
+        # With the blanks following it
+        rest = buf[end:lineend]
+        return start, end + len(rest) - len(rest.lstrip(b' \t'))
+    return linestart, lineend
+
+
+def _proxy_variables(name, value):
+    """
+    Return the proxy variables of an env_keep (or env_check...) parameter.
+    """
+    if not name.startswith('env_') or not value:
+        return []
+    return [v for v in value.split() if v.lower().endswith('_proxy')]
+
+
+def _decode(data):
+    return data.decode('utf-8', 'replace')
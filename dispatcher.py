@@ -0,0 +1,180 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Calls to the GUI from worker threads.
+
+wx may only be used from the thread running the event loop. A Dispatcher
+queues the calls of the other threads and runs every call queued so far in a
+single turn of the event loop, posting one wx.CallAfter per batch rather than
+per call. Each call returns a Future holding its result.
+
+All the futures of a dispatcher share one condition, so that no lock or event
+is allocated per call.
+"""
+
+
+import threading
+import time
+
+
+class CancelledError(Exception):
+    """
+    The call was cancelled before it was made.
+    """
+
+
+class TimeoutError(Exception):
+    """
+    The call was not finished in time.
+    """
+
+
+class Future(object):
+    """
+    The pending result of a call made by a Dispatcher.
+    """
+
+    PENDING, RUNNING, CANCELLED, FINISHED = range(4)
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.state = Future.PENDING
+        self._result = None
+        self._exception = None
+
+    def cancel(self):
+        """
+        Cancel the call unless it has been started. Return True if the call
+        is cancelled.
+        """
+        with self.condition:
+            if self.state == Future.PENDING:
+                self.state = Future.CANCELLED
+                self.condition.notify_all()
+            return self.state == Future.CANCELLED
+
+    def cancelled(self):
+        return self.state == Future.CANCELLED
+
+    def done(self):
+        return self.state in (Future.CANCELLED, Future.FINISHED)
+
+    def result(self, timeout=None):
+        """
+        Wait for the call and return its result, or raise the exception it
+        raised.
+
+        Raises TimeoutError if the call is not finished within 'timeout'
+        seconds (default: no limit) and CancelledError if it was cancelled.
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the call and return the exception it raised, or None.
+        """
+        self._wait(timeout)
+        return self._exception
+
+    def _wait(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            # Woken up whenever any future of the dispatcher is done
+            while not self.done():
+                if deadline is None:
+                    self.condition.wait()
+                elif deadline > time.time():
+                    self.condition.wait(deadline - time.time())
+                else:
+                    break
+            if self.state == Future.CANCELLED:
+                raise CancelledError()
+            if self.state != Future.FINISHED:
+                raise TimeoutError('The call was not finished in {} seconds'
+                                   .format(timeout))
+
+    def _run(self, func, args, kwargs):
+        with self.condition:
+            if self.state != Future.PENDING:
+                return
+            self.state = Future.RUNNING
+        result = exception = None
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            exception = e
+        with self.condition:
+            self._result, self._exception = result, exception
+            self.state = Future.FINISHED
+            self.condition.notify_all()
+
+
+class Dispatcher(object):
+
+    def __init__(self, post=None):
+        """
+        Must be created in the thread running the event loop.
+
+        'post' is called with a callable to run it in the event loop.
+        (default: wx.CallAfter)
+        """
+        if post is None:
+            import wx
+            post = wx.CallAfter
+        self.post = post
+        self.thread = threading.current_thread()
+        self.condition = threading.Condition()
+        self.pending = []
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue a call of func(*args, **kwargs) and return its Future.
+
+        Calls made from the event loop thread itself are made at once, as
+        waiting for them would never end.
+        """
+        future = Future(self.condition)
+        if threading.current_thread() is self.thread:
+            future._run(func, args, kwargs)
+            return future
+        with self.condition:
+            self.pending.append((future, func, args, kwargs))
+            first = len(self.pending) == 1
+        if first:
+            self.post(self._run_pending)
+        return future
+
+    def call(self, func, *args, **kwargs):
+        """
+        Make the call and wait for its result (see submit).
+        """
+        return self.submit(func, *args, **kwargs).result()
+
+    def _run_pending(self):
+        """
+        Make every queued call, in the event loop.
+        """
+        with self.condition:
+            pending, self.pending = self.pending, []
+        for future, func, args, kwargs in pending:
+            future._run(func, args, kwargs)
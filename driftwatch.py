@@ -0,0 +1,518 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Watching the managed files for proxy settings changed behind our back.
+
+Configuration management and users edit /etc/environment, the bashrc files
+and the like; a change to their proxy settings is a drift. Rather than
+scanning every file periodically, the directories of the files are watched
+through inotify (directories rather than files, since editors and atomic
+writes replace a file by renaming another over it), and only the files
+changed are read again.
+
+Each change is classified by the proxy settings of the file, compared to the
+ones last seen:
+
+    bash         the lines holding one of the phrases (backend.PHRASES) or
+                 sourcing the current profile, found through the scan index
+    environment  the proxy variables and BASH_ENV of the model of the file
+    apt          the proxy options of the model
+    sudoers      the Defaults keeping proxy variables and the includes
+
+Models are updated incrementally (see confmodel). A change of anything else,
+a comment or an alias, is not a drift. GSettings are not files and are not
+watched.
+
+Drifts are reported (see Drift) and, optionally, the profile in use is
+applied again to the targets which drifted (see reapply). The files written
+then are taken as the new settings, so re-applying does not trigger itself.
+Changes made by other grrproxy processes (a profile switch) are reported as
+well.
+
+Symbolic links are followed, so that a bashrc linked to another directory is
+watched there, except to the profiles, which are only changed by us. For
+tests and systems without inotify, a PollSource stats the files instead.
+"""
+
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+import backend
+import confmodel
+import profiles
+import scanner
+import users
+
+
+DEFAULT_DEBOUNCE = 0.5
+
+TARGETS = ('bash', 'environment', 'apt', 'sudoers')
+
+# Formats of the targets whose files are modelled, bash files are scanned
+FORMATS = {'environment': confmodel.ENVIRONMENT, 'apt': confmodel.APT,
+           'sudoers': confmodel.SUDOERS}
+
+# inotify flags and events (sys/inotify.h)
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+           IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT = struct.Struct('iIII')
+
+
+# A file holding proxy settings, of the target. 'home' is the home
+# directory of the user the file belongs to, None for the files of the
+# backend (the system and HOME).
+ManagedFile = collections.namedtuple('ManagedFile', 'filename target home')
+
+# A change of the proxy settings of a file: the settings which appeared and
+# disappeared, as texts (see settings)
+Drift = collections.namedtuple('Drift', 'filename target home added removed')
+
+
+def managed_files(targets=TARGETS, homes=()):
+    """
+    Return the ManagedFiles of the targets, including the bash files of the
+    users with the home directories.
+    """
+    files = []
+    if 'bash' in targets:
+        for filename in (backend.bashprofile, backend.bashlogin,
+                         backend.userprofile, backend.bashenv,
+                         backend.bashbashrc, backend.bashrc,
+                         backend.profdproxy, backend.profile):
+            files.append(ManagedFile(filename, 'bash', None))
+        for home in homes:
+            files.extend(ManagedFile(f, 'bash', home)
+                         for f in backend.user_files(home))
+    if 'environment' in targets:
+        files.append(ManagedFile(backend.environment, 'environment', None))
+    if 'apt' in targets:
+        files.append(ManagedFile(backend.aptconf, 'apt', None))
+        files.append(ManagedFile(backend.aptfrag, 'apt', None))
+    if 'sudoers' in targets:
+        files.append(ManagedFile(backend.sudoers, 'sudoers', None))
+        files.append(ManagedFile(backend.sudodproxy, 'sudoers', None))
+    # HOME may be among the homes
+    seen = set()
+    return [f for f in files
+            if not (f.filename in seen or seen.add(f.filename))]
+
+
+def settings(managed):
+    """
+    Return the proxy settings of the ManagedFile, as a tuple of texts in the
+    order of the file, or None if it does not exist.
+    """
+    fmt = FORMATS.get(managed.target)
+    if fmt is None:
+        phrases = backend.PHRASES + (backend.unrooted(backend.currentlink) +
+                                     '/',)
+        lines = backend.index.lookup(managed.filename, phrases, scanner.scan)
+        if lines is None:
+            return None
+        with scanner.mapfile(managed.filename) as buf:
+            return tuple(_decode(buf[start:end]).strip()
+                         for start, end in scanner.merge(lines))
+    items = backend.models.model(managed.filename, fmt)
+    if items is None:
+        return None
+    return tuple(_describe(i) for i in items
+                 if fmt.is_proxy(i) or i.kind == confmodel.INCLUDE or
+                 i.name == 'BASH_ENV')
+
+
+def _describe(item):
+    if item.kind == confmodel.DEFAULTS:
+        return 'Defaults{} {}'.format(item.name,
+                                      ', '.join(p[3] for p in item.value))
+    if item.kind == confmodel.INCLUDE:
+        return '#{} {}'.format(item.name, item.value)
+    if item.kind == confmodel.ASSIGNMENT:
+        return '{}={}'.format(item.name, item.value)
+    return '{} "{}"'.format(item.name, item.value)
+
+
+def reapply(drifts):
+    """
+    Apply the profile in use again to the targets (and users) which
+    drifted. Return the changed files.
+    """
+    name = profiles.current()
+    if name is None:
+        raise ValueError('No profile in use to apply again')
+    changed = []
+    targets = set(d.target for d in drifts if d.home is None)
+    if targets:
+        changed.extend(profiles.use(name, [t for t in profiles.TARGETS
+                                           if t in targets]))
+    homes = sorted(set(d.home for d in drifts if d.home is not None))
+    if homes:
+        s = profiles.load(name)
+        results = users.apply(users.home_users(homes), {
+            'protos': s['protos'], 'hosts': s['hosts'], 'ports': s['ports'],
+            'user': s.get('user'), 'pwd': s.get('pwd'),
+            'noproxy': s.get('noproxy'), 'useauth': s.get('useauth')})
+        for r in results:
+            if r.exception is not None:
+                raise r.exception
+            changed.extend(r.result)
+    return changed
+
+
+class InotifySource(object):
+    """
+    Changes of the files, from the kernel. The directories of the files (or
+    their closest existing parents) are watched.
+    """
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        # Written to by interrupt, to wake up wait
+        self.wakeup = os.pipe()
+        # Watched directories by watch descriptor
+        self.watches = {}
+        # Filenames by the paths whose changes change them
+        self.paths = {}
+        self.refresh()
+
+    def refresh(self):
+        """
+        Watch the directories of the files and of the files they link to,
+        as they are now.
+        """
+        self.paths = {}
+        for filename in self.filenames:
+            self.paths.setdefault(filename, set()).add(filename)
+            target = os.path.realpath(filename)
+            if not _is_within(target, backend.statedir):
+                self.paths.setdefault(target, set()).add(filename)
+        watched = set(self.watches.values())
+        for dirname in set(_existing(os.path.dirname(p))
+                           for p in self.paths):
+            if dirname in watched:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, _encode(dirname),
+                                             IN_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                logging.warning('Could not watch {}: {}'.format(
+                    dirname, os.strerror(e)))
+                continue
+            self.watches[wd] = dirname
+
+    def wait(self, timeout=None):
+        """
+        Wait for changes for at most 'timeout' seconds (default: no limit).
+        Return the set of filenames which may have changed.
+        """
+        try:
+            ready = select.select([self.fd, self.wakeup[0]], [], [],
+                                  timeout)[0]
+        except select.error as e:
+            # Interrupted by a signal
+            if e.args[0] != errno.EINTR:
+                raise
+            return set()
+        if self.wakeup[0] in ready:
+            os.read(self.wakeup[0], 512)
+            return set()
+        changed = set()
+        if not ready:
+            return changed
+        refresh = False
+        for wd, mask, name in self._events():
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost
+                changed.update(self.filenames)
+                refresh = True
+                continue
+            dirname = self.watches.get(wd)
+            if dirname is None:
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                # The directory is gone, its parent is watched instead
+                if not mask & IN_IGNORED:
+                    self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+                path = dirname
+            else:
+                path = os.path.join(dirname, name)
+                changed.update(self.paths.get(path, ()))
+                if not mask & IN_ISDIR:
+                    continue
+            # Files may be in (or linked from) a directory which appeared
+            # or disappeared
+            refresh = True
+            for p, filenames in self.paths.items():
+                if _is_within(p, path):
+                    changed.update(filenames)
+        if refresh or changed:
+            # Links may point elsewhere now
+            self.refresh()
+        return changed
+
+    def _events(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not data:
+                return
+            pos = 0
+            while pos + _EVENT.size <= len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, pos)
+                pos += _EVENT.size
+                name = data[pos:pos + length].rstrip(b'\0')
+                pos += length
+                yield wd, mask, _decode_path(name)
+
+    def interrupt(self):
+        """
+        Make the current (or next) wait return.
+        """
+        os.write(self.wakeup[1], b'x')
+
+    def close(self):
+        os.close(self.fd)
+        for fd in self.wakeup:
+            os.close(fd)
+
+
+class PollSource(object):
+    """
+    Changes of the files, found by checking their stat keys (and those of
+    the files they link to) every 'interval' seconds.
+    """
+
+    def __init__(self, filenames, interval=0.1):
+        self.filenames = list(filenames)
+        self.interval = interval
+        self.keys = dict((f, self._key(f)) for f in self.filenames)
+        self.interrupted = False
+
+    def _key(self, filename):
+        keys = []
+        for func in (os.lstat, os.stat):
+            try:
+                st = func(filename)
+            except OSError:
+                keys.append(None)
+            else:
+                keys.append((st.st_ino, st.st_mtime, st.st_size))
+        return tuple(keys)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed = set()
+            for filename in self.filenames:
+                key = self._key(filename)
+                if key != self.keys[filename]:
+                    self.keys[filename] = key
+                    changed.add(filename)
+            if changed:
+                return changed
+            if self.interrupted:
+                self.interrupted = False
+                return changed
+            if deadline is not None and time.time() >= deadline:
+                return changed
+            time.sleep(self.interval if deadline is None else
+                       max(min(self.interval, deadline - time.time()), 0))
+
+    def interrupt(self):
+        self.interrupted = True
+
+    def close(self):
+        pass
+
+
+class DriftWatcher(object):
+
+    def __init__(self, source, files, debounce=DEFAULT_DEBOUNCE, notify=None,
+                 apply=None):
+        """
+        'source' gives the changes of the files (InotifySource or
+        PollSource).
+        'files' are the ManagedFiles watched.
+        'debounce' is the time in seconds without changes after which a
+        burst of changes is classified.
+        'notify' is called with each Drift (default: log it).
+        'apply' is called with the list of Drifts of a burst, to apply the
+        settings again (see reapply), if given. It returns the changed
+        files.
+        """
+        self.source = source
+        self.files = dict((f.filename, f) for f in files)
+        self.debounce = debounce
+        self.notify = notify or _log
+        self.apply = apply
+        self.drifts = 0
+        self.reapplied = 0
+        self.stopped = False
+        # The settings last seen, read once at the start
+        self.seen = {}
+        self.update(self.files)
+
+    def update(self, filenames):
+        """
+        Return the Drifts of the files, and take their settings as seen.
+        """
+        drifts = []
+        for filename in filenames:
+            managed = self.files.get(filename)
+            if managed is None:
+                continue
+            try:
+                current = settings(managed)
+            except (IOError, OSError) as e:
+                logging.error('Could not read {}: {}'.format(filename, e))
+                continue
+            known = filename in self.seen
+            previous = self.seen.get(filename)
+            self.seen[filename] = current
+            if known and current != previous:
+                after = set(current or ())
+                before = set(previous or ())
+                drifts.append(Drift(filename, managed.target, managed.home,
+                                    [s for s in current or () if s not in
+                                     before],
+                                    [s for s in previous or () if s not in
+                                     after]))
+        backend.index.save()
+        backend.models.save()
+        return drifts
+
+    def check(self, filenames):
+        """
+        Classify the changes of the files, report the drifts and apply the
+        settings again if asked to. Return the Drifts.
+        """
+        drifts = self.update(filenames)
+        for drift in drifts:
+            self.drifts += 1
+            self.notify(drift)
+        if drifts and self.apply is not None:
+            changed = self.apply(drifts)
+            self.reapplied += 1
+            if changed:
+                logging.info('Applied the settings again to {}'.format(
+                    ', '.join(changed)))
+            # Our own changes are not drifts
+            self.update(self.files)
+        return drifts
+
+    def run(self):
+        """
+        Check the changed files after each burst of changes, until stopped.
+        """
+        while not self.stopped:
+            changed = self.source.wait()
+            if not changed:
+                continue
+            # Wait until the files settle
+            while not self.stopped:
+                more = self.source.wait(self.debounce)
+                if not more:
+                    break
+                changed.update(more)
+            if not self.stopped:
+                self._check(changed)
+
+    def _check(self, filenames):
+        # A failed check is retried on the next change
+        try:
+            self.check(filenames)
+        except Exception as e:
+            logging.error('Could not check the drift of the settings: {}'
+                          .format(e))
+
+    def stop(self):
+        """
+        Stop running. May be called from another thread or a signal handler.
+        """
+        self.stopped = True
+        self.source.interrupt()
+
+
+def _log(drift):
+    logging.warning('Proxy settings of {} changed:{}'.format(
+        drift.filename, ''.join(['\n  + ' + s for s in drift.added] +
+                                ['\n  - ' + s for s in drift.removed])))
+
+
+def _existing(dirname):
+    """
+    Return the directory, or its closest existing parent.
+    """
+    while not os.path.isdir(dirname) and os.path.dirname(dirname) != dirname:
+        dirname = os.path.dirname(dirname)
+    return dirname
+
+
+def _is_within(path, dirname):
+    return path == dirname or path.startswith(dirname.rstrip('/') + '/')
+
+
+def _encode(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding(), 'surrogateescape')
+
+
+def _decode_path(name):
+    if isinstance(name, str):
+        return name
+    return name.decode(sys.getfilesystemencoding(), 'surrogateescape')
+
+
+def _decode(data):
+    return data.decode('utf-8', 'replace')
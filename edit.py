@@ -0,0 +1,235 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Streaming line edits.
+
+An Edit describes the new contents of a file as the file without the lines
+containing some phrases, with a block of lines optionally appended. The new
+contents are produced in chunks straight from the file, so memory use does
+not depend on the size of the file.
+
+Spans of the file (parts of lines, as located by a parser) can also be
+removed or replaced.
+
+When lines are removed, trailing empty lines are reduced to one and the last
+line is terminated with a newline. An appended block is separated from the
+contents by an empty line.
+
+The lines located through 'lookup' may be stale (a persistent index, or a
+file changed since). Every line removed is checked to still contain its
+phrase as the contents are produced, and the edit fails otherwise (see
+StaleError), so that nothing else is ever cut out of the file.
+"""
+
+
+import os
+
+import scanner
+
+
+# Largest chunk of contents produced at once
+CHUNK = 1 << 16
+
+
+class StaleError(IOError):
+    """
+    A line located for removal no longer contains its phrase.
+    """
+
+
+class Edit(object):
+
+    def __init__(self, filename, phrases=(), exact=(), tail=None,
+                 lookup=None, replace=(), stale=None):
+        """
+        'phrases' are the phrases whose lines are removed and 'exact' are
+        lines removed only if they are equal to the line (without newline).
+        'tail' is the block appended, without a final newline.
+        'lookup' is called as lookup(filename, phrases) to locate lines. It
+        must return the same as scanner.scan, or None if the file is missing.
+        (default: scanning the file)
+        'replace' are (start, end, text) offsets of spans replaced by the
+        text, removed if it is empty.
+        'stale' is called with the filename when a line located no longer
+        contains its phrase, before StaleError is raised, to drop what
+        'lookup' knows of the file.
+        """
+        self.filename = filename
+        self.tail = tail
+        self.lookup = lookup or _scan_file
+        self.stale = stale
+        self.lastblank = False
+
+        if phrases or exact:
+            lines = self.lookup(filename, tuple(phrases) + tuple(exact))
+        else:
+            lines = {} if os.path.exists(filename) else None
+        self.exists = lines is not None
+        spans = set()
+        # What each line removed must still hold: phrases or an exact line
+        self.phrases = {}
+        self.exact = {}
+        if self.exists:
+            for phrase in phrases:
+                for l in lines[phrase]:
+                    self.phrases.setdefault(tuple(l), []).append(phrase)
+            for line in exact:
+                for l in lines[line]:
+                    if self._read(*l).rstrip('\n') == line:
+                        self.exact[tuple(l)] = line
+            spans.update(self.phrases)
+            spans.update(self.exact)
+            spans.update((start, end) for start, end, _ in replace)
+        self.texts = dict(((start, end), text)
+                          for start, end, text in replace if text)
+        self.spans = sorted(spans)
+
+    def __iter__(self):
+        return self.chunks()
+
+    def contains(self, phrase):
+        """
+        Return True if a line kept by the edit contains the phrase.
+        """
+        return bool(self.lines(phrase))
+
+    def lines(self, phrase):
+        """
+        Return the lines kept by the edit which contain the phrase.
+        """
+        if not self.exists:
+            return []
+        lines = self.lookup(self.filename, (phrase,)) or {phrase: []}
+        removed = set(self.spans)
+        return [self._read(*l) for l in lines[phrase]
+                if tuple(l) not in removed]
+
+    def unchanged(self):
+        """
+        Return True if the edit leaves the file as it is.
+        """
+        if not self.exists:
+            return self.tail is None
+        if not self.spans and self.tail is None:
+            return True
+        # Compare the new contents with the file, chunk by chunk
+        with open(self.filename, 'rb') as fil:
+            for chunk in self.chunks():
+                if fil.read(len(chunk)) != chunk:
+                    return False
+            return not fil.read(1)
+
+    def chunks(self):
+        """
+        Yield the new contents of the file.
+        """
+        self.lastblank = False
+        if self.exists:
+            with scanner.mapfile(self.filename) as buf:
+                if self.spans:
+                    for chunk in self._stripped(buf):
+                        yield chunk
+                else:
+                    for pos in range(0, len(buf), CHUNK):
+                        yield buf[pos:pos + CHUNK]
+                    self.lastblank = (buf[:] == b'\n' if len(buf) == 1 else
+                                      buf[-2:] == b'\n\n')
+        if self.tail is not None:
+            newline = b'' if self.lastblank else b'\n'
+            yield newline + self.tail + b'\n'
+
+    def _stripped(self, buf):
+        """
+        Yield the contents without the removed lines, managing newlines.
+        Trailing newlines are held back until more contents follow.
+        """
+        pending = 0
+        written = False
+        for piece in self._kept(buf):
+            stripped = piece.rstrip(b'\n')
+            if not stripped:
+                pending += len(piece)
+                continue
+            for chunk in _newlines(pending):
+                yield chunk
+            yield stripped
+            pending = len(piece) - len(stripped)
+            written = True
+
+        # One empty line at most, and a newline at the end
+        if written:
+            pending = max(1, min(pending, 2))
+        else:
+            pending = 1
+        for chunk in _newlines(pending):
+            yield chunk
+        self.lastblank = pending == 2 or not written
+
+    def _kept(self, buf):
+        pos = 0
+        for start, end in self.spans + [(len(buf), len(buf))]:
+            # Spans overlapping a removed one are already gone
+            if start < pos:
+                continue
+            self._check(buf, start, end)
+            while pos < start:
+                yield buf[pos:min(start, pos + CHUNK)]
+                pos = min(start, pos + CHUNK)
+            text = self.texts.get((start, end))
+            if text:
+                yield text
+            pos = end
+
+    def _check(self, buf, start, end):
+        """
+        Raise StaleError if the span is a line located for removal which no
+        longer contains its phrase in the contents.
+        """
+        phrases = self.phrases.get((start, end))
+        line = self.exact.get((start, end))
+        if phrases is None and line is None:
+            return
+        text = buf[start:end]
+        if (end <= len(buf) and buf[start - 1:start] in (b'', b'\n') and
+                (end == len(buf) or text[-1:] == b'\n') and
+                (any(p in text for p in phrases or ()) or
+                 line is not None and text.rstrip(b'\n') == line)):
+            return
+        if self.stale is not None:
+            self.stale(self.filename)
+        raise StaleError('Lines located in {} are out of date, the file was '
+                         'left as it is'.format(self.filename))
+
+    def _read(self, start, end):
+        with open(self.filename, 'rb') as fil:
+            fil.seek(start)
+            return fil.read(end - start)
+
+
+def _newlines(count):
+    while count > 0:
+        yield b'\n' * min(count, CHUNK)
+        count -= CHUNK
+
+
+def _scan_file(filename, phrases):
+    if not os.path.exists(filename):
+        return
+    return scanner.scan_file(filename, phrases)
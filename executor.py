@@ -0,0 +1,122 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Concurrent execution of the proxy targets.
+
+The targets touch separate files (and dconf), so the check, set and remove
+functions of different targets can run at the same time. Targets listed in
+DEPENDENCIES are only started after the targets they depend on have finished.
+Sudoers always goes last, so that sudo keeps working if any other target
+fails.
+"""
+
+
+import collections
+import logging
+import threading
+import time
+
+
+# Targets in reporting order
+TARGETS = ('bash', 'environment', 'apt', 'gsettings', 'sudoers')
+
+# Targets which must finish before the target is started
+DEPENDENCIES = {'sudoers': ('bash', 'environment', 'apt', 'gsettings')}
+
+DEFAULT_WORKERS = 4
+
+
+TargetResult = collections.namedtuple('TargetResult',
+                                      'name result exception elapsed')
+
+
+def run(funcs, phase=None, workers=DEFAULT_WORKERS, dependencies=None):
+    """
+    Call the function of each target and return a list of TargetResults.
+
+    'funcs' maps target names to callables taking no arguments. At most
+    'workers' functions run at a time. If 'phase' is given, it is logged along
+    with the name of each target when it is started. Exceptions raised by the
+    functions are caught and returned in the results. Results are ordered as
+    TARGETS, followed by any other targets in name order.
+    """
+    if dependencies is None:
+        dependencies = DEPENDENCIES
+    results = {}
+    pending = sorted(funcs, key=_order)
+    while pending:
+        # Start the targets whose dependencies have finished
+        ready = [name for name in pending
+                 if all(dep in results or dep not in funcs
+                        for dep in dependencies.get(name, ()))]
+        if not ready:
+            raise ValueError('Circular dependencies between targets: {}'
+                             .format(', '.join(pending)))
+        _run_stage(ready, funcs, results, phase, workers)
+        pending = [name for name in pending if name not in results]
+    return [results[name] for name in sorted(results, key=_order)]
+
+
+def errors(results):
+    """
+    Return the exceptions of the failed results.
+    """
+    return [r.exception for r in results if r.exception is not None]
+
+
+def _order(name):
+    return (TARGETS.index(name) if name in TARGETS else len(TARGETS), name)
+
+
+def _run_stage(names, funcs, results, phase, workers):
+    """
+    Run the targets with a bounded number of threads.
+    """
+    names = list(names)
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not names:
+                    return
+                name = names.pop(0)
+            results[name] = _call(name, funcs[name], phase)
+
+    threads = [threading.Thread(target=work)
+               for _ in range(min(max(workers, 1), len(names)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _call(name, func, phase):
+    if phase:
+        logging.info('{} {}...'.format(phase, name))
+    start = time.time()
+    result = exception = None
+    try:
+        result = func()
+    except Exception as e:
+        exception = e
+    elapsed = time.time() - start
+    logging.debug('{} took {:.3f}s'.format(name, elapsed))
+    return TargetResult(name, result, exception, elapsed)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python2.7
+
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Offline stand-in for dconf and gsettings.
+
+Implements the subset of both commands used by backend, keeping the database
+in a JSON file (FAKEDCONF_DB, default: fakedconf.json in the temp directory).
+Values are stored in GVariant text format, as dconf prints them.
+
+    dconf load DIR < KEYFILE
+    dconf dump DIR
+    dconf reset -f DIR
+    dconf read KEY
+    dconf write KEY VALUE
+    gsettings get SCHEMA KEY
+
+The gsettings commands are used when the program is invoked through a link
+named 'gsettings'. To use it, point backend.dconf and backend.gsettings to
+this file and a link to it respectively.
+"""
+
+
+import json
+import os
+import sys
+import tempfile
+
+
+# Schema defaults for keys read through gsettings
+DEFAULTS = {
+    '/org/gnome/system/proxy/mode': '\'none\'',
+    '/org/gnome/system/proxy/ignore-hosts': '[\'localhost\', '
+                                            '\'127.0.0.0/8\', \'::1\']',
+}
+
+
+def load_db():
+    path = os.getenv('FAKEDCONF_DB',
+                     os.path.join(tempfile.gettempdir(), 'fakedconf.json'))
+    if os.path.exists(path):
+        with open(path, 'r') as fil:
+            return path, json.load(fil)
+    return path, {}
+
+
+def save_db(path, db):
+    with open(path, 'w') as fil:
+        json.dump(db, fil, indent=1, sort_keys=True)
+
+
+def dconf(args, db):
+    """
+    Run a dconf command on the database. Return its output.
+    """
+    cmd = args[0]
+    if cmd == 'load':
+        dirname = args[1]
+        section = None
+        for line in sys.stdin.read().splitlines():
+            line = line.strip()
+            if line.startswith('[') and line.endswith(']'):
+                section = line[1:-1].strip('/')
+            elif '=' in line and section is not None:
+                key, value = line.split('=', 1)
+                sub = '{}/'.format(section) if section else ''
+                db['{}{}{}'.format(dirname, sub, key)] = value
+        return ''
+    elif cmd == 'dump':
+        dirname = args[1]
+        sections = {}
+        for path, value in db.items():
+            if path.startswith(dirname):
+                sub, _, key = path[len(dirname):].rpartition('/')
+                sections.setdefault(sub or '/', []).append((key, value))
+        output = []
+        for section in sorted(sections, key=lambda s: (s != '/', s)):
+            output.append('[{}]'.format(section))
+            output.extend('{}={}'.format(k, v)
+                          for k, v in sorted(sections[section]))
+            output.append('')
+        return '\n'.join(output)
+    elif cmd == 'reset':
+        dirname = args[-1]
+        for path in list(db):
+            if path == dirname or (args[1] == '-f' and
+                                   path.startswith(dirname)):
+                del db[path]
+        return ''
+    elif cmd == 'read':
+        return db.get(args[1], '')
+    elif cmd == 'write':
+        db[args[1]] = args[2]
+        return ''
+    raise ValueError('Unsupported command: {}'.format(cmd))
+
+
+def gsettings(args, db):
+    """
+    Run a gsettings command on the database. Return its output.
+    """
+    if args[0] != 'get':
+        raise ValueError('Unsupported command: {}'.format(args[0]))
+    path = '/{}/{}'.format(args[1].replace('.', '/'), args[2])
+    return db.get(path, DEFAULTS.get(path, '\'\''))
+
+
+def main(argv):
+    path, db = load_db()
+    if os.path.basename(argv[0]).startswith('gsettings'):
+        output = gsettings(argv[1:], db)
+    else:
+        output = dconf(argv[1:], db)
+    save_db(path, db)
+    if output:
+        sys.stdout.write(output if output.endswith('\n') else output + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,83 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Batches of root file systems.
+
+Applies, checks or removes proxy settings in many directory trees (chroots,
+unpacked container root file systems) at once. The backend targets one root
+per process (see backend.set_root), so the roots are spread over a pool of
+processes. Each process runs the command on one root at a time, with a scan
+index and models (see confmodel) kept in memory.
+
+GSettings are kept in the dconf database of a running session, not in the
+tree, so that target is left out.
+"""
+
+
+import collections
+import multiprocessing
+import time
+
+import backend
+from confmodel import ModelCache
+from scanindex import ScanIndex
+
+
+RootResult = collections.namedtuple('RootResult',
+                                    'root output code elapsed')
+
+BatchResult = collections.namedtuple('BatchResult',
+                                     'results elapsed roots_per_sec')
+
+
+def run(roots, func, args, processes=None):
+    """
+    Call func(args) for each root in a pool of processes (default: one per
+    CPU) and return a BatchResult.
+
+    'func' must be picklable (a module level function) and return an output
+    and an exit code, as the commands of cli do. The RootResults are in the
+    order of the roots, their code is None if func raised an exception.
+    """
+    jobs = [(root, func, args) for root in roots]
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_process, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    return BatchResult(results, elapsed,
+                       len(results) / elapsed if elapsed else None)
+
+
+def _process(job):
+    root, func, args = job
+    backend.set_root(root)
+    backend.index = ScanIndex(None, backend.PHRASES)
+    backend.models = ModelCache(None)
+    start = time.time()
+    try:
+        output, code = func(args)
+    except Exception as e:
+        # Reported with the root, the other roots go on
+        output, code = {'ok': False, 'error': str(e)}, None
+    return RootResult(root, output, code, time.time() - start)
@@ -32,8 +32,6 @@ import sys
 import traceback
 import wx
 
-from mainframe import GrrFrame
-
 
 def ExceptionHook(exctype, value, trace):
     """
@@ -79,10 +77,14 @@ class GrrApp(wx.App):
             console.setFormatter(formatter)
             logging.getLogger('').addHandler(console)
 
+            # Imported here, so that failing checks above return quickly
+            from mainframe import GrrFrame
             self.frame = GrrFrame(parent=None,
                                   title='{} v{}'.format(NAME, VERSION))
             self.SetTopWindow(self.frame)
             self.frame.Show()
+            # Slow calls are made once the frame is up
+            wx.CallAfter(self.frame.FetchNoProxy)
             return True
 
     def GetName(self):
@@ -18,59 +18,100 @@
 
 
 import logging
-import tempfile
+import Queue
 import threading
 import time
 
 
+class QueueHandler(logging.Handler):
+    """
+    Logging handler putting the records in a queue, unformatted.
+
+    Records are dropped while the event is clear, at the cost of a single
+    check.
+    """
+
+    def __init__(self, queue, event):
+        super(QueueHandler, self).__init__()
+        self.queue = queue
+        self.event = event
+
+    def emit(self, record):
+        if self.event.is_set():
+            self.queue.put(record)
+
+
 class LogMonitor(threading.Thread):
 
-    def __init__(self, caller, handler, event, interval=0.01):
+    def __init__(self, handler, event, interval=1.0 / 60):
         """
-        'caller' must be the thread object of the caller.
         'handler' must the callable used for handling the logs
         'event' is the Event object which is checked before making calls to the
-        handler.
-        'interval' must be of type int or float. It specifies the time in
-        seconds between each call to the handler. (default: 0.01)
+        handler. Nothing is formatted while it is clear.
+        'interval' must be of type int or float. It specifies the least time in
+        seconds between each call to the handler. (default: one frame at 60
+        frames per second)
 
         NOTE:
-        If the interval is too long, the accumulated messages in the logger
-        would be handled at once. For more responsive updates, keep this value
-        somewhere close to one second or less (but not zero).
+        The monitor sleeps until records arrive. Records arriving within the
+        interval are joined and passed to the handler at once, so a burst of
+        logs costs a single update of the display.
         """
         super(LogMonitor, self).__init__()
-        self.caller = caller
+        self.daemon = True
         self.handler = handler
         self.event = event
         self.interval = interval
-        # Define a file handler with a tempfile
-        self.tfile = tempfile.NamedTemporaryFile()
-        tfilehand = logging.FileHandler(self.tfile.name)
+        self.queue = Queue.Queue()
+        # Define a handler keeping the records in memory
+        self.qhandler = QueueHandler(self.queue, event)
         # Set logging level
-        tfilehand.setLevel(logging.INFO)
+        self.qhandler.setLevel(logging.INFO)
         # Create a console friendly formatter
-        formatter = logging.Formatter('%(name)-12s: %(levelname)-8s '
-                                      '%(message)s')
-        tfilehand.setFormatter(formatter)
+        self.formatter = logging.Formatter('%(name)-12s: %(levelname)-8s '
+                                           '%(message)s')
+        self.qhandler.setFormatter(self.formatter)
         # Add this handler to the root logger
-        logging.getLogger('').addHandler(tfilehand)
+        logging.getLogger('').addHandler(self.qhandler)
 
         self.start()
 
     def run(self):
-        """Read the logger and handle the data.
+        """Wait for log records and handle them.
+
+        This method enters a loop which is not broken out of until the monitor
+        is stopped. The records pushed to the logger are formatted and passed
+        to the handler if the event is set. Records arriving while the handler
+        was called less than an interval ago are collected and handled
+        together.
+        """
+        last = 0
+        while True:
+            # Block until a record arrives
+            records = [self.queue.get()]
+            wait = last + self.interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            # Collect the rest of the burst
+            try:
+                while True:
+                    records.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            stop = None in records
+            if stop:
+                records = records[:records.index(None)]
+            if records and self.event.is_set():
+                self.handler(''.join(self.qhandler.format(r) + '\n'
+                                     for r in records))
+                last = time.time()
+            if stop:
+                break
+        logging.getLogger('').removeHandler(self.qhandler)
+        logging.debug('LogMonitor is exiting now.')
 
-        This method enters a loop which is not broken out of until the caller
-        thread is dead. The messages pushed to the logger are passed to the
-        handler if the event is set. The loop is repeated in specified
-        intervals.
+    def stop(self):
+        """
+        Stop the monitor. Records queued before are still handled.
         """
-        while self.caller.is_alive():
-            details = self.tfile.read()
-            if self.event.is_set() and details:
-                self.handler(details)
-            time.sleep(self.interval)
-        else:
-            logging.debug('Caller thread, {}, is not alive. '
-                          'LogMonitor is exiting now.'.format(self.caller))
+        self.queue.put(None)
@@ -17,15 +17,22 @@
 # Contact the author via email: ultrabook@email.com
 
 
+import functools
 import itertools
 import logging
 import threading
 import wx
 
 import backend
-from propdialog import PropDialog
+import executor
+import probe
+from dispatcher import Dispatcher, TimeoutError
 from logmonitor import LogMonitor
-from synchronizer import Synchronizer
+from noproxy import compact
+
+
+# Seconds a worker waits for the answer to a question before giving up
+ANSWER_TIMEOUT = 600
 
 
 class GrrFrame(wx.Frame):
@@ -33,6 +40,12 @@ class GrrFrame(wx.Frame):
     def __init__(self, *args, **kwargs):
         super(GrrFrame, self).__init__(*args, **kwargs)
         self.dlg_properties = None
+        # Calls to the GUI from the worker threads
+        self.dispatcher = Dispatcher()
+        # Default noproxy hosts, fetched in the background (see FetchNoProxy)
+        self.noproxy = None
+        self.noproxyevent = threading.Event()
+        self.noproxythread = None
 
         self.pnl_main = wx.PyPanel(self)
         self.stb_proxset = wx.StaticBox(self.pnl_main, label='Proxy Settings')
@@ -72,9 +85,7 @@ class GrrFrame(wx.Frame):
         # Fire up the log monitor
         self.tct_details.Hide()
         self.lmevent = threading.Event()
-        self.lmthread = LogMonitor(threading.current_thread(),
-                                   self.OnUpdateDetails,
-                                   self.lmevent)
+        self.lmthread = LogMonitor(self.OnUpdateDetails, self.lmevent)
 
         self.Bind(wx.EVT_BUTTON, self.OnRemoveProxy, self.btn_removeprox)
         self.Bind(wx.EVT_BUTTON, self.OnProperties, self.btn_properties)
@@ -126,87 +137,111 @@ class GrrFrame(wx.Frame):
             if noproxy:
                 logging.info('Ignoring hosts: {}'.format(', '.join(noproxy)))
         else:
-            user = pwd = useauth = None
-            noproxy = backend.get_noproxy()
+            user = pwd = useauth = noproxy = None
 
         # Start the working thread
         work = threading.Thread(target=self.DoApplyProxy,
                                 args=(protos, hosts, ports, user, pwd, noproxy,
-                                      useauth))
+                                      useauth, not self.dlg_properties))
         work.start()
 
-    def DoApplyProxy(self, protos, hosts, ports, user, pwd, noproxy, useauth):
+    def DoApplyProxy(self, protos, hosts, ports, user, pwd, noproxy, useauth,
+                     defaultnoproxy=False):
+        if defaultnoproxy:
+            # Wait for the defaults here rather than in the event loop
+            noproxy = self.GetNoProxy()
+        if noproxy:
+            try:
+                compacted = compact(noproxy)
+            except ValueError as e:
+                logging.error(str(e))
+                logging.info('No settings were applied.')
+                return
+            if compacted != noproxy:
+                logging.info('Compacted the hosts to ignore from {} to {} '
+                             'bytes'.format(len(','.join(noproxy)),
+                                            len(','.join(compacted))))
+            noproxy = compacted
+
+        # Several hosts of a protocol are candidates, use the fastest
+        if any(',' in host for host in hosts):
+            chosen = self.ChooseProxies(protos, hosts, ports, user, pwd)
+            if chosen is None:
+                logging.info('No settings were applied.')
+                return
+            hosts, ports = chosen
 
         # Check before applying....
-        checknames = ('bash', 'environment', 'apt', 'gsettings', 'sudoers')
-        checkfuncs = (backend.check_bash, backend.check_environment,
-                      backend.check_apt, backend.check_gsettings,
-                      backend.check_sudoers)
-        remfuncs = (backend.remove_bash, backend.remove_environment,
-                    backend.remove_apt, backend.remove_gsettings,
-                    backend.remove_sudoers)
+        checkfuncs = {'bash': backend.check_bash,
+                      'environment': backend.check_environment,
+                      'apt': backend.check_apt,
+                      'gsettings': backend.check_gsettings,
+                      'sudoers': backend.check_sudoers}
         found = []
-        remfound = {}
-        for cfunc, name, rfunc in zip(checkfuncs, checknames, remfuncs):
-            logging.info('Checking {}...'.format(name))
-            result = cfunc()
-            if result:
-                found.extend(result)
-                remfound[name] = rfunc
+        results = executor.run(checkfuncs, phase='Checking')
+        errors = executor.errors(results)
+        if errors:
+            logging.error('The following errors occured while checking proxy '
+                          'settings\n{}'.format('\n'.join(str(e)
+                                                           for e in errors)))
+            logging.info('No settings were applied.')
+            return
+        for result in results:
+            if result.result:
+                found.extend(result.result)
 
         # If found any settings, ask for overwrite
         if found:
             message = ('Proxy settings were detected in:\n{}'
                        .format('\n'.join(found)))
             logging.warning(message)
-            warnbox = Synchronizer(wx.MessageBox,
-                                   args=('Some proxy settings were detected '
-                                         'in your system. Do you want to '
-                                         'overwite them?', 'Confirm Overwrite'
-                                         ),
-                                   kwargs={'style': wx.CENTRE |
-                                           wx.ICON_QUESTION | wx.YES_NO})
-            overwrite = warnbox.run()
-            if overwrite == wx.NO:
+            warnbox = self.dispatcher.submit(
+                wx.MessageBox, 'Some proxy settings were detected in your '
+                'system. Do you want to overwite them?', 'Confirm Overwrite',
+                style=wx.CENTRE | wx.ICON_QUESTION | wx.YES_NO)
+            try:
+                overwrite = warnbox.result(timeout=ANSWER_TIMEOUT)
+            except TimeoutError:
+                warnbox.cancel()
+                logging.info('No answer was given. No settings were applied.')
+                return
+            except Exception as e:
+                logging.error('Could not ask for overwrite: {}'.format(e))
+                logging.info('No settings were applied.')
+                return
+            if overwrite != wx.YES:
                 logging.info('No settings were applied.')
                 return
             else:
                 logging.warning('Overwriting settings...')
-                for name, rfunc in remfound.items():
-                    logging.info('Removing {}...'.format(name))
-                    rfunc()
 
-        # Catch all the exceptions individually and report later
-        errors = []
-        try:
-            logging.info('Setting bash...')
-            backend.set_bash(protos, hosts, ports, user=user, pwd=pwd,
-                             noproxy=noproxy, useauth=useauth)
-        except Exception as e:
-            errors.append(e)
-        try:
-            logging.info('Setting environment...')
-            backend.set_environment(protos, hosts, ports, user=user, pwd=pwd,
-                                    noproxy=noproxy, useauth=useauth)
-        except Exception as e:
-            errors.append(e)
-        try:
-            logging.info('Setting apt...')
-            backend.set_apt(protos, hosts, ports, user=user, pwd=pwd,
-                            useauth=useauth)
-        except Exception as e:
-            errors.append(e)
-        try:
-            logging.info('Setting gsettings...')
-            backend.set_gsettings(protos, hosts, ports, user=user, pwd=pwd,
-                                  noproxy=noproxy)
-        except Exception as e:
-            errors.append(e)
-        try:
-            logging.info('Setting sudoers...')
-            backend.set_sudoers(protos, noproxy=noproxy)
-        except Exception as e:
-            errors.append(e)
+        # Set the targets concurrently, errors are reported later. Existing
+        # settings are replaced and only the files that differ are written.
+        setfuncs = {'bash': functools.partial(backend.set_bash, protos, hosts,
+                                              ports, user=user, pwd=pwd,
+                                              noproxy=noproxy,
+                                              useauth=useauth),
+                    'environment': functools.partial(backend.set_environment,
+                                                     protos, hosts, ports,
+                                                     user=user, pwd=pwd,
+                                                     noproxy=noproxy,
+                                                     useauth=useauth),
+                    'apt': functools.partial(backend.set_apt, protos, hosts,
+                                             ports, user=user, pwd=pwd,
+                                             useauth=useauth),
+                    'gsettings': functools.partial(backend.set_gsettings,
+                                                   protos, hosts, ports,
+                                                   user=user, pwd=pwd,
+                                                   noproxy=noproxy),
+                    'sudoers': functools.partial(backend.set_sudoers, protos,
+                                                 noproxy=noproxy)}
+        with backend.transaction() as trans:
+            results = executor.run(setfuncs, phase='Setting')
+        _log_snapshot(trans)
+        errors = executor.errors(results)
+        for result in results:
+            if result.result:
+                logging.info('Changed {}'.format(', '.join(result.result)))
 
         # Finalize
         if errors:
@@ -215,14 +250,63 @@ class GrrFrame(wx.Frame):
                           'settings\n{}'.format(errstring))
         else:
             logging.info('Proxy settings were succesfully applied.')
-            okbox = Synchronizer(wx.MessageBox,
-                                 args=('Proxy settings were succesfully '
-                                       'applied. You might have to restart '
-                                       'your browser or any other '
-                                       'applications for changes to take '
-                                       'effect.', 'Settings Applied'),
-                                 kwargs={'style': wx.OK})
-            okbox.run()
+            # Nothing is left to do, the worker does not wait
+            self.dispatcher.submit(wx.MessageBox, 'Proxy settings were '
+                                   'succesfully applied. You might have to '
+                                   'restart your browser or any other '
+                                   'applications for changes to take '
+                                   'effect.', 'Settings Applied', style=wx.OK)
+
+    def ChooseProxies(self, protos, hosts, ports, user, pwd):
+        """
+        Probe the comma separated candidate hosts and return the hosts and
+        ports of the fastest, or None if nothing should be applied. A host
+        without a port gets the port of its protocol.
+        """
+        candidates = {}
+        for proto, field, port in zip(protos, hosts, ports):
+            candidates[proto] = []
+            for host in field.split(','):
+                host, _, hostport = host.strip().rpartition(':')
+                if not host or not hostport.isdigit():
+                    host, hostport = host + _ + hostport, port
+                if host:
+                    candidates[proto].append((host, int(hostport)))
+        logging.info('Probing the proxies...')
+        try:
+            chosen, results = probe.choose(candidates, user=user, pwd=pwd)
+        except probe.UnreachableError as e:
+            logging.warning(str(e))
+            if any(not candidates[p] for p in e.protos):
+                return
+            question = self.dispatcher.submit(
+                wx.MessageBox, 'No proxy could be reached for {}. Do you want '
+                'to apply the first hosts anyway?'.format(
+                    ', '.join(sorted(e.protos))), 'Proxy Unreachable',
+                style=wx.CENTRE | wx.ICON_QUESTION | wx.YES_NO)
+            try:
+                answer = question.result(timeout=ANSWER_TIMEOUT)
+            except TimeoutError:
+                question.cancel()
+                logging.info('No answer was given.')
+                return
+            except Exception as e:
+                logging.error('Could not ask to apply: {}'.format(e))
+                return
+            if answer != wx.YES:
+                return
+            chosen = dict((p, c[0]) for p, c in candidates.items())
+        else:
+            for result in results:
+                logging.info('Proxy {}:{}: {}'.format(
+                    result.host, result.port,
+                    '{:.0f} ms'.format(result.latency * 1000) if result.ok
+                    else result.error))
+        for proto in protos:
+            logging.info('Using {}:{} for {}'.format(chosen[proto][0],
+                                                     chosen[proto][1], proto))
+        return ([chosen[p][0] for p in protos],
+                [chosen[p][1] for p in protos])
 
     def OnUpdateDetails(self, details):
         # Check if the frame and it's attribute exist
@@ -251,12 +335,14 @@ class GrrFrame(wx.Frame):
             self.dlg_properties.Show()
         else:
             logging.debug('Creating properties')
-            self.dlg_properties = PropDialog(self, title='Properties')
+            from propdialog import PropDialog
+            self.dlg_properties = PropDialog(self, title='Properties',
+                                             ighosts=self.GetNoProxy())
             self.dlg_properties.Show()
 
     def OnRemoveProxy(self, event):
         logging.info('Removing proxy settings...')
-        # Show warning (could implement backup facility)
+        # Show warning (the files can be rolled back from a snapshot)
         remove = wx.MessageBox('Are you sure you want to remove proxy '
                                'settings?', 'Confirm Overwrite',
                                style=wx.CENTRE | wx.ICON_QUESTION | wx.YES_NO)
@@ -270,47 +356,55 @@ class GrrFrame(wx.Frame):
             work.start()
 
     def DoRemoveProxy(self):
-        errors = []
-        try:
-            logging.info('Removing bash...')
-            backend.remove_bash()
-        except Exception as e:
-            errors.append(e)
-        try:
-            logging.info('Removing environment...')
-            backend.remove_environment()
-        except Exception as e:
-            errors.append(e)
-        try:
-            logging.info('Removing apt...')
-            backend.remove_apt()
-        except Exception as e:
-            errors.append(e)
-        try:
-            logging.info('Removing gsettings...')
-            backend.remove_gsettings()
-        except Exception as e:
-            errors.append(e)
-        try:
-            logging.info('Removing sudoers...')
-            backend.remove_sudoers()
-        except Exception as e:
-            errors.append(e)
+        remfuncs = {'bash': backend.remove_bash,
+                    'environment': backend.remove_environment,
+                    'apt': backend.remove_apt,
+                    'gsettings': backend.remove_gsettings,
+                    'sudoers': backend.remove_sudoers}
+        with backend.transaction() as trans:
+            results = executor.run(remfuncs, phase='Removing')
+        _log_snapshot(trans)
+        errors = executor.errors(results)
 
         # Finalize
         if errors:
             logging.error('The following errors occured while removing proxy '
-                          'settings\n{}'.format('\n'.join(errors)))
+                          'settings\n{}'.format('\n'.join(str(e)
+                                                       for e in errors)))
         else:
             logging.info('Proxy settings were succesfully removed.')
-            okbox = Synchronizer(wx.MessageBox,
-                                 args=('Proxy settings were succesfully '
-                                       'removed. You might have to restart '
-                                       'your browser or any other '
-                                       'applications for changes to take '
-                                       'effect.', 'Settings Removed'),
-                                 kwargs={'style': wx.OK})
-            okbox.run()
+            # Nothing is left to do, the worker does not wait
+            self.dispatcher.submit(wx.MessageBox, 'Proxy settings were '
+                                   'succesfully removed. You might have to '
+                                   'restart your browser or any other '
+                                   'applications for changes to take '
+                                   'effect.', 'Settings Removed', style=wx.OK)
+
+    def FetchNoProxy(self):
+        """
+        Start fetching the default noproxy hosts in the background.
+        """
+        self.noproxythread = threading.Thread(target=self.DoFetchNoProxy)
+        self.noproxythread.daemon = True
+        self.noproxythread.start()
+
+    def DoFetchNoProxy(self):
+        try:
+            self.noproxy = backend.get_noproxy()
+        except Exception as e:
+            logging.warning('Could not get default noproxy hosts: {}'
+                            .format(e))
+            self.noproxy = []
+        self.noproxyevent.set()
+
+    def GetNoProxy(self):
+        """
+        Return the default noproxy hosts, fetching them if not done yet.
+        """
+        if not self.noproxythread and not self.noproxyevent.is_set():
+            self.DoFetchNoProxy()
+        self.noproxyevent.wait()
+        return self.noproxy
 
     def OnSetFocus(self, event):
         field = event.GetEventObject()
@@ -341,6 +435,7 @@ class GrrFrame(wx.Frame):
 
     def OnClose(self, event):
         logging.info('Closing window...')
+        self.lmthread.stop()
         event.Skip()
 
     def DoLayout(self):
@@ -387,3 +482,9 @@ class GrrFrame(wx.Frame):
         self.pnl_main.SetSizer(sizer_0)
         sizer_0.Fit(self)
         self.Layout()
+
+
+def _log_snapshot(trans):
+    if trans.journal is not None and trans.journal.last is not None:
+        logging.info('Saved snapshot {0}, undo with: grrproxy snapshot '
+                     'rollback {0}'.format(trans.journal.last))
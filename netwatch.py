@@ -0,0 +1,340 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Switching profiles as the network changes.
+
+A Watcher waits for changes of the network, reads the facts describing the
+network it is on (interfaces, addresses, gateways, DNS domains) and picks a
+profile by matching them against rules. Changes often come in bursts (an
+interface going up brings addresses, routes and DNS), so the facts are only
+read once no change has been seen for the debounce delay. The profile is
+only applied (see profiles.use) when the one picked is not the one in use.
+
+Changes are received from the kernel through a netlink socket. For tests, a
+FileSource reads the facts from a JSON file instead and reports a change
+whenever the file is modified.
+
+Rules are a JSON list, matched in order, the first matching rule wins:
+    [{"profile": "office", "match": {"domain": "corp.example.com"}},
+     {"profile": "vpn", "match": {"interface": "tun0"}},
+     {"profile": "home", "match": {"gateway": "192.168.1.1",
+                                   "address": "192.168.1.0/24"}}]
+Each key of "match" is one of interface, address (an address or a CIDR
+network), gateway (idem) or domain (the domain or any subdomain of it). Its
+value is a value or a list of values, any of which must match. All the keys
+must match. A rule without "match" always matches.
+"""
+
+
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import subprocess
+import time
+
+import profiles
+
+
+DEFAULT_DEBOUNCE = 2.0
+
+# Netlink groups of link, address and route changes (linux/rtnetlink.h)
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+
+ROUTES = '/proc/net/route'
+RESOLVCONF = '/etc/resolv.conf'
+
+
+class NetlinkSource(object):
+    """
+    Changes of links, addresses and routes, from the kernel.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR |
+                        RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_IFADDR |
+                        RTMGRP_IPV6_ROUTE))
+        self.sock.setblocking(False)
+        # Written to by interrupt, to wake up wait
+        self.wakeup = os.pipe()
+
+    def wait(self, timeout=None):
+        """
+        Wait for changes for at most 'timeout' seconds (default: no limit).
+        Return True if any were received.
+        """
+        try:
+            ready = select.select([self.sock, self.wakeup[0]], [], [],
+                                  timeout)[0]
+        except select.error as e:
+            # Interrupted by a signal
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if self.wakeup[0] in ready:
+            os.read(self.wakeup[0], 512)
+            return False
+        if not ready:
+            return False
+        # The messages only tell that something changed
+        try:
+            while self.sock.recv(65536):
+                pass
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return True
+
+    def facts(self):
+        return system_facts()
+
+    def interrupt(self):
+        """
+        Make the current (or next) wait return.
+        """
+        os.write(self.wakeup[1], b'x')
+
+    def close(self):
+        self.sock.close()
+        for fd in self.wakeup:
+            os.close(fd)
+
+
+class FileSource(object):
+    """
+    Facts read from a JSON file, changed whenever the file is modified. The
+    file is polled every 'interval' seconds.
+    """
+
+    def __init__(self, filename, interval=0.1):
+        self.filename = filename
+        self.interval = interval
+        self.key = self._key()
+        self.interrupted = False
+
+    def _key(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            key = self._key()
+            if key != self.key:
+                self.key = key
+                return True
+            if self.interrupted:
+                self.interrupted = False
+                return False
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(self.interval if deadline is None else
+                       max(min(self.interval, deadline - time.time()), 0))
+
+    def facts(self):
+        try:
+            with open(self.filename, 'r') as fil:
+                facts = json.load(fil)
+        except (IOError, ValueError) as e:
+            logging.warning('Could not read network facts: {}'.format(e))
+            return {}
+        return facts if isinstance(facts, dict) else {}
+
+    def interrupt(self):
+        self.interrupted = True
+
+    def close(self):
+        pass
+
+
+def system_facts():
+    """
+    Return the facts of the network this host is on: the interfaces with a
+    default route, the addresses of the host, the default gateways and the
+    DNS search domains.
+    """
+    facts = {'interfaces': [], 'addresses': [], 'gateways': [],
+             'domains': []}
+    try:
+        with open(ROUTES, 'r') as fil:
+            for line in fil.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 2 and fields[1] == '00000000':
+                    facts['interfaces'].append(fields[0])
+                    facts['gateways'].append(socket.inet_ntoa(
+                        struct.pack('<I', int(fields[2], 16))))
+    except (IOError, ValueError):
+        pass
+    try:
+        output = subprocess.check_output(['ip', '-o', 'addr', 'show'])
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) > 3 and fields[2] in ('inet', 'inet6'):
+                facts['addresses'].append(fields[3].split('/')[0])
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    try:
+        with open(RESOLVCONF, 'r') as fil:
+            for line in fil:
+                fields = line.split()
+                if fields and fields[0] in ('domain', 'search'):
+                    facts['domains'].extend(fields[1:])
+    except IOError:
+        pass
+    return facts
+
+
+def match(rules, facts):
+    """
+    Return the profile of the first rule matching the facts, or None.
+    """
+    for rule in rules:
+        conditions = rule.get('match') or {}
+        if all(_matches(key, values, facts)
+               for key, values in conditions.items()):
+            return rule['profile']
+
+
+def _matches(key, values, facts):
+    if not isinstance(values, list):
+        values = [values]
+    if key == 'interface':
+        return any(v in facts.get('interfaces', ()) for v in values)
+    if key == 'domain':
+        domains = [d.lower().rstrip('.') for d in facts.get('domains', ())]
+        return any(d == v.lower() or d.endswith('.' + v.lower())
+                   for v in values for d in domains)
+    if key in ('address', 'gateway'):
+        addresses = facts.get(key + 'es' if key == 'address' else 'gateways',
+                              ())
+        return any(_in_network(a, v) for v in values for a in addresses)
+    raise ValueError('Unknown rule condition: {}'.format(key))
+
+
+def _in_network(address, network):
+    """
+    Return True if the address is the network (an address or an IPv4 CIDR
+    network) or is within it.
+    """
+    if '/' not in network:
+        return address == network
+    base, _, bits = network.partition('/')
+    try:
+        mask = (0xffffffff << (32 - int(bits))) & 0xffffffff
+        value = struct.unpack('!I', socket.inet_aton(address))[0]
+        start = struct.unpack('!I', socket.inet_aton(base))[0]
+    except (socket.error, ValueError):
+        return False
+    return value & mask == start & mask
+
+
+def load_rules(filename):
+    """
+    Return the rules of the JSON file. Raises ValueError if they are invalid.
+    """
+    with open(filename, 'r') as fil:
+        rules = json.load(fil)
+    if not isinstance(rules, list) or not all(
+            isinstance(r, dict) and 'profile' in r for r in rules):
+        raise ValueError('Rules must be a list of objects with a profile')
+    return rules
+
+
+class Watcher(object):
+
+    def __init__(self, source, rules, debounce=DEFAULT_DEBOUNCE,
+                 apply=profiles.use):
+        """
+        'source' gives the changes and facts of the network (NetlinkSource
+        or FileSource).
+        'rules' are the rules picking profiles (see match).
+        'debounce' is the time in seconds without changes after which the
+        network is considered settled.
+        'apply' is called with the name of a profile to switch to it.
+        """
+        self.source = source
+        self.rules = rules
+        self.debounce = debounce
+        self.apply = apply
+        self.chosen = None
+        self.switches = 0
+        self.stopped = False
+
+    def check(self):
+        """
+        Pick the profile of the network and apply it if it is not in use.
+        Return True if it was applied.
+        """
+        name = match(self.rules, self.source.facts())
+        if name is None:
+            logging.info('No rule matches the network, keeping the settings')
+            return False
+        if self.chosen is None:
+            self.chosen = profiles.current()
+        if name == self.chosen:
+            logging.debug('Profile {} is already in use'.format(name))
+            return False
+        logging.info('Switching to profile {}...'.format(name))
+        self.apply(name)
+        self.chosen = name
+        self.switches += 1
+        return True
+
+    def run(self):
+        """
+        Check the network, then again after each burst of changes, until
+        stopped.
+        """
+        self._check()
+        while not self.stopped:
+            if not self.source.wait():
+                continue
+            # Wait until the network settles
+            while not self.stopped and self.source.wait(self.debounce):
+                pass
+            if not self.stopped:
+                self._check()
+
+    def _check(self):
+        # A failed switch is retried on the next change
+        try:
+            self.check()
+        except Exception as e:
+            logging.error('Could not switch profiles: {}'.format(e))
+
+    def stop(self):
+        """
+        Stop running. May be called from another thread or a signal handler.
+        """
+        self.stopped = True
+        self.source.interrupt()
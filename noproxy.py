@@ -0,0 +1,408 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Matching hosts against the no_proxy list.
+
+A Matcher compiles the list once and then tells whether a host bypasses the
+proxy. Entries are read as curl and wget read them, with the wildcards of the
+GNOME ignore-hosts:
+
+    *                   every host
+    example.com         example.com and its subdomains
+    .example.com        the same (the subdomains only, for Go)
+    *.example.com       the subdomains of example.com only
+    10.0.0.0/8          the addresses of the network, IPv4 or IPv6
+    192.168.1.1, ::1    the address only
+    192.168.*           the same as 192.168.0.0/16
+    ci-?.example, *db*  the hosts matching the pattern (see fnmatch)
+
+A port (host:port) is ignored and IPv6 addresses may be in brackets. Case and
+a trailing dot do not matter.
+
+Domains are kept in a trie of their labels, last label first, and networks
+in sorted, merged intervals, so that the time of a lookup does not depend on
+the length of the list. A pattern is kept in the trie under the labels it
+ends with, and only tried on the hosts ending with them. The answers for the
+latest hosts are cached, as the same hosts are looked up again and again.
+
+Long lists are compacted before they are written (see compact), as every
+process started copies no_proxy and NO_PROXY along with its environment.
+"""
+
+
+import bisect
+import collections
+import fnmatch
+import re
+import socket
+import struct
+
+
+# The kinds of entries
+ALL = 'all'
+DOMAIN = 'domain'
+SUBDOMAINS = 'subdomains'
+NETWORK = 'network'
+PATTERN = 'pattern'
+
+# Keys of the trie nodes for the domain and its subdomains, its subdomains
+# only and the patterns ending with it. Labels are strings, so they cannot be
+# confused with them.
+_MATCHES = 0
+_BELOW = 1
+_PATTERNS = 2
+# Key of the subdomains listed with a leading dot, only used by compact
+_DOTTED = 3
+
+# Largest number of answers cached
+CACHE_SIZE = 4096
+
+# Bits of the addresses of each family
+BITS = {socket.AF_INET: 32, socket.AF_INET6: 128}
+
+# 'value' is the domain for DOMAIN and SUBDOMAINS, (family, address, prefix)
+# for NETWORK, the lowercase pattern for PATTERN and None for ALL
+Entry = collections.namedtuple('Entry', 'kind value')
+
+_IPV4_WILDCARD = re.compile(r'(\d{1,3}\.){1,3}\*$')
+
+
+def parse(entry):
+    """
+    Return the Entry of a no_proxy entry, or None if it is empty.
+
+    Raises ValueError if it is a malformed network.
+    """
+    text = _strip(entry.strip().lower())
+    if not text:
+        return
+    if text == '*':
+        return Entry(ALL, None)
+    if _IPV4_WILDCARD.match(text):
+        octets = text.count('.')
+        text = '{}{}/{}'.format(text[:-1], '.'.join('0' * (4 - octets)),
+                                8 * octets)
+
+    address, slash, prefix = text.partition('/')
+    parsed = address_value(address)
+    if parsed is not None:
+        family, value = parsed
+        bits = BITS[family]
+        if slash:
+            if not prefix.isdigit() or int(prefix) > bits:
+                raise ValueError('Invalid network: {}'.format(entry))
+            prefix = int(prefix)
+        else:
+            prefix = bits
+        # Host bits are ignored, as curl does
+        value &= ~((1 << (bits - prefix)) - 1)
+        return Entry(NETWORK, (family, value, prefix))
+    if slash:
+        raise ValueError('Invalid network: {}'.format(entry))
+
+    if _wild(text):
+        if text.startswith('*.') and not _wild(text[2:]):
+            kind, text = SUBDOMAINS, text[2:]
+        else:
+            return Entry(PATTERN, text)
+    else:
+        kind = DOMAIN
+    text = text.strip('.')
+    return Entry(kind, text) if text else None
+
+
+def address_value(text):
+    """
+    Return the (family, integer value) of an IP address, or None if the
+    text is not one.
+    """
+    family = socket.AF_INET6 if ':' in text else socket.AF_INET
+    try:
+        packed = socket.inet_pton(family, text)
+    except (socket.error, ValueError):
+        return
+    if family == socket.AF_INET:
+        return family, struct.unpack('!I', packed)[0]
+    high, low = struct.unpack('!QQ', packed)
+    return family, high << 64 | low
+
+
+class Matcher(object):
+
+    def __init__(self, entries=()):
+        """
+        'entries' are the no_proxy entries, malformed networks raise
+        ValueError (see parse).
+        """
+        self.all = False
+        self.domains = {}
+        self.networks = {}
+        self.cache = {}
+
+        patterns = collections.defaultdict(list)
+        ranges = collections.defaultdict(list)
+        for entry in entries:
+            parsed = parse(entry)
+            if parsed is None:
+                continue
+            kind, value = parsed
+            if kind == ALL:
+                self.all = True
+            elif kind == DOMAIN:
+                self._node(value)[_MATCHES] = True
+            elif kind == SUBDOMAINS:
+                self._node(value)[_BELOW] = True
+            elif kind == NETWORK:
+                family, start, prefix = value
+                size = 1 << (BITS[family] - prefix)
+                ranges[family].append((start, start + size - 1))
+            else:
+                patterns[_literal_suffix(value)].append(
+                    fnmatch.translate(value))
+
+        for family, spans in ranges.items():
+            self.networks[family] = _merged(spans)
+        for suffix, regexes in patterns.items():
+            self._node(suffix)[_PATTERNS] = re.compile('|'.join(regexes))
+
+    def __contains__(self, host):
+        return self.bypass(host)
+
+    def bypass(self, host):
+        """
+        Return True if connections to the host do not go through the proxy.
+        'host' is a domain name or an IP address, without a port.
+        """
+        answer = self.cache.get(host)
+        if answer is None:
+            answer = self.all or self._bypass(host.lower().rstrip('.'))
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
+            self.cache[host] = answer
+        return answer
+
+    def _bypass(self, host):
+        # Addresses end with a digit (IPv4) or contain colons (IPv6). Those
+        # not in the networks may still match a pattern, as the domains do.
+        if ':' in host or host[-1:].isdigit():
+            host = host.strip('[]')
+            address = address_value(host)
+            if address is not None:
+                family, value = address
+                intervals = self.networks.get(family)
+                if intervals is not None:
+                    starts, ends = intervals
+                    i = bisect.bisect_right(starts, value) - 1
+                    if i >= 0 and value <= ends[i]:
+                        return True
+
+        node = self.domains
+        patterns = None
+        for label in reversed(host.split('.')):
+            if _BELOW in node:
+                return True
+            if _PATTERNS in node:
+                patterns = (patterns or []) + [node[_PATTERNS]]
+            node = node.get(label)
+            if node is None:
+                break
+            if _MATCHES in node:
+                return True
+        else:
+            if _PATTERNS in node:
+                patterns = (patterns or []) + [node[_PATTERNS]]
+        if patterns:
+            return any(p.match(host) for p in patterns)
+        return False
+
+    def _node(self, domain):
+        node = self.domains
+        if domain:
+            for label in reversed(domain.split('.')):
+                node = node.setdefault(label, {})
+        return node
+
+
+def compact(entries):
+    """
+    Return the entries without those that change nothing: duplicates, the
+    entries within another one listed and the empty entries. Networks which
+    overlap or are adjacent are merged into as few as possible, after the
+    other entries. Single addresses are kept as they are, for the programs
+    that do not read networks.
+
+    An entry is only dropped for one matching every host it matches, for
+    every program: a leading dot matches the subdomains alone (as Go and
+    wget read it) and an entry with a port matches that port alone (as the
+    programs reading ports do). Of equivalent entries, the one without a
+    dot or a port is kept, whatever their order.
+
+    Raises ValueError if an entry is a malformed network.
+    """
+    # (entry, value, dotted, port) of each entry
+    parsed = []
+    for entry in entries:
+        value = parse(entry)
+        if value is not None:
+            entry = entry.strip()
+            text = entry.lower()
+            dotted = value.kind == DOMAIN and _strip(text).startswith('.')
+            parsed.append((entry, value, dotted, _port(text)))
+    if any(value.kind == ALL and not port for _, value, _, port in parsed):
+        return ['*']
+
+    def rank(i):
+        # Plain forms first, then the shortest
+        entry, value, dotted, port = parsed[i]
+        return (bool(port), dotted, len(entry), entry)
+
+    # Check the domains from the shortest, each against those kept before. A
+    # domain is covered at its own node by a mark of its kind or a wider one:
+    # the domain, then its subdomains with a leading dot, then with '*.'.
+    # Entries with a port cover nothing.
+    marks = (_MATCHES, _DOTTED, _BELOW)
+
+    def width(i):
+        _, value, dotted, _ = parsed[i]
+        return 2 if value.kind == SUBDOMAINS else 1 if dotted else 0
+
+    trie = {}
+    covered = set()
+    domains = [i for i, (_, value, _, _) in enumerate(parsed)
+               if value.kind in (DOMAIN, SUBDOMAINS)]
+    domains.sort(key=lambda i: (parsed[i][1].value.count('.'),
+                                bool(parsed[i][3]), width(i), rank(i)))
+    for i in domains:
+        _, (_, domain), _, port = parsed[i]
+        labels = domain.split('.')[::-1]
+        last = len(labels) - 1
+        node = trie
+        for depth, label in enumerate(labels):
+            node = node.setdefault(label, {})
+            if any(mark in node for mark in
+                   (marks if depth < last else marks[:width(i) + 1])):
+                covered.add(i)
+                break
+        else:
+            if not port:
+                node[marks[width(i)]] = True
+
+    # The best of the equivalent entries left, in the order given
+    best = {}
+    networks = collections.defaultdict(list)
+    for i, (entry, value, dotted, port) in enumerate(parsed):
+        if (value.kind == NETWORK and not port and
+                value.value[2] < BITS[value.value[0]]):
+            family, start, prefix = value.value
+            size = 1 << (BITS[family] - prefix)
+            networks[family].append((start, start + size - 1))
+        elif i not in covered:
+            key = (value, dotted, port)
+            if key not in best or rank(i) < rank(best[key]):
+                best[key] = i
+    kept = [parsed[i][0] for i in sorted(
+        i for (value, dotted, port), i in best.items()
+        if not (port and (value, dotted, '') in best))]
+    for family in sorted(networks):
+        starts, ends = _merged(networks[family])
+        for start, end in zip(starts, ends):
+            kept.extend(_cidrs(family, start, end))
+    return kept
+
+
+def _cidrs(family, start, end):
+    """
+    Return the fewest networks covering the addresses from start to end.
+    """
+    bits = BITS[family]
+    cidrs = []
+    while start <= end:
+        # The largest aligned block starting here and not going past the end
+        size = start & -start or 1 << bits
+        while size > end - start + 1:
+            size >>= 1
+        prefix = bits - size.bit_length() + 1
+        cidrs.append('{}/{}'.format(address_text(family, start), prefix))
+        start += size
+    return cidrs
+
+
+def address_text(family, value):
+    """
+    Return the text of the integer value of an IP address.
+    """
+    if family == socket.AF_INET:
+        packed = struct.pack('!I', value)
+    else:
+        packed = struct.pack('!QQ', value >> 64, value & (1 << 64) - 1)
+    return socket.inet_ntop(family, packed)
+
+
+def _literal_suffix(pattern):
+    """
+    Return the labels a pattern ends with that have no wildcards.
+    """
+    labels = pattern.split('.')
+    i = len(labels)
+    while i > 0 and not _wild(labels[i - 1]):
+        i -= 1
+    return '.'.join(labels[i:])
+
+
+def _merged(spans):
+    """
+    Return the lists of starts and ends of the sorted, merged spans.
+    """
+    starts, ends = [], []
+    for start, end in sorted(spans):
+        if ends and start <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return starts, ends
+
+
+def _strip(text):
+    """
+    Return the host of an entry without the brackets of an IPv6 address or
+    a port.
+    """
+    if text.startswith('['):
+        return text[1:].partition(']')[0]
+    host, colon, port = text.rpartition(':')
+    if colon and ':' not in host and (port.isdigit() or not port):
+        return host
+    return text
+
+
+def _port(text):
+    """
+    Return the port of an entry, or '' if it has none.
+    """
+    if text.startswith('['):
+        port = text.partition(']')[2]
+        return port[1:] if port[:1] == ':' and port[1:].isdigit() else ''
+    host, colon, port = text.rpartition(':')
+    return port if colon and ':' not in host and port.isdigit() else ''
+
+
+def _wild(text):
+    return '*' in text or '?' in text or '[' in text
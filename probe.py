@@ -0,0 +1,284 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Proxy health probes.
+
+Checks that proxies accept connections, all of them at once, within a strict
+time limit. A probe connects to the proxy over TCP and, optionally, asks it
+to open a tunnel with an HTTP CONNECT request, which shows that the proxy
+actually relays (and accepts the credentials). The latency of a probe is the
+time until the proxy has answered.
+
+The probes run concurrently in a single thread: the sockets are
+non-blocking and waited on with select. Host names are resolved by a thread
+each beforehand, within the same time limit.
+"""
+
+
+import base64
+import collections
+import errno
+import select
+import socket
+import threading
+import time
+
+
+DEFAULT_TIMEOUT = 2.0
+
+# Target of the CONNECT requests
+DEFAULT_TARGET = 'example.com:443'
+
+ProbeResult = collections.namedtuple('ProbeResult',
+                                     'host port ok latency error')
+
+
+class _Probe(object):
+    """
+    State of the probe of one endpoint.
+    """
+
+    def __init__(self, host, port, request):
+        self.host = host
+        self.port = int(port)
+        self.request = request
+        self.sock = None
+        self.sent = 0
+        self.response = b''
+        self.result = None
+        self.start = None
+
+    def finish(self, error=None):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        latency = None if error else time.time() - self.start
+        self.result = ProbeResult(self.host, self.port, not error, latency,
+                                  error)
+
+
+def probe(endpoints, timeout=DEFAULT_TIMEOUT, target=None, user=None,
+          pwd=None):
+    """
+    Probe the endpoints, (host, port) pairs, concurrently. Return their
+    ProbeResults in the same order.
+
+    If 'target' (host:port) is given, a tunnel to it is requested from each
+    proxy with HTTP CONNECT, authenticated with 'user' and 'pwd' if given,
+    and the probe only succeeds if the proxy accepts. Every probe is given
+    up after 'timeout' seconds.
+    """
+    request = _request(target, user, pwd)
+    probes = [_Probe(host, port, request) for host, port in endpoints]
+    _run(probes, timeout)
+    return [p.result for p in probes]
+
+
+def _request(target, user=None, pwd=None):
+    """
+    Return the CONNECT request to the target, or None if there is none.
+    """
+    if not target:
+        return None
+    request = 'CONNECT {0} HTTP/1.1\r\nHost: {0}\r\n'.format(target)
+    if user and pwd:
+        credentials = base64.b64encode('{}:{}'.format(user, pwd))
+        request += 'Proxy-Authorization: Basic {}\r\n'.format(credentials)
+    return (request + '\r\n').encode('ascii')
+
+
+def _run(probes, timeout):
+    """
+    Run the probes until they all have a result or the time is up.
+    """
+    deadline = time.time() + timeout
+    addresses = _resolve(set((p.host, p.port) for p in probes), deadline)
+
+    for p in probes:
+        address = addresses.get((p.host, p.port))
+        if isinstance(address, Exception) or address is None:
+            p.finish('cannot resolve: {}'.format(address or
+                                                        'timed out'))
+            continue
+        family, address = address
+        p.start = time.time()
+        p.sock = socket.socket(family, socket.SOCK_STREAM)
+        p.sock.setblocking(False)
+        code = p.sock.connect_ex(address)
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            p.finish('cannot connect: {}'.format(errno.errorcode.get(
+                code, code)))
+
+    while True:
+        pending = [p for p in probes if p.result is None]
+        if not pending:
+            break
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            for p in pending:
+                p.finish('timed out')
+            break
+        # Connecting and sending wait for writability, reading for data
+        writing = [p.sock for p in pending if p.sent < len(p.request or '')
+                   or p.sent == 0]
+        reading = [p.sock for p in pending if p.sock not in writing]
+        try:
+            readable, writable, _ = select.select(reading, writing, [],
+                                                  remaining)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            continue
+        for p in pending:
+            if p.sock in writable:
+                _write(p)
+            elif p.sock in readable:
+                _read(p)
+
+
+def _write(p):
+    if p.sent == 0:
+        code = p.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if code:
+            p.finish('cannot connect: {}'.format(
+                errno.errorcode.get(code, code)))
+            return
+        if p.request is None:
+            # Connected, nothing more to check
+            p.finish()
+            return
+    try:
+        p.sent += p.sock.send(p.request[p.sent:])
+    except socket.error as e:
+        p.finish('cannot send: {}'.format(e))
+
+
+def _read(p):
+    try:
+        data = p.sock.recv(4096)
+    except socket.error as e:
+        p.finish('cannot receive: {}'.format(e))
+        return
+    p.response += data
+    if not data or b'\r\n' in p.response:
+        status = p.response.split(b'\r\n', 1)[0]
+        fields = status.split(None, 2)
+        if len(fields) < 2 or not fields[0].startswith(b'HTTP/'):
+            p.finish('not an HTTP proxy')
+        elif fields[1] == b'200':
+            p.finish()
+        elif fields[1] == b'407':
+            p.finish('authentication required')
+        else:
+            p.finish('CONNECT refused: {}'.format(status))
+    elif len(p.response) > 8192:
+        p.finish('not an HTTP proxy')
+
+
+def _resolve(endpoints, deadline):
+    """
+    Return the (family, address) of each (host, port), or the exception
+    raised resolving it, or None if it could not be resolved in time.
+    """
+    addresses = {}
+
+    def resolve(host, port):
+        try:
+            info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            addresses[(host, port)] = (info[0][0], info[0][4])
+        except socket.error as e:
+            addresses[(host, port)] = e
+
+    threads = []
+    for host, port in endpoints:
+        thread = threading.Thread(target=resolve, args=(host, port))
+        # Left behind if it does not finish in time
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+    return dict(addresses)
+
+
+def fastest(candidates, timeout=DEFAULT_TIMEOUT, target=DEFAULT_TARGET,
+            user=None, pwd=None):
+    """
+    Return the fastest reachable candidate of each protocol, as a
+    ProbeResult, or None if no candidate of the protocol is reachable, along
+    with the results of all the probes.
+
+    'candidates' maps protocols to lists of (host, port). HTTP proxies are
+    asked for a tunnel to 'target' (see probe), SOCKS proxies are only
+    connected to.
+    """
+    # An endpoint is probed once, whichever protocols it is a candidate of
+    request = _request(target, user, pwd)
+    probes = {}
+    for proto, pairs in candidates.items():
+        socks = proto == 'socks'
+        for host, port in pairs:
+            key = (host, int(port), socks)
+            if key not in probes:
+                probes[key] = _Probe(host, port, None if socks else request)
+    _run(list(probes.values()), timeout)
+
+    best = {}
+    for proto, pairs in candidates.items():
+        results = [probes[(h, int(p), proto == 'socks')].result
+                   for h, p in pairs]
+        reachable = [r for r in results if r.ok]
+        best[proto] = (min(reachable, key=lambda r: r.latency) if reachable
+                       else None)
+    return best, [p.result for p in probes.values()]
+
+
+class UnreachableError(Exception):
+    """
+    No candidate of some protocol could be reached.
+    """
+
+    def __init__(self, protos, results):
+        super(UnreachableError, self).__init__(
+            'No reachable proxy for {}: {}'.format(', '.join(sorted(protos)),
+                                                   _describe(results)))
+        self.protos = protos
+        self.results = results
+
+
+def choose(candidates, timeout=DEFAULT_TIMEOUT, target=DEFAULT_TARGET,
+           user=None, pwd=None):
+    """
+    Return the (host, port) of the fastest reachable candidate of each
+    protocol (see fastest), along with the results of all the probes.
+
+    Raises UnreachableError if a protocol has no reachable candidate.
+    """
+    best, results = fastest(candidates, timeout, target, user, pwd)
+    unreachable = [proto for proto, result in best.items() if result is None]
+    if unreachable:
+        raise UnreachableError(unreachable, [r for r in results if not r.ok])
+    return (dict((proto, (r.host, r.port)) for proto, r in best.items()),
+            results)
+
+
+def _describe(results):
+    return ', '.join('{}:{} ({})'.format(r.host, r.port, r.error)
+                     for r in results)
@@ -0,0 +1,213 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Named proxy profiles.
+
+A profile holds a set of proxy settings, saved under the profiles directory
+of the state directory (backend.profilesdir) and rendered ahead of time for
+the targets which can read them from there:
+
+    proxy.sh        The variables, sourced by the bash startup files.
+    credentials.sh  The variables holding the credentials, if any, sourced
+                    by proxy.sh where readable (only by root).
+    apt.conf        The apt configuration, linked from apt.conf.d.
+    settings.json   The settings themselves.
+
+The files holding the password are only readable by root. Other users'
+shells get the variables without the credentials.
+
+A link named 'current' in the state directory points to the profile in use.
+The bash startup files source current/proxy.sh and the apt fragment links to
+current/apt.conf, so switching profiles replaces that one link, atomically,
+rather than rewriting the files. /etc/environment is read by pam_env which
+cannot include other files, so its settings are written (only if they
+differ), along with sudoers and GSettings, in the same step.
+"""
+
+
+import json
+import os
+import re
+import shutil
+
+import backend
+from atomic import Transaction
+
+
+# Files of a profile
+BASHSCRIPT = 'proxy.sh'
+CREDENTIALS = 'credentials.sh'
+APTCONF = 'apt.conf'
+SETTINGS = 'settings.json'
+
+# Names of profiles are also the names of their directories
+NAME = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]*$')
+
+# Targets in the order they are switched, sudoers last (see executor)
+TARGETS = ('bash', 'apt', 'environment', 'gsettings', 'sudoers')
+
+
+def profiledir(name):
+    """
+    Return the directory of the profile.
+
+    Raises ValueError if the name is invalid.
+    """
+    if not NAME.match(name or ''):
+        raise ValueError('Invalid profile name: {!r}'.format(name))
+    return os.path.join(backend.profilesdir, name)
+
+
+def names():
+    """
+    Return the names of the saved profiles.
+    """
+    if not os.path.isdir(backend.profilesdir):
+        return []
+    return sorted(name for name in os.listdir(backend.profilesdir)
+                  if NAME.match(name) and os.path.exists(
+                      os.path.join(backend.profilesdir, name, SETTINGS)))
+
+
+def current():
+    """
+    Return the name of the profile in use, or None.
+    """
+    if not os.path.islink(backend.currentlink):
+        return None
+    return os.path.basename(os.readlink(backend.currentlink))
+
+
+def load(name):
+    """
+    Return the settings of the profile, as keyword arguments of the set
+    functions of backend.
+
+    Raises ValueError if there is no such profile.
+    """
+    filename = os.path.join(profiledir(name), SETTINGS)
+    if not os.path.exists(filename):
+        raise ValueError('No such profile: {}'.format(name))
+    with open(filename, 'r') as fil:
+        return json.load(fil)
+
+
+def save(name, settings, targets=TARGETS):
+    """
+    Save the settings as the profile, replacing it if it exists. If the
+    profile is in use, the targets are updated. Return the changed files.
+
+    'settings' are the keyword arguments of the set functions of backend:
+    protos, hosts, ports, user, pwd, noproxy and useauth.
+    """
+    s = settings
+    dirname = profiledir(name)
+    # Protocols whose proxies are given the credentials
+    authed = [(p, h, port) for p, h, port in
+              zip(s['protos'], s['hosts'], s['ports'])
+              if not s.get('useauth') or p in s['useauth']]
+    secret = bool(s.get('user') and s.get('pwd') and authed)
+    # The script is sourced by every user, so it holds no password
+    script = backend.proxy_lines('export {}="{}"', s['protos'], s['hosts'],
+                                 s['ports'], noproxy=s.get('noproxy'))
+    aptconf = backend.apt_lines(s['protos'], s['hosts'], s['ports'],
+                                user=s.get('user'), pwd=s.get('pwd'),
+                                useauth=s.get('useauth'))
+    files = {APTCONF: '\n'.join(aptconf) + '\n',
+             SETTINGS: json.dumps(settings, indent=1, sort_keys=True) + '\n'}
+    if secret:
+        credentials = backend.proxy_lines('export {}="{}"',
+                                          *zip(*authed), user=s['user'],
+                                          pwd=s['pwd'])
+        files[CREDENTIALS] = '\n'.join(credentials) + '\n'
+        # Read through the current link, as the script itself
+        script.append('[ -r "{0}" ] && . "{0}"'.format(backend.unrooted(
+            os.path.join(backend.currentlink, CREDENTIALS))))
+    files[BASHSCRIPT] = '\n'.join(script) + '\n'
+    # The password is only readable by root
+    modes = {BASHSCRIPT: 0o644, CREDENTIALS: 0o600,
+             APTCONF: 0o600 if secret else 0o644, SETTINGS: 0o600}
+
+    trans = Transaction()
+    for filename, contents in sorted(files.items()):
+        filename = os.path.join(dirname, filename)
+        mode = modes[os.path.basename(filename)]
+        # The mode of an existing file would be kept
+        if os.path.exists(filename):
+            os.chmod(filename, mode)
+        trans.write(filename, contents, mode=mode)
+    changed = [os.path.join(dirname, f) for f in sorted(files)]
+    credentials = os.path.join(dirname, CREDENTIALS)
+    if not secret and os.path.exists(credentials):
+        trans.remove(credentials)
+        changed.append(credentials)
+    trans.commit()
+    if current() == name:
+        changed.extend(use(name, targets))
+    return changed
+
+
+def delete(name):
+    """
+    Delete the profile. The profile in use cannot be deleted.
+    """
+    dirname = profiledir(name)
+    if current() == name:
+        raise ValueError('Profile {} is in use'.format(name))
+    if not os.path.isdir(dirname):
+        raise ValueError('No such profile: {}'.format(name))
+    shutil.rmtree(dirname)
+
+
+def use(name, targets=TARGETS):
+    """
+    Switch to the profile. Return the changed files (and GSettings keys).
+
+    The first switch makes the bash startup files source the current profile
+    and links the apt fragment to it. Later switches replace the current link
+    and only write the settings of the targets which cannot follow it.
+    """
+    s = load(name)
+    changed = []
+    with backend.transaction() as trans:
+        if 'bash' in targets:
+            script = os.path.join(backend.currentlink, BASHSCRIPT)
+            changed.extend(backend.commit(backend.plan_link_bash(script)))
+        if 'apt' in targets:
+            conf = os.path.join(backend.currentlink, APTCONF)
+            changed.extend(backend.commit(backend.plan_link_apt(conf)))
+        # The switch itself
+        if current() != name:
+            trans.symlink(os.path.relpath(profiledir(name), backend.statedir),
+                          backend.currentlink)
+            changed.append(backend.currentlink)
+        if 'environment' in targets:
+            changed.extend(backend.set_environment(
+                s['protos'], s['hosts'], s['ports'], user=s.get('user'),
+                pwd=s.get('pwd'), noproxy=s.get('noproxy'),
+                useauth=s.get('useauth')))
+        if 'gsettings' in targets:
+            changed.extend(backend.set_gsettings(
+                s['protos'], s['hosts'], s['ports'], user=s.get('user'),
+                pwd=s.get('pwd'), noproxy=s.get('noproxy')))
+        if 'sudoers' in targets:
+            changed.extend(backend.set_sudoers(s['protos'],
+                                               noproxy=s.get('noproxy')))
+    return changed
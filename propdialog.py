@@ -19,12 +19,14 @@
 import itertools
 import wx
 
-import backend
-
 
 class PropDialog(wx.Dialog):
 
     def __init__(self, *args, **kwargs):
+        """
+        Keyword argument 'ighosts' is the initial list of hosts to ignore.
+        """
+        ighosts = kwargs.pop('ighosts', ())
         super(PropDialog, self).__init__(*args, **kwargs)
 
         # widgets
@@ -52,7 +54,6 @@ class PropDialog(wx.Dialog):
             widget.SetValue(True)
             widget.Disable()
 
-        ighosts = backend.get_noproxy()
         self.tct_igproxy.AppendText('\n'.join(ighosts))
 
         for widget in self.wid_authtexts:
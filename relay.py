@@ -0,0 +1,828 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Local forwarding proxy.
+
+The relay listens on the local host and forwards the requests of its clients
+to the upstream proxy of their protocol, adding the credentials. The targets
+are given the relay, without credentials, so that only the relay holds them
+(see save_config).
+
+Connections to the upstream proxies are kept open and reused. A plain HTTP
+request is sent over an idle connection of the pool when there is one, and
+the connection goes back to the pool once the response has been read, unless
+either side closes it. A CONNECT tunnel takes a connection from the pool too,
+sparing the handshake, but the connection ends with the tunnel.
+
+A protocol may have several upstream proxies, each with a weight. A new
+request goes to the proxy with the fewest outstanding requests for its
+weight, among those that are healthy. A proxy that fails is ejected, and
+probed again after a delay doubling with each failure (up to MAX_BACKOFF);
+the requests it failed to take are passed to the next proxy.
+
+The statistics of the relay are answered, as JSON, to a GET /stats request
+made to the relay itself rather than through it.
+"""
+
+
+import base64
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+import backend
+import probe
+from atomic import Transaction
+
+
+# Address listened on by default
+DEFAULT_ADDRESS = ('127.0.0.1', 3129)
+
+# Protocols forwarded, SOCKS clients are left to their proxy
+PROTOS = ('http', 'https', 'ftp')
+
+# Idle connections kept per upstream proxy, and for how long (seconds)
+POOL_SIZE = 8
+IDLE_TIMEOUT = 60.0
+
+# Time limit of the reads and writes of a connection (seconds)
+TIMEOUT = 120.0
+
+# Delay before an ejected upstream proxy is probed again, doubled with each
+# failure, and how often they are checked (seconds)
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+HEALTH_INTERVAL = 0.25
+
+# Size of the reads, and largest request or response head
+BUFSIZE = 1 << 16
+MAX_HEAD = 1 << 16
+
+# Headers concerning a single connection, never forwarded
+HOP_HEADERS = frozenset([b'connection', b'keep-alive', b'proxy-connection',
+                         b'proxy-authorization', b'proxy-authenticate', b'te',
+                         b'trailer', b'upgrade'])
+
+
+class ProxyError(Exception):
+    """
+    A request that cannot be forwarded, answered with the status.
+    """
+
+    def __init__(self, status, message):
+        super(ProxyError, self).__init__(message)
+        self.status = status
+
+
+class ClientError(Exception):
+    """
+    A failure reading the request from the client, holding the error (see
+    Relay._exchange). It says nothing of the health of the proxy.
+    """
+
+    def __init__(self, error):
+        super(ClientError, self).__init__(str(error))
+        self.error = error
+
+
+class Stream(object):
+    """
+    Buffered reads from a socket, which leave what is not consumed available
+    to the tunnels.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b''
+
+    def fill(self):
+        """
+        Read more data into the buffer. Return False at the end of the data.
+        """
+        data = self.sock.recv(BUFSIZE)
+        self.buf += data
+        return bool(data)
+
+    def head(self):
+        """
+        Return the lines of the next head, without the empty line ending it,
+        or None if the connection is closed before the head starts.
+        """
+        while True:
+            end = self.buf.find(b'\r\n\r\n')
+            if end >= 0:
+                head, self.buf = self.buf[:end], self.buf[end + 4:]
+                return head.split(b'\r\n')
+            if len(self.buf) > MAX_HEAD:
+                raise ProxyError(431, 'Head too large')
+            if not self.fill():
+                if self.buf.strip():
+                    raise ProxyError(400, 'Incomplete head')
+                return None
+
+    def line(self):
+        while b'\r\n' not in self.buf:
+            if len(self.buf) > MAX_HEAD or not self.fill():
+                raise ProxyError(502, 'Incomplete chunk')
+        line, _, self.buf = self.buf.partition(b'\r\n')
+        return line
+
+    def chunks(self, size):
+        """
+        Yield the next 'size' bytes as they are read.
+        """
+        while size > 0:
+            if not self.buf and not self.fill():
+                raise ProxyError(502, 'Connection closed early')
+            data, self.buf = self.buf[:size], self.buf[size:]
+            size -= len(data)
+            yield data
+
+    def rest(self):
+        """
+        Yield the data until the connection is closed.
+        """
+        while self.buf or self.fill():
+            data, self.buf = self.buf, b''
+            yield data
+
+
+class Upstream(object):
+    """
+    An upstream proxy and its pool of idle connections.
+    """
+
+    def __init__(self, host, port, user=None, pwd=None, weight=1,
+                 size=POOL_SIZE, idle=IDLE_TIMEOUT):
+        self.host = host
+        self.port = int(port)
+        self.weight = weight
+        self.size = size
+        self.idle = idle
+        self.auth = b''
+        if user and pwd:
+            credentials = base64.b64encode(
+                '{}:{}'.format(user, pwd).encode('utf-8'))
+            self.auth = b'Proxy-Authorization: Basic ' + credentials + b'\r\n'
+        self.lock = threading.Lock()
+        self.pool = []
+        self.counts = dict.fromkeys(('connects', 'reuses', 'requests',
+                                     'tunnels', 'errors', 'ejections'), 0)
+        # Requests being served, and the health of the proxy
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected = False
+        self.retry = 0
+
+    def __str__(self):
+        return '{}:{}'.format(self.host, self.port)
+
+    def acquire(self, pooled=True):
+        """
+        Return an idle connection (sock, stream) of the pool, or a new one
+        (always if not 'pooled'), and whether it was reused.
+        """
+        with self.lock:
+            while pooled and self.pool:
+                sock, stream, since = self.pool.pop()
+                # An idle connection with data to read has been closed
+                if (time.time() - since < self.idle and
+                        not select.select([sock], [], [], 0)[0]):
+                    self.counts['reuses'] += 1
+                    return (sock, stream), True
+                sock.close()
+            self.counts['connects'] += 1
+        try:
+            sock = socket.create_connection((self.host, self.port), TIMEOUT)
+        except (socket.error, socket.timeout) as e:
+            self.count('errors')
+            raise ProxyError(502, 'Cannot connect to {}: {}'.format(self, e))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return (sock, Stream(sock)), False
+
+    def release(self, conn, reusable):
+        """
+        Return the connection to the pool, or close it.
+        """
+        sock, stream = conn
+        with self.lock:
+            if reusable and not stream.buf and len(self.pool) < self.size:
+                self.pool.append((sock, stream, time.time()))
+                return
+        sock.close()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def begin(self):
+        with self.lock:
+            self.outstanding += 1
+
+    def end(self):
+        with self.lock:
+            self.outstanding -= 1
+
+    def fail(self):
+        """
+        Eject the proxy until it is probed again, after a delay doubling with
+        each failure in a row.
+        """
+        with self.lock:
+            # Requests sent before the ejection fail along, count them once
+            if self.ejected and time.time() < self.retry:
+                return
+            self.failures += 1
+            if not self.ejected:
+                self.counts['ejections'] += 1
+                logging.warning('Proxy {} failed, ejected'.format(self))
+            self.ejected = True
+            self.retry = time.time() + min(
+                BACKOFF * 2 ** (self.failures - 1), MAX_BACKOFF)
+            pool, self.pool = self.pool, []
+        for sock, _, _ in pool:
+            sock.close()
+
+    def answered(self):
+        """
+        Count a request answered. An ejected proxy is only returned to
+        service by a probe (see recover), requests sent before it was
+        ejected may still be answered.
+        """
+        with self.lock:
+            if not self.ejected:
+                self.failures = 0
+
+    def recover(self):
+        """
+        Return the proxy to service.
+        """
+        with self.lock:
+            if self.ejected:
+                logging.info('Proxy {} is back'.format(self))
+            self.failures = 0
+            self.ejected = False
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts, idle=len(self.pool), weight=self.weight,
+                         outstanding=self.outstanding, ejected=self.ejected)
+        opened = stats['connects'] + stats['reuses']
+        stats['reuse_ratio'] = (float(stats['reuses']) / opened if opened
+                                else None)
+        return stats
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, []
+        for sock, _, _ in pool:
+            sock.close()
+
+
+class Balancer(object):
+    """
+    The upstream proxies of a protocol.
+    """
+
+    def __init__(self, upstreams):
+        self.upstreams = list(upstreams)
+
+    def pick(self, exclude=()):
+        """
+        Return the healthy upstream with the fewest outstanding requests for
+        its weight, or if none is healthy the one probed again the soonest.
+        The request is counted as outstanding until it ends (see
+        Upstream.end). Return None if every upstream is excluded.
+        """
+        upstreams = [u for u in self.upstreams if u not in exclude]
+        if not upstreams:
+            return None
+        healthy = [u for u in upstreams if not u.ejected]
+        if healthy:
+            upstream = min(healthy, key=lambda u: (u.outstanding + 1.0) /
+                           u.weight)
+        else:
+            upstream = min(upstreams, key=lambda u: u.retry)
+        upstream.begin()
+        return upstream
+
+    def acquire(self, exclude=(), pooled=True):
+        """
+        Return an upstream (see pick), a connection to it and whether it was
+        reused (see Upstream.acquire). The other upstreams are tried in turn
+        if it cannot be connected to.
+        """
+        tried = list(exclude)
+        error = ProxyError(502, 'No proxy left to try')
+        while True:
+            upstream = self.pick(tried)
+            if upstream is None:
+                raise error
+            try:
+                conn, reused = upstream.acquire(pooled)
+            except ProxyError as e:
+                upstream.end()
+                upstream.fail()
+                tried.append(upstream)
+                error = e
+                continue
+            return upstream, conn, reused
+
+
+class Relay(object):
+
+    def __init__(self, upstreams, address=DEFAULT_ADDRESS):
+        """
+        'upstreams' maps the protocols to their Balancer. Requests of other
+        protocols go to the HTTP upstreams.
+        """
+        self.upstreams = upstreams
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(tuple(address))
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.clients = 0
+        self.active = 0
+
+    def serve_forever(self):
+        """
+        Serve the clients, each in its own thread, until stopped.
+        """
+        logging.info('Relaying on {}:{}'.format(*self.address))
+        health = threading.Thread(target=self._check_health)
+        health.daemon = True
+        health.start()
+        while not self.stopped.is_set():
+            try:
+                if not select.select([self.sock], [], [], 0.5)[0]:
+                    continue
+                client, _ = self.sock.accept()
+            except (select.error, socket.error) as e:
+                if self.stopped.is_set():
+                    break
+                if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                    continue
+                raise
+            thread = threading.Thread(target=self._serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+        self.sock.close()
+        health.join()
+        for upstream in self.all():
+            upstream.close()
+
+    def stop(self):
+        self.stopped.set()
+
+    def all(self):
+        """
+        Return every upstream proxy, once.
+        """
+        return set(u for b in self.upstreams.values() for u in b.upstreams)
+
+    def balancer(self, proto):
+        balancer = self.upstreams.get(proto) or self.upstreams.get('http')
+        if balancer is None:
+            raise ProxyError(502, 'No proxy for {}'.format(proto))
+        return balancer
+
+    def stats(self):
+        """
+        Return the statistics of the relay and of each upstream proxy.
+        """
+        with self.lock:
+            stats = {'clients': self.clients, 'active': self.active}
+        stats['upstreams'] = dict((str(u), u.stats()) for u in self.all())
+        return stats
+
+    def _check_health(self):
+        """
+        Probe the ejected upstreams once their delay is over.
+        """
+        while not self.stopped.wait(HEALTH_INTERVAL):
+            now = time.time()
+            due = [u for u in self.all() if u.ejected and u.retry <= now]
+            if not due:
+                continue
+            results = probe.probe([(u.host, u.port) for u in due])
+            for upstream, result in zip(due, results):
+                if result.ok:
+                    upstream.recover()
+                else:
+                    upstream.fail()
+
+    def _serve(self, client):
+        with self.lock:
+            self.clients += 1
+            self.active += 1
+        client.settimeout(TIMEOUT)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = Stream(client)
+        try:
+            while True:
+                try:
+                    lines = stream.head()
+                    if lines is None:
+                        break
+                    method, target, version, headers = _request(lines)
+                    if method == b'CONNECT':
+                        self._tunnel(client, stream, target)
+                        break
+                    if target.startswith(b'/'):
+                        keep = self._local(client, target, version, headers)
+                    else:
+                        keep = self._forward(client, stream, method, target,
+                                             version, headers)
+                except ProxyError as e:
+                    _reply(client, e.status, str(e))
+                    break
+                if not keep:
+                    break
+        except (socket.error, socket.timeout) as e:
+            logging.debug('Client connection failed: {}'.format(e))
+        finally:
+            client.close()
+            with self.lock:
+                self.active -= 1
+
+    def _local(self, client, target, version, headers):
+        """
+        Answer a request made to the relay itself.
+        """
+        if target != b'/stats':
+            raise ProxyError(404, 'Not found')
+        body = json.dumps(self.stats(), sort_keys=True).encode('utf-8')
+        keep = _keep_alive(version, headers)
+        client.sendall(b''.join([
+            b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n',
+            b'Content-Length: ', str(len(body)).encode('ascii'), b'\r\n',
+            b'Connection: ', b'keep-alive' if keep else b'close', b'\r\n\r\n',
+            body]))
+        return keep
+
+    def _forward(self, client, stream, method, target, version, headers):
+        """
+        Forward a plain request and its response. Return whether the client
+        connection is kept open.
+        """
+        proto = target.partition(b':')[0].decode('ascii', 'replace').lower()
+        balancer = self.balancer(proto)
+        head = [b' '.join([method, target, version])]
+        head.extend(b': '.join(h) for h in headers
+                    if h[0].lower() not in HOP_HEADERS)
+        head = b'\r\n'.join(head) + b'\r\n'
+        bodyless = _body_length(headers) == 0
+
+        tried = []
+        while True:
+            # A pooled connection may have been closed by the proxy, and a
+            # request with a body cannot be sent again
+            upstream, conn, reused = balancer.acquire(tried, pooled=bodyless)
+            upstream.count('requests')
+            try:
+                status, rversion, rheaders = self._exchange(
+                    conn, head + upstream.auth +
+                    b'Connection: keep-alive\r\n\r\n', stream, headers)
+                break
+            except ClientError as e:
+                conn[0].close()
+                upstream.end()
+                if isinstance(e.error, socket.error):
+                    raise e.error
+                raise ProxyError(400, 'Bad request body: {}'.format(e))
+            except (socket.error, socket.timeout, ProxyError) as e:
+                conn[0].close()
+                upstream.end()
+                upstream.count('errors')
+                # A reused connection may have been closed meanwhile, the
+                # proxy has only failed if a new one fails
+                if not reused:
+                    upstream.fail()
+                    tried.append(upstream)
+                # The body has been consumed, only requests without one can
+                # be sent again
+                if not bodyless:
+                    raise ProxyError(502, 'Proxy {} failed: {}'
+                                     .format(upstream, e))
+        upstream.answered()
+
+        try:
+            length = _body_length(rheaders, method, status)
+            keep = _keep_alive(version, headers) and length is not None
+            reusable = _keep_alive(rversion, rheaders) and length is not None
+            response = [b' '.join(status)]
+            response.extend(b': '.join(h) for h in rheaders
+                            if h[0].lower() not in HOP_HEADERS or
+                            h[0].lower() == b'proxy-authenticate')
+            response.append(b'Connection: ' +
+                            (b'keep-alive' if keep else b'close'))
+            client.sendall(b'\r\n'.join(response) + b'\r\n\r\n')
+            for data in _body(conn[1], rheaders, length):
+                client.sendall(data)
+        except (socket.error, socket.timeout) as e:
+            conn[0].close()
+            upstream.count('errors')
+            raise ProxyError(502, 'Proxy {} failed: {}'.format(upstream, e))
+        except:
+            conn[0].close()
+            raise
+        finally:
+            upstream.end()
+        upstream.release(conn, reusable)
+        return keep
+
+    def _exchange(self, conn, head, stream, headers):
+        """
+        Send the request and return the head of the final response, after
+        forwarding any interim responses. Failures to read the body from the
+        client are raised as ClientErrors.
+        """
+        sock, upstream = conn
+        sock.sendall(head)
+        body = _body(stream, headers, _body_length(headers))
+        while True:
+            try:
+                data = next(body, None)
+            except (socket.error, socket.timeout, ProxyError, ValueError) as e:
+                raise ClientError(e)
+            if data is None:
+                break
+            sock.sendall(data)
+        while True:
+            lines = upstream.head()
+            if lines is None:
+                raise ProxyError(502, 'Proxy closed the connection')
+            status, headers = _response(lines)
+            if not status[1].startswith(b'1'):
+                return status, status[0], headers
+
+    def _tunnel(self, client, stream, target):
+        """
+        Open a tunnel to the target through an upstream proxy and relay the
+        data until either side closes it.
+        """
+        balancer = self.balancer('https')
+        tried = []
+        while True:
+            upstream, (sock, ustream), reused = balancer.acquire(tried)
+            upstream.count('tunnels')
+            try:
+                sock.sendall(b'CONNECT ' + target + b' HTTP/1.1\r\nHost: ' +
+                             target + b'\r\n' + upstream.auth + b'\r\n')
+                lines = ustream.head()
+                if lines is not None:
+                    status, headers = _response(lines)
+                    break
+            except (socket.error, socket.timeout, ProxyError):
+                pass
+            sock.close()
+            upstream.end()
+            upstream.count('errors')
+            # A reused connection may have been closed meanwhile
+            if not reused:
+                upstream.fail()
+                tried.append(upstream)
+        upstream.answered()
+
+        try:
+            if status[1] != b'200':
+                length = _body_length(headers)
+                body = b''.join(_body(ustream, headers, length or 0))
+                client.sendall(b'\r\n'.join([b' '.join(status)] + [
+                    b': '.join(h) for h in headers
+                    if h[0].lower() not in HOP_HEADERS]) +
+                    b'\r\nConnection: close\r\n\r\n' + body)
+                return
+            client.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            _splice(client, stream, sock, ustream)
+        except (socket.error, socket.timeout) as e:
+            logging.debug('Tunnel to {} failed: {}'.format(target, e))
+        finally:
+            sock.close()
+            upstream.end()
+
+
+def _request(lines):
+    parts = lines[0].split()
+    if len(parts) != 3 or not parts[2].startswith(b'HTTP/'):
+        raise ProxyError(400, 'Bad request')
+    return parts[0].upper(), parts[1], parts[2], _headers(lines[1:])
+
+
+def _response(lines):
+    parts = lines[0].split(None, 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        raise ProxyError(502, 'Bad response from the proxy')
+    if len(parts) == 2:
+        parts.append(b'')
+    return parts, _headers(lines[1:])
+
+
+def _headers(lines):
+    headers = []
+    for line in lines:
+        name, colon, value = line.partition(b':')
+        if not colon:
+            raise ProxyError(400, 'Bad header')
+        headers.append((name.strip(), value.strip()))
+    return headers
+
+
+def _header(headers, name):
+    for key, value in headers:
+        if key.lower() == name:
+            return value.lower()
+    return None
+
+
+def _keep_alive(version, headers):
+    tokens = (_header(headers, b'connection') or
+              _header(headers, b'proxy-connection') or b'')
+    if version == b'HTTP/1.0':
+        return b'keep-alive' in tokens
+    return b'close' not in tokens
+
+
+def _body_length(headers, method=None, status=None):
+    """
+    Return the length of the body of a message, -1 if it is chunked, or
+    None if it ends with the connection.
+    """
+    if method == b'HEAD' or (status is not None and status[1] in
+                             (b'204', b'304')):
+        return 0
+    if (_header(headers, b'transfer-encoding') or b'').endswith(b'chunked'):
+        return -1
+    length = _header(headers, b'content-length')
+    if length is not None:
+        if not length.isdigit():
+            raise ProxyError(400, 'Bad Content-Length')
+        return int(length)
+    # Requests without a length have no body
+    return None if status is not None else 0
+
+
+def _body(stream, headers, length):
+    """
+    Yield the body of a message as it is read, unchanged.
+    """
+    if length is None:
+        for data in stream.rest():
+            yield data
+    elif length >= 0:
+        for data in stream.chunks(length):
+            yield data
+    else:
+        while True:
+            line = stream.line()
+            yield line + b'\r\n'
+            size = int(line.partition(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                # Trailers, up to the empty line
+                while True:
+                    line = stream.line()
+                    yield line + b'\r\n'
+                    if not line:
+                        return
+            for data in stream.chunks(size + 2):
+                yield data
+
+
+def _splice(client, cstream, upstream, ustream):
+    """
+    Relay the data between both sockets until either closes.
+    """
+    if cstream.buf:
+        upstream.sendall(cstream.buf)
+    if ustream.buf:
+        client.sendall(ustream.buf)
+    peers = {client: upstream, upstream: client}
+    while True:
+        readable = select.select(list(peers), [], [], TIMEOUT)[0]
+        if not readable:
+            return
+        for sock in readable:
+            data = sock.recv(BUFSIZE)
+            if not data:
+                return
+            peers[sock].sendall(data)
+
+
+def _reply(sock, status, message):
+    body = '{}\n'.format(message).encode('utf-8')
+    try:
+        sock.sendall(b''.join([
+            'HTTP/1.1 {} {}\r\n'.format(status, message).encode('utf-8'),
+            b'Content-Type: text/plain\r\nContent-Length: ',
+            str(len(body)).encode('ascii'),
+            b'\r\nConnection: close\r\n\r\n', body]))
+    except (socket.error, socket.timeout):
+        pass
+
+
+def balancers(settings, upstreams=None):
+    """
+    Return the Balancer of each protocol relayed, from apply settings (see
+    backend.set_bash). 'upstreams' maps protocols to lists of (host, port,
+    weight) replacing the single proxy of the settings. Protocols using the
+    same proxy share its Upstream.
+    """
+    s = settings
+    upstreams = upstreams or {}
+    result, shared = {}, {}
+    for proto, host, port in zip(s['protos'], s['hosts'], s['ports']):
+        if proto not in PROTOS:
+            continue
+        useauth = s.get('useauth')
+        auth = (s.get('user'), s.get('pwd'))
+        if useauth and proto not in useauth:
+            auth = (None, None)
+        members = []
+        for host, port, weight in upstreams.get(proto) or [(host, port, 1)]:
+            key = (host, int(port), weight) + auth
+            if key not in shared:
+                shared[key] = Upstream(host, port, *auth, weight=weight)
+            members.append(shared[key])
+        result[proto] = Balancer(members)
+    return result
+
+
+def relayed(settings, address):
+    """
+    Return the apply settings pointing the relayed protocols at the relay,
+    without credentials.
+    """
+    s = dict(settings)
+    hosts, ports = [], []
+    for proto, host, port in zip(s['protos'], s['hosts'], s['ports']):
+        if proto in PROTOS:
+            host, port = address
+        hosts.append(host)
+        ports.append(port)
+    relayedauth = [p for p in s['protos'] if p not in PROTOS]
+    useauth = s.get('useauth')
+    if useauth:
+        relayedauth = [p for p in relayedauth if p in useauth]
+    if not relayedauth:
+        s['user'] = s['pwd'] = None
+    s.update(hosts=hosts, ports=ports, useauth=relayedauth or None)
+    return s
+
+
+def save_config(settings, address, upstreams=None):
+    """
+    Save the settings of the upstream proxies, the lists of upstreams of the
+    protocols which have several (see balancers) and the address of the
+    relay, readable by root only. Return the filename.
+    """
+    filename = backend.relayconf
+    contents = json.dumps({'address': list(address), 'settings': settings,
+                           'upstreams': upstreams or {}},
+                          indent=1, sort_keys=True) + '\n'
+    trans = Transaction()
+    trans.write(filename, contents.encode('utf-8'), mode=0o600)
+    os.chmod(filename, 0o600)
+    trans.commit()
+    return filename
+
+
+def load_config():
+    """
+    Return the settings of the upstream proxies, the lists of upstreams and
+    the address of the relay (see save_config).
+
+    Raises ValueError if there is no configuration.
+    """
+    try:
+        with open(backend.relayconf, 'r') as fil:
+            config = json.load(fil)
+    except IOError:
+        raise ValueError('No relay configuration: {}'
+                         .format(backend.relayconf))
+    return (config['settings'], config.get('upstreams'),
+            tuple(config['address']))
@@ -0,0 +1,162 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Persistent index of phrase scans.
+
+Every file scanned for phrases is recorded with its stat key (inode, mtime
+and size), a digest of its contents and, for every phrase it was scanned for,
+the offsets of the lines containing it. A file whose stat key is unchanged is
+never read again. When the key changes the contents are hashed, and the
+previous results are reused if the digest still matches.
+
+The index is stored as JSON. Failing to load or save it is not an error, the
+index simply starts empty or stays in memory.
+"""
+
+
+import hashlib
+import json
+import os
+import threading
+
+from scanner import mapfile
+
+
+class ScanIndex(object):
+
+    def __init__(self, path=None, phrases=()):
+        """
+        'path' is the JSON file the index is persisted to. If it is None, the
+        index is kept in memory only.
+        'phrases' are always scanned for along with the requested ones, so
+        that a file is read once for all of them.
+        """
+        self.path = path
+        self.phrases = tuple(phrases)
+        self.entries = None
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def load(self):
+        """
+        Read the index from its path, discarding it if it is unreadable.
+        """
+        self.entries = {}
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as fil:
+                entries = json.load(fil)
+        except (IOError, OSError, ValueError):
+            return
+        if isinstance(entries, dict):
+            self.entries = entries
+
+    def save(self):
+        """
+        Write the index to its path if it has changed since the last save.
+        """
+        with self.lock:
+            if not self.dirty or not self.path:
+                return
+            tmpname = '{}.{}.tmp'.format(self.path, os.getpid())
+            try:
+                dirname = os.path.dirname(self.path)
+                if dirname and not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                with open(tmpname, 'w') as fil:
+                    json.dump(self.entries, fil)
+                os.rename(tmpname, self.path)
+            except (IOError, OSError):
+                return
+            self.dirty = False
+
+    def digest(self, filename, st):
+        """
+        Return the SHA-1 of the contents of the file if it is known for its
+        stat 'st', or None.
+        """
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            entry = self.entries.get(filename)
+        if entry and entry['key'] == [st.st_ino, st.st_mtime, st.st_size]:
+            return entry['digest']
+        return None
+
+    def forget(self, filename):
+        """
+        Drop the entry of the file, so that it is scanned again.
+        """
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            if self.entries.pop(filename, None) is not None:
+                self.dirty = True
+
+    def lookup(self, filename, phrases, scan):
+        """
+        Return a dictionary mapping each phrase to the lines containing it.
+
+        'scan' is called with the mapped contents of the file and the phrases
+        not yet known for it. It must return a dictionary of the same form.
+        Lines are lists of start and end offsets. None is returned if the file
+        does not exist.
+        """
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            entry = self.entries.get(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            with self.lock:
+                if self.entries.pop(filename, None) is not None:
+                    self.dirty = True
+            return None
+        key = [st.st_ino, st.st_mtime, st.st_size]
+        if entry and 'lines' not in entry:
+            # Entry from an older index format
+            entry = None
+
+        if entry and entry['key'] == key:
+            lines = entry['lines']
+            if all(p in lines for p in phrases):
+                return dict((p, lines[p]) for p in phrases)
+
+        # Stat key changed or some phrases are unknown, read the file. The
+        # lock is not held meanwhile, so that other files can be scanned.
+        with mapfile(filename) as buf:
+            digest = hashlib.sha1(buf).hexdigest()
+            if entry and entry['digest'] == digest:
+                lines = dict(entry['lines'])
+            else:
+                lines = {}
+            unknown = [p for p in phrases if p not in lines]
+            if unknown:
+                unknown.extend(p for p in self.phrases
+                               if p not in lines and p not in unknown)
+                for phrase, spans in scan(buf, unknown).items():
+                    lines[phrase] = [list(l) for l in spans]
+        with self.lock:
+            self.entries[filename] = {'key': key, 'digest': digest,
+                                      'lines': lines}
+            self.dirty = True
+        return dict((p, lines[p]) for p in phrases)
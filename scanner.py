@@ -0,0 +1,111 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Single pass multi-phrase scanner.
+
+Files are memory mapped and searched once for all the phrases with a compiled
+alternation, so the file is neither split into lines nor held in memory.
+The result is the offsets of the lines containing each phrase. Offsets are
+byte positions; a line spans from its first character up to and including its
+newline character (if any).
+"""
+
+
+import contextlib
+import mmap
+import re
+
+
+# Compiled patterns, keyed by the phrases they search for
+_patterns = {}
+
+
+@contextlib.contextmanager
+def mapfile(filename):
+    """
+    Memory map the file for reading. Empty files yield an empty string.
+    """
+    with open(filename, 'rb') as fil:
+        try:
+            buf = mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            yield b''
+            return
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+
+def compile_phrases(phrases):
+    """
+    Return a pattern matching any of the phrases.
+    """
+    key = frozenset(phrases)
+    pattern = _patterns.get(key)
+    if pattern is None:
+        # Longer phrases first, so that a phrase is never hidden by its prefix
+        alternatives = sorted(key, key=len, reverse=True)
+        pattern = re.compile(b'|'.join(re.escape(p) for p in alternatives))
+        _patterns[key] = pattern
+    return pattern
+
+
+def scan(buf, phrases):
+    """
+    Return a dictionary mapping each phrase to the lines containing it.
+
+    'buf' is a string or a memory map. Lines are (start, end) offset pairs in
+    ascending order.
+    """
+    pattern = compile_phrases(phrases)
+    lines = dict((p, []) for p in phrases)
+    size = len(buf)
+    pos = 0
+    while pos < size:
+        match = pattern.search(buf, pos)
+        if not match:
+            break
+        start = buf.rfind(b'\n', 0, match.start()) + 1
+        end = buf.find(b'\n', match.end())
+        end = size if end < 0 else end + 1
+        # Only the matched lines are materialised, to sort out the phrases
+        line = buf[start:end]
+        for phrase in phrases:
+            if phrase in line:
+                lines[phrase].append((start, end))
+        pos = end
+    return lines
+
+
+def scan_file(filename, phrases):
+    """
+    Return the lines containing each phrase in the file (see scan).
+    """
+    with mapfile(filename) as buf:
+        return scan(buf, phrases)
+
+
+def merge(lines):
+    """
+    Return the sorted, unique lines of a scan result, for all phrases.
+    """
+    return sorted(set(tuple(l) for spans in lines.values() for l in spans))
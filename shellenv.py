@@ -0,0 +1,382 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Effective proxy variables of bash shells, without running bash.
+
+The startup files are read in the order bash reads them (see set_bash):
+
+    login           /etc/profile, then the first of ~/.bash_profile,
+                    ~/.bash_login and ~/.profile.
+    interactive     /etc/bash.bashrc, then ~/.bashrc.
+    noninteractive  The file named by BASH_ENV.
+
+Every shell starts from the variables of /etc/environment, which pam_env
+sets on login. 'login' is an interactive login shell.
+
+The files are interpreted rather than run: variable assignments, export,
+declare -x, unset, sourcing other files (. or source) and for loops over
+files (the profile.d loop of /etc/profile) are followed; other commands are
+ignored and conditions are assumed to hold, except that the command after
+|| is skipped. Only the lines starting with one of these commands (or with
+if, then, a test...) are parsed, so large files with other contents are
+read quickly.
+
+Paths named in the files are resolved within the root (see backend.rooted).
+"""
+
+
+import collections
+import glob
+import os
+import re
+
+import backend
+import scanner
+
+
+LOGIN = 'login'
+INTERACTIVE = 'interactive'
+NONINTERACTIVE = 'noninteractive'
+SHELLS = (LOGIN, INTERACTIVE, NONINTERACTIVE)
+
+# Files sourced within each other at most (bash has no limit)
+MAX_DEPTH = 32
+
+# Value of a variable, and the file and line which set it (None for HOME)
+Value = collections.namedtuple('Value', 'value filename line')
+
+# Lines which may hold a command that is followed, by the way they start.
+# Searching for the newline first is much faster than a multiline pattern.
+_LINE = (br'[ \t]*(?:(?:if|then|else|elif|do|while|until|!|\{)[ \t]+)*'
+         br'(?:[A-Za-z_][A-Za-z0-9_]*=|(?:export|declare|typeset|readonly|'
+         br'unset|source|for|done|test|fi)\b|[.[][ \t])[^\n]*')
+_FIRSTLINE = re.compile(_LINE)
+_CANDIDATE = re.compile(b'\n' + _LINE)
+
+# Words and control operators of a line
+_TOKEN = re.compile(r'''[ \t]*(?:(?P<op>&&|\|\||[;&|])|(?P<comment>#.*)|'''
+                    r'''(?P<word>(?:[^\s'"\\;&|]|\\.|'[^']*'|'''
+                    r'''"(?:[^"\\]|\\.)*")+))''')
+
+# Parts of a word: quoted strings, escapes, expansions and literal text
+_PART = re.compile(r"""'([^']*)'|"((?:[^"\\]|\\.)*)"|\\(.)|"""
+                   r"""\$\{(\w+)\}|\$(\w+)|([^'"\\$]+|\$)""")
+_QUOTED = re.compile(r'\\([$`"\\])|\$\{(\w+)\}|\$(\w+)')
+
+_ASSIGNMENT = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)=')
+
+# Words opening a command, which do not change what the command does
+_KEYWORDS = frozenset(('if', 'then', 'else', 'elif', 'do', '!', '{'))
+_LOOPS = frozenset(('for', 'while', 'until'))
+
+# An environment line of pam_env
+_ENVLINE = re.compile(br'^[ \t]*(?:export[ \t]+)?([A-Za-z_][A-Za-z0-9_]*)='
+                      br'[ \t]*([^\n]*)', re.M)
+
+
+def resolve(shells=SHELLS, home=None):
+    """
+    Return a dictionary mapping each shell to the proxy variables (those
+    ending in _proxy, in either case) its programs get, as a dictionary of
+    Values.
+
+    'home' is the actual home directory of the user (default: the user's
+    files of the backend).
+    """
+    if home is None:
+        files = backend.UserFiles(backend.bashprofile, backend.bashlogin,
+                                  backend.userprofile, backend.bashenv,
+                                  backend.bashrc)
+        home = backend.home
+    else:
+        files = backend.user_files(home)
+    cache = {}
+    result = {}
+    for shell in shells:
+        interpreter = _Interpreter(home, cache)
+        interpreter.environment(backend.environment)
+        if shell == LOGIN:
+            interpreter.run(backend.profile)
+            interpreter.run(files.supfile)
+        elif shell == INTERACTIVE:
+            interpreter.run(backend.bashbashrc)
+            interpreter.run(files.bashrc)
+        elif shell == NONINTERACTIVE:
+            bashenv = interpreter.variables.get('BASH_ENV')
+            if bashenv is not None and bashenv.value:
+                interpreter.source(bashenv.value)
+        else:
+            raise ValueError('Unknown shell: {}'.format(shell))
+        result[shell] = interpreter.proxies()
+    return result
+
+
+class _Interpreter(object):
+
+    def __init__(self, home, cache):
+        """
+        'cache' holds the commands of the files read, shared by the
+        interpreters of the same files.
+        """
+        self.cache = cache
+        self.variables = {'HOME': Value(
+            os.path.normpath(backend.unrooted(home)), None, None)}
+        self.exported = set(['HOME'])
+        self.reading = []
+
+    def proxies(self):
+        """
+        Return the exported proxy variables, with the line numbers of the
+        lines which set them.
+        """
+        lines = {}
+        result = {}
+        for name in self.exported:
+            value = self.variables.get(name)
+            if value is None or not name.lower().endswith('_proxy'):
+                continue
+            if value.filename is not None:
+                key = value.filename, value.line
+                if key not in lines:
+                    lines[key] = _line_number(*key)
+                value = value._replace(line=lines[key])
+            result[name] = value
+        return result
+
+    def environment(self, filename):
+        """
+        Set the variables of a pam_env environment file. Values are taken
+        literally, without their quotes.
+        """
+        if not os.path.isfile(filename):
+            return
+        with scanner.mapfile(filename) as buf:
+            for match in _ENVLINE.finditer(buf):
+                value = _decode(match.group(2)).strip()
+                if len(value) > 1 and value[0] in '"\'' and (value[-1] ==
+                                                           value[0]):
+                    value = value[1:-1]
+                name = _decode(match.group(1))
+                self.variables[name] = Value(value, filename, match.start())
+                self.exported.add(name)
+
+    def source(self, path):
+        """
+        Run the file at the path within the root, if it is a readable file.
+        """
+        if not os.path.isabs(path):
+            return
+        self.run(backend.rooted(path))
+
+    def run(self, filename):
+        if len(self.reading) >= MAX_DEPTH or filename in self.reading:
+            return
+        commands = self.cache.get(filename)
+        if commands is None:
+            if not os.path.isfile(filename) or not os.access(filename,
+                                                             os.R_OK):
+                return
+            commands = self.cache[filename] = _commands(filename)
+        self.reading.append(filename)
+        try:
+            self._execute(commands, 0, len(commands))
+        finally:
+            self.reading.pop()
+
+    def _execute(self, commands, start, end):
+        pos = start
+        while pos < end:
+            words, offset = commands[pos]
+            pos += 1
+            if words[0] == 'for':
+                body = pos
+                pos = _loop_end(commands, pos, end)
+                if len(words) > 3 and words[2] == 'in':
+                    for item in self._items(words[3:]):
+                        self.variables[words[1]] = Value(item, None, None)
+                        self._execute(commands, body, pos)
+                pos += 1
+            elif words[0] in _LOOPS:
+                # The condition is run as a command, the body once
+                if len(words) > 1:
+                    self._command(words[1:], offset)
+            else:
+                self._command(words, offset)
+
+    def _command(self, words, offset):
+        filename = self.reading[-1]
+        name = words[0]
+        if name in ('.', 'source'):
+            if len(words) > 1:
+                self.source(self.expand(words[1]))
+        elif name in ('export', 'declare', 'typeset', 'readonly'):
+            flags = ''.join(w[1:] for w in words[1:] if w.startswith('-'))
+            export = name == 'export' and 'n' not in flags or 'x' in flags
+            for word in words[1:]:
+                if word.startswith('-'):
+                    continue
+                match = _ASSIGNMENT.match(word)
+                if match:
+                    var = match.group(1)
+                    self.variables[var] = Value(
+                        self.expand(word[match.end():], assignment=True),
+                        filename, offset)
+                else:
+                    var = word
+                if export:
+                    self.exported.add(var)
+                elif name == 'export':
+                    self.exported.discard(var)
+        elif name == 'unset':
+            for word in words[1:]:
+                if not word.startswith('-'):
+                    self.variables.pop(word, None)
+                    self.exported.discard(word)
+        else:
+            assignments = []
+            for word in words:
+                match = _ASSIGNMENT.match(word)
+                if not match:
+                    # Assignments before a command are for the command only
+                    return
+                assignments.append((match.group(1), word[match.end():]))
+            for var, value in assignments:
+                self.variables[var] = Value(
+                    self.expand(value, assignment=True), filename, offset)
+
+    def _items(self, words):
+        for word in words:
+            item = self.expand(word)
+            if '*' in item or '?' in item:
+                matches = sorted(glob.glob(backend.rooted(item)))
+                if matches:
+                    for match in matches:
+                        yield backend.unrooted(match)
+                    continue
+            yield item
+
+    def expand(self, word, assignment=False):
+        """
+        Return the word without its quotes, with the variables (and a
+        leading ~) expanded.
+        """
+        if word.startswith('~') and (len(word) == 1 or word[1] == '/'):
+            word = '${HOME}' + word[1:]
+        parts = []
+        for match in _PART.finditer(word):
+            single, double, escaped, braced, plain, literal = match.groups()
+            if single is not None:
+                parts.append(single)
+            elif double is not None:
+                parts.append(_QUOTED.sub(self._quoted, double))
+            elif escaped is not None:
+                parts.append(escaped)
+            elif literal is not None:
+                parts.append(literal)
+            else:
+                parts.append(self._value(braced or plain))
+        return ''.join(parts)
+
+    def _quoted(self, match):
+        escaped, braced, plain = match.groups()
+        if escaped is not None:
+            return escaped
+        return self._value(braced or plain)
+
+    def _value(self, name):
+        value = self.variables.get(name)
+        return '' if value is None else value.value
+
+
+def _commands(filename):
+    """
+    Return the commands of the file which may be followed, as (words,
+    offset) pairs, the words still quoted. Commands after || are left out.
+    """
+    commands = []
+    with scanner.mapfile(filename) as buf:
+        for match in _candidates(buf):
+            offset = match.start()
+            line = _decode(match.group())
+            words = []
+            skip = False
+            pos = 0
+            while pos < len(line):
+                token = _TOKEN.match(line, pos)
+                # An unterminated quote continues on the next lines
+                if token is None or token.end() == pos:
+                    break
+                pos = token.end()
+                op, comment, word = token.group('op', 'comment', 'word')
+                if comment is not None:
+                    break
+                if word is not None:
+                    words.append(word)
+                    continue
+                _append(commands, words, offset, skip)
+                words = []
+                skip = op == '||'
+            _append(commands, words, offset, skip)
+    return commands
+
+
+def _candidates(buf):
+    match = _FIRSTLINE.match(buf)
+    if match:
+        yield match
+    for match in _CANDIDATE.finditer(buf):
+        # Without the newline
+        yield _FIRSTLINE.match(buf, match.start() + 1)
+
+
+def _append(commands, words, offset, skip):
+    while words and words[0] in _KEYWORDS:
+        words = words[1:]
+    if not words or skip and words[0] not in _LOOPS and words[0] != 'done':
+        return
+    commands.append((words, offset))
+
+
+def _loop_end(commands, start, end):
+    """
+    Return the position of the done closing the loop starting at 'start'.
+    """
+    depth = 0
+    for pos in range(start, end):
+        word = commands[pos][0][0]
+        if word in _LOOPS:
+            depth += 1
+        elif word == 'done':
+            if not depth:
+                return pos
+            depth -= 1
+    return end
+
+
+def _line_number(filename, offset):
+    with scanner.mapfile(filename) as buf:
+        line = 1
+        for pos in range(0, offset, 1 << 16):
+            line += buf[pos:min(offset, pos + (1 << 16))].count(b'\n')
+        return line
+
+
+def _decode(data):
+    return data.decode('utf-8', 'replace')
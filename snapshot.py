@@ -0,0 +1,313 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Snapshots of the files changed, and their rollback.
+
+A transaction given a Journal (see atomic.Transaction) records the state of
+each file before it first changes it: its contents, mode and owner, the
+target of a link, or that it did not exist. Contents are kept in a store of
+blobs named by their digest, so that identical contents are kept once,
+whatever the number of transactions. A file about to be replaced or removed
+is hard linked into the store rather than copied: the transaction renames a
+new file over it or unlinks it, so the old file is left as it was, held by
+the store alone.
+
+When the transaction is committed, its log is written: the files and their
+previous states. Rolling a transaction back restores these states, within a
+new transaction which may itself be rolled back. gc removes the old logs and
+the blobs no log refers to anymore.
+
+A journal holds a shared lock on the store from the first file it records
+until its log is written, and gc holds an exclusive one: the blobs of a
+transaction in flight, which no log refers to yet, are not collected.
+
+    <store>/blobs/<digest[:2]>/<digest>
+    <store>/log/<id>.json
+    <store>/lock
+"""
+
+
+import binascii
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+from scanner import mapfile
+
+
+# Logs kept by gc by default
+KEEP = 100
+
+# Kinds of previous states
+FILE = 'file'
+LINK = 'link'
+ABSENT = 'absent'
+
+
+class Journal(object):
+
+    def __init__(self, store, digest=None):
+        """
+        'store' is the directory of the blobs and logs. 'digest' is called
+        with a filename and its stat to get the SHA-1 of its contents if it
+        is already known (see ScanIndex.digest), or None.
+        """
+        self.store = os.path.abspath(store)
+        self.digest = digest
+        self.lock = threading.Lock()
+        self.files = {}
+        self.last = None
+        # Shared lock on the store, while states are recorded
+        self.lockfd = None
+
+    def record(self, filename):
+        """
+        Record the state of the file unless it has been recorded already.
+        """
+        filename = os.path.abspath(filename)
+        if filename.startswith(self.store + os.sep):
+            return
+        with self.lock:
+            if self.lockfd is None:
+                self.lockfd = _lock(self.store, fcntl.LOCK_SH)
+            if filename not in self.files:
+                self.files[filename] = self._state(filename)
+
+    def save(self, trans):
+        """
+        Write the log of the states recorded, if any, and start anew. The
+        directories written are synced along with those of the transaction.
+        """
+        with self.lock:
+            files, self.files = self.files, {}
+            lockfd, self.lockfd = self.lockfd, None
+        try:
+            if files:
+                self._save(trans, files)
+        finally:
+            if lockfd is not None:
+                os.close(lockfd)
+
+    def _save(self, trans, files):
+        txnid = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S', time.gmtime()),
+                               binascii.hexlify(os.urandom(3)).decode())
+        logdir = os.path.join(self.store, 'log')
+        _makedirs(logdir)
+        log = {'id': txnid, 'time': time.time(), 'files': files}
+        fd, tmpname = tempfile.mkstemp(dir=logdir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as fil:
+            json.dump(log, fil, indent=1, sort_keys=True)
+            fil.flush()
+            os.fsync(fil.fileno())
+        os.rename(tmpname, os.path.join(logdir, txnid + '.json'))
+        trans._touch(logdir)
+        for state in files.values():
+            if state['kind'] == FILE:
+                trans._touch(os.path.dirname(self._blob(state['blob'])))
+        self.last = txnid
+
+    def _state(self, filename):
+        try:
+            st = os.lstat(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {'kind': ABSENT}
+        if stat.S_ISLNK(st.st_mode):
+            return {'kind': LINK, 'target': os.readlink(filename)}
+        digest = self.digest and self.digest(filename, st)
+        # A digest known by the stat alone may be stale, it is only trusted
+        # if its blob holds the contents already
+        if digest and not _holds(self._blob(digest), filename, st):
+            digest = None
+        if not digest:
+            with mapfile(filename) as buf:
+                digest = hashlib.sha1(buf).hexdigest()
+        blob = self._blob(digest)
+        if not os.path.exists(blob):
+            _makedirs(os.path.dirname(blob))
+            tmpname = tempfile.mktemp(dir=os.path.dirname(blob),
+                                      suffix='.tmp')
+            try:
+                # Other names of the file could change the blob
+                if st.st_nlink > 1:
+                    raise OSError(errno.EMLINK, 'File has several links')
+                os.link(filename, tmpname)
+            except OSError:
+                # Another file system, or links are not allowed
+                shutil.copyfile(filename, tmpname)
+            os.rename(tmpname, blob)
+        return {'kind': FILE, 'blob': digest, 'mode': stat.S_IMODE(st.st_mode),
+                'uid': st.st_uid, 'gid': st.st_gid}
+
+    def _blob(self, digest):
+        return blob_path(self.store, digest)
+
+
+def _holds(blob, filename, st):
+    """
+    Return True if the blob has the contents of the file of stat 'st'.
+    """
+    try:
+        bst = os.stat(blob)
+    except OSError:
+        return False
+    if (bst.st_dev, bst.st_ino) == (st.st_dev, st.st_ino):
+        return True
+    if bst.st_size != st.st_size:
+        return False
+    with open(blob, 'rb') as bfil:
+        with open(filename, 'rb') as fil:
+            while True:
+                chunk = bfil.read(1 << 16)
+                if chunk != fil.read(1 << 16):
+                    return False
+                if not chunk:
+                    return True
+
+
+def blob_path(store, digest):
+    return os.path.join(store, 'blobs', digest[:2], digest)
+
+
+def logs(store):
+    """
+    Return the logs of the store, oldest first.
+    """
+    logdir = os.path.join(store, 'log')
+    if not os.path.isdir(logdir):
+        return []
+    result = []
+    for name in sorted(os.listdir(logdir)):
+        if name.endswith('.json'):
+            with open(os.path.join(logdir, name), 'r') as fil:
+                result.append(json.load(fil))
+    return sorted(result, key=lambda log: (log['time'], log['id']))
+
+
+def load(store, txnid):
+    """
+    Return the log of the transaction.
+
+    Raises ValueError if there is no such transaction.
+    """
+    filename = os.path.join(store, 'log', '{}.json'.format(txnid))
+    if os.sep in txnid or not os.path.exists(filename):
+        raise ValueError('No such transaction: {}'.format(txnid))
+    with open(filename, 'r') as fil:
+        return json.load(fil)
+
+
+def rollback(store, txnid, trans):
+    """
+    Restore the files changed by the transaction to their previous states,
+    within the transaction 'trans'. Return the restored filenames.
+
+    Raises ValueError if there is no such transaction.
+    """
+    log = load(store, txnid)
+    for filename, state in sorted(log['files'].items()):
+        kind = state['kind']
+        if kind == ABSENT:
+            trans.remove(filename)
+        elif kind == LINK:
+            trans.symlink(state['target'], filename)
+        else:
+            with open(blob_path(store, state['blob']), 'rb') as fil:
+                trans.write(filename, iter(lambda: fil.read(1 << 16), b''),
+                            mode=state['mode'], follow=False)
+            # The mode and owner of a file replaced are kept
+            st = os.lstat(filename)
+            if stat.S_IMODE(st.st_mode) != state['mode']:
+                os.chmod(filename, state['mode'])
+            if (st.st_uid, st.st_gid) != (state['uid'], state['gid']):
+                os.lchown(filename, state['uid'], state['gid'])
+    return sorted(log['files'])
+
+
+def gc(store, keep=KEEP, age=None):
+    """
+    Remove the logs but the 'keep' latest, and those older than 'age'
+    seconds, then the blobs no log refers to. Return the ids of the logs
+    removed and the number of blobs removed.
+    """
+    if not os.path.isdir(store):
+        return [], 0
+    lockfd = _lock(store, fcntl.LOCK_EX)
+    try:
+        return _gc(store, keep, age)
+    finally:
+        os.close(lockfd)
+
+
+def _gc(store, keep, age):
+    current = logs(store)
+    removed = current[:max(0, len(current) - keep)]
+    if age is not None:
+        limit = time.time() - age
+        removed.extend(log for log in current[len(removed):]
+                       if log['time'] < limit)
+    for log in removed:
+        os.remove(os.path.join(store, 'log', '{}.json'.format(log['id'])))
+
+    ids = set(log['id'] for log in removed)
+    referenced = set(state['blob'] for log in current if log['id'] not in ids
+                     for state in log['files'].values()
+                     if state['kind'] == FILE)
+    blobs = 0
+    blobdir = os.path.join(store, 'blobs')
+    for dirpath, _, names in os.walk(blobdir):
+        for name in names:
+            if name not in referenced:
+                os.remove(os.path.join(dirpath, name))
+                blobs += 1
+    return sorted(ids), blobs
+
+
+def _lock(store, operation):
+    """
+    Return a descriptor holding a lock on the store, released when closed.
+    """
+    _makedirs(store)
+    fd = os.open(os.path.join(store, 'lock'), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        # Programs run meanwhile (dconf...) must not hold the lock
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        fcntl.flock(fd, operation)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+
+def _makedirs(dirname):
+    # Only root may read the previous contents of the files
+    try:
+        os.makedirs(dirname, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,172 @@
+# GrrProxy is a simple GUI tool to manage proxy settings in linux.
+# Copyright (C) 2014 Cadogan West
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Contact the author via email: ultrabook@email.com
+
+
+"""
+Multi-user operations.
+
+The bash settings of a user live in the home directory, and the backend
+functions only cover the user running them (HOME). The functions here run
+the per-user part of the bash target (see backend.check_user_bash,
+set_user_bash and remove_user_bash) over many users at once, with a pool of
+worker threads. The system wide files are left to the usual targets.
+
+Users are taken from the password database, or from a list of home
+directories.
+"""
+
+
+import collections
+import functools
+import os
+import pwd
+
+import backend
+import executor
+
+
+# Users below this UID are system accounts
+UID_MIN = 1000
+LOGINDEFS = '/etc/login.defs'
+
+# Shells of accounts which cannot log in
+NOLOGIN = ('/usr/sbin/nologin', '/sbin/nologin', '/bin/false',
+           '/usr/bin/false')
+
+DEFAULT_WORKERS = 16
+
+
+User = collections.namedtuple('User', 'name home')
+
+UserResult = collections.namedtuple('UserResult',
+                                    'name home result exception elapsed')
+
+
+def uid_min():
+    """
+    Return the least UID of regular users, as configured in login.defs.
+    """
+    try:
+        with open(LOGINDEFS, 'r') as fil:
+            for line in fil:
+                fields = line.split()
+                if len(fields) == 2 and fields[0] == 'UID_MIN':
+                    return int(fields[1])
+    except (IOError, ValueError):
+        pass
+    return UID_MIN
+
+
+def passwd_users():
+    """
+    Return the Users of the password database who can log in and have a home
+    directory, root included.
+    """
+    least = uid_min()
+    users = []
+    for entry in pwd.getpwall():
+        if entry.pw_uid != 0 and entry.pw_uid < least:
+            continue
+        if entry.pw_shell in NOLOGIN or not os.path.isdir(entry.pw_dir):
+            continue
+        users.append(User(entry.pw_name, entry.pw_dir))
+    return _unique(users)
+
+
+def home_users(homes):
+    """
+    Return the Users of the home directories, named after the owner of each
+    directory (or the directory itself if it has no known owner).
+    """
+    users = []
+    for home in homes:
+        home = os.path.abspath(home)
+        try:
+            name = pwd.getpwuid(os.stat(home).st_uid).pw_name
+        except (KeyError, OSError):
+            name = os.path.basename(home)
+        users.append(User(name, home))
+    return _unique(users)
+
+
+def _unique(users):
+    # Several accounts may share a home directory
+    seen = set()
+    return [u for u in users if not (u.home in seen or seen.add(u.home))]
+
+
+def run(func, users, phase=None, workers=DEFAULT_WORKERS):
+    """
+    Call func(home) for each user and return a list of UserResults in the
+    order of the users.
+
+    Exceptions are caught and returned in the results (see executor.run). The
+    scan index is saved once all the users are done.
+    """
+    homes = dict((u.home, u) for u in users)
+    funcs = dict((home, functools.partial(func, home)) for home in homes)
+    try:
+        results = executor.run(funcs, phase=phase, workers=workers,
+                               dependencies={})
+    finally:
+        backend.index.save()
+    results = dict((r.name, r) for r in results)
+    return [UserResult(u.name, u.home, results[u.home].result,
+                       results[u.home].exception, results[u.home].elapsed)
+            for u in users]
+
+
+def check(users, workers=DEFAULT_WORKERS):
+    """
+    Return the files of each user containing proxy settings for bash.
+    """
+    return run(backend.check_user_bash, users, 'Checking', workers)
+
+
+def apply(users, settings, workers=DEFAULT_WORKERS):
+    """
+    Apply proxy settings for bash to each user. Return the changed files.
+
+    'settings' are the keyword arguments of backend.set_user_bash.
+    """
+    func = functools.partial(backend.set_user_bash, **settings)
+    return run(func, users, 'Setting', workers)
+
+
+def remove(users, workers=DEFAULT_WORKERS):
+    """
+    Remove proxy settings for bash from each user. Return the changed files.
+    """
+    return run(backend.remove_user_bash, users, 'Removing', workers)
+
+
+def table(results):
+    """
+    Return the results as a text table, one user per line.
+    """
+    rows = [('USER', 'HOME', 'STATUS', 'FILES')]
+    for r in results:
+        if r.exception is not None:
+            rows.append((r.name, r.home, 'error', str(r.exception)))
+        else:
+            files = ' '.join(os.path.basename(f) for f in r.result)
+            rows.append((r.name, r.home, 'ok', files or '-'))
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    return '\n'.join('{:{}}  {:{}}  {:{}}  {}'.format(
+        row[0], widths[0], row[1], widths[1], row[2], widths[2], row[3])
+        .rstrip() for row in rows)